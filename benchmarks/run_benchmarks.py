@@ -0,0 +1,162 @@
+# Benchmarks of pipeline stages with synthetic data
+"""
+Author: Sebastian Haan
+Affiliation: Sydney Information Hub, The University of Sydney
+
+Comments:
+Times the main stages (combine_geodata, poly2raster, rasterdiff, webmap3d) on synthetic census-like data
+(see synthetic.py) for different polygon counts, pixel sizes and engines. Each stage runs in a fresh process,
+so wall time, CPU time (including gdal subprocesses) and peak memory (RSS) are measured per stage.
+Results are saved as csv table; with --compare a previous result table is joined to show speedups.
+
+Run from main directory, e.g.:
+python benchmarks/run_benchmarks.py --npoly 1000 10000 --pixsize 100 200 --engine gdal rasterio --outpath ../Results/Benchmarks/
+python benchmarks/run_benchmarks.py --npoly 1000 10000 --compare ../Results/Benchmarks/benchmarks_<date>.csv
+"""
+
+import os
+import sys
+import time
+import resource
+import argparse
+import shutil
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic import make_dataset
+
+
+def _measure(func, args, kwargs):
+	""" Runs func in current (fresh worker) process and returns wall time, CPU time and peak RSS in MB
+	"""
+	start_wall = time.perf_counter()
+	self_start = resource.getrusage(resource.RUSAGE_SELF)
+	child_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+	error = ''
+	try:
+		func(*args, **kwargs)
+	except Exception as e:
+		error = type(e).__name__ + ': ' + str(e)
+	wall = time.perf_counter() - start_wall
+	self_end = resource.getrusage(resource.RUSAGE_SELF)
+	child_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+	cpu = (self_end.ru_utime + self_end.ru_stime - self_start.ru_utime - self_start.ru_stime
+		+ child_end.ru_utime + child_end.ru_stime - child_start.ru_utime - child_start.ru_stime)
+	# ru_maxrss in kB on Linux, in bytes on macOS
+	scale = 1024. ** 2 if sys.platform == 'darwin' else 1024.
+	rss = max(self_end.ru_maxrss, child_end.ru_maxrss) / scale
+	return {'wall_s': round(wall, 3), 'cpu_s': round(cpu, 3), 'peak_rss_mb': round(rss, 1), 'error': error}
+
+
+def run_stage(func, *args, **kwargs):
+	""" Runs stage in a new process (so peak memory is not inherited from previous stages)
+	"""
+	with ProcessPoolExecutor(max_workers = 1) as pool:
+		return pool.submit(_measure, func, args, kwargs).result()
+
+
+def _combine(**kwargs):
+	from lib.rasterize import combine_geodata
+	combine_geodata(**kwargs)
+
+
+def _poly2raster(*args, **kwargs):
+	from lib.rasterize import poly2raster
+	poly2raster(*args, **kwargs)
+
+
+def _rasterdiff(*args, **kwargs):
+	from lib.rasterize import rasterdiff
+	rasterdiff(*args, **kwargs)
+
+
+def _webmap3d(*args, **kwargs):
+	from lib.visual import webmap3d
+	webmap3d(*args, **kwargs)
+
+
+def run_benchmarks(list_npoly, pixsizes, engines, outpath, nfeatures = 5, weightings = ['upsample'], repeat = 1, webmap = True):
+	""" Runs all benchmark stages for all combinations of polygon count, pixel size and engine
+
+	RETURN
+	Dataframe with one row per stage run
+	"""
+	results = []
+	datapath = os.path.join(outpath, 'data/')
+	for npoly in list_npoly:
+		fname_poly, fname_data, fname_mask, features = make_dataset(datapath, npoly, nfeatures = nfeatures)
+		fname_comb = os.path.join(datapath, 'comb_' + str(npoly) + '.gpkg')
+		config = {'npoly': npoly, 'nfeatures': len(features)}
+		for rep in range(repeat):
+			res = run_stage(_combine, fname_poly = fname_poly, fname_data = fname_data, featurelist = list(features),
+				polymask = fname_mask, outfile = fname_comb, indexname = 'SA1_CODE7')
+			results.append(dict(config, stage = 'combine_geodata', engine = '', pixsize = '', weighting = '', repeat = rep, **res))
+		# feature list after combine (TOTAL replaced by POPDENS_100m)
+		featurelist = features[:-1] + ['POPDENS_100m']
+		for pixsize in pixsizes:
+			webmap_done = not webmap
+			for engine in engines:
+				for weighting in (weightings if engine == 'rasterio' else ['upsample']):
+					rasterpath = os.path.join(outpath, 'raster_' + str(npoly) + '_' + str(pixsize) + '_' + engine + '_' + weighting + '/')
+					if not os.path.exists(rasterpath):
+						os.makedirs(rasterpath)
+					name = dict(config, engine = engine, pixsize = pixsize, weighting = weighting)
+					rasters = [rasterpath + 'raster_' + str(int(pixsize)) + 'm_' + feature + '.tif' for feature in featurelist]
+					for rep in range(repeat):
+						res = run_stage(_poly2raster, fname_comb, rasterpath, featurelist, polymask = fname_mask, pixsize = pixsize,
+							engine = engine, weighting = weighting)
+						# gdal tools report failures only as print output
+						if (res['error'] == '') and not all(os.path.exists(fname) for fname in rasters):
+							res['error'] = 'missing output rasters'
+						results.append(dict(name, stage = 'poly2raster', repeat = rep, **res))
+					if res['error'] != '':
+						shutil.rmtree(rasterpath)
+						continue
+					for rep in range(repeat):
+						res = run_stage(_rasterdiff, rasters[0], rasters[1], rasterpath + 'diff.tif', norm = True, engine = engine)
+						results.append(dict(name, stage = 'rasterdiff', repeat = rep, **res))
+					if not webmap_done:
+						# webmap3d is independent of engine, run once per pixel size
+						res = run_stage(_webmap3d, rasters[-1], rasterpath, 'webmap', featurename = 'PopDens', zfilter = 0.01)
+						results.append(dict(name, stage = 'webmap3d', repeat = 0, **res))
+						webmap_done = True
+					shutil.rmtree(rasterpath)
+	return pd.DataFrame(results)
+
+
+def summary(df, compare = None):
+	""" Table of median wall time, CPU time and peak memory per configuration and stage,
+	with speedup relative to previous results (compare) if given
+	"""
+	keys = ['stage', 'npoly', 'nfeatures', 'pixsize', 'engine', 'weighting']
+	df = df.fillna('').astype({'pixsize': str})
+	table = df.groupby(keys, sort = False).agg(wall_s = ('wall_s', 'median'), cpu_s = ('cpu_s', 'median'),
+		peak_rss_mb = ('peak_rss_mb', 'max'), error = ('error', 'first')).reset_index()
+	if compare is not None:
+		old = compare.fillna('').astype({'pixsize': str}).groupby(keys, sort = False).agg(wall_s_old = ('wall_s', 'median')).reset_index()
+		table = table.merge(old, how = 'left', on = keys)
+		table['speedup'] = (table.wall_s_old / table.wall_s).round(2)
+	return table
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Benchmark pipeline stages with synthetic data')
+	parser.add_argument('--npoly', type = int, nargs = '+', default = [1000, 10000])
+	parser.add_argument('--pixsize', type = float, nargs = '+', default = [100])
+	parser.add_argument('--engine', nargs = '+', default = ['gdal', 'rasterio'])
+	parser.add_argument('--weighting', nargs = '+', default = ['upsample'], help = "weightings for engine rasterio: 'upsample', 'exact'")
+	parser.add_argument('--nfeatures', type = int, default = 5)
+	parser.add_argument('--repeat', type = int, default = 1)
+	parser.add_argument('--no-webmap', action = 'store_true', help = 'skip webmap3d stage')
+	parser.add_argument('--outpath', default = '../Results/Benchmarks/')
+	parser.add_argument('--compare', default = None, help = 'csv file with previous benchmark results')
+	args = parser.parse_args()
+	df = run_benchmarks(args.npoly, args.pixsize, args.engine, args.outpath, nfeatures = args.nfeatures, weightings = args.weighting,
+		repeat = args.repeat, webmap = not args.no_webmap)
+	fname = os.path.join(args.outpath, 'benchmarks_' + time.strftime('%Y%m%d_%H%M%S') + '.csv')
+	df.to_csv(fname, index = False)
+	compare = pd.read_csv(args.compare) if args.compare is not None else None
+	pd.set_option('display.width', 200)
+	print(summary(df, compare = compare).to_string(index = False))
+	print('Benchmark results saved to ' + fname)
@@ -0,0 +1,109 @@
+# Synthetic census-like test data for benchmarks
+"""
+Author: Sebastian Haan
+Affiliation: Sydney Information Hub, The University of Sydney
+
+Comments:
+Generates a tessellation of polygons (Voronoi cells of random points, denser towards the centre as for census regions
+in cities) with an attribute table in the same format as the preprocessed income data (NEWPERC_INC*.csv)
+and a mask polygon (as SYD_SHAPE.gpkg). All data is reproducible with the given seed.
+
+Run with e.g.: python benchmarks/synthetic.py --npoly 10000 --outpath ../Data/Synthetic/
+"""
+
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely.geometry import box, Point
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lib.rasterize import write_polygons
+
+FEATURES = ['VERY_LOW', 'LOW', 'MID', 'HIGH', 'VERY_HIGH']
+
+
+def make_tessellation(npoly, area_km2 = 0.5, crs = 'epsg:3577', origin = (1.5e6, -3.9e6), seed = 0, indexname = 'SA1_CODE7'):
+	""" Generates polygon tessellation with npoly regions, region sizes are smallest in the centre
+
+	:param npoly: number of polygons
+	:param area_km2: mean area of polygons in km^2 (extent of tessellation scales with npoly)
+	:param crs: coordinate reference system (in meters)
+	:param origin: lower left corner of tessellation
+	:param seed: random seed
+
+	RETURN
+	GeoDataFrame with columns indexname, AREASQKM, geometry
+	"""
+	rng = np.random.default_rng(seed)
+	size = np.sqrt(npoly * area_km2) * 1e3
+	# 60% of region centres concentrated around centre (city), 40% uniform
+	ncity = int(0.6 * npoly)
+	city = np.clip(rng.normal(0.5, 0.15, (ncity, 2)), 0, 1)
+	points = np.vstack([city, rng.random((npoly - ncity, 2))]) * size + np.asarray(origin)
+	extent = box(origin[0], origin[1], origin[0] + size, origin[1] + size)
+	cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(points), extend_to = extent))
+	cells = shapely.intersection(cells, extent)
+	poly = gpd.GeoDataFrame({indexname: [str(1000000 + i) for i in range(len(cells))]}, geometry = cells, crs = crs)
+	poly['AREASQKM'] = poly.area * 1e-6
+	return poly
+
+
+def make_attributes(poly, features = FEATURES, seed = 0, indexname = 'SA1_CODE7'):
+	""" Generates attribute table: fractions of population in income bins (sum to 1) and total population
+	(density decreasing from the centre)
+	"""
+	rng = np.random.default_rng(seed + 1)
+	frac = rng.dirichlet(np.ones(len(features)) * 2, len(poly))
+	xmin, ymin, xmax, ymax = poly.total_bounds
+	dist = poly.centroid.distance(Point(0.5 * (xmin + xmax), 0.5 * (ymin + ymax))).values
+	density = 5000. * np.exp(-dist / (dist.max() / 3 + 1)) + 10
+	df = pd.DataFrame(np.round(frac, 4), columns = features)
+	df.insert(0, indexname, poly[indexname].values)
+	df['TOTAL'] = np.round(density * poly['AREASQKM'].values).astype(int) + 1
+	return df
+
+
+def make_mask(poly, fraction = 0.4):
+	""" Circular mask around centre of tessellation with radius fraction of extent
+	"""
+	xmin, ymin, xmax, ymax = poly.total_bounds
+	mask = Point(0.5 * (xmin + xmax), 0.5 * (ymin + ymax)).buffer(fraction * (xmax - xmin))
+	return gpd.GeoDataFrame(geometry = [mask], crs = poly.crs)
+
+
+def make_dataset(outpath, npoly, area_km2 = 0.5, nfeatures = len(FEATURES), seed = 0, parquet = False):
+	""" Writes synthetic dataset to outpath: poly_<npoly>.gpkg (and .parquet), data_<npoly>.csv and mask_<npoly>.gpkg
+
+	RETURN
+	filenames of polygons, data and mask, list of features
+	"""
+	if not os.path.exists(outpath):
+		os.makedirs(outpath)
+	features = FEATURES[:nfeatures] if nfeatures <= len(FEATURES) else FEATURES + ['FEATURE' + str(i) for i in range(len(FEATURES), nfeatures)]
+	fname_poly = os.path.join(outpath, 'poly_' + str(npoly) + '.gpkg')
+	fname_data = os.path.join(outpath, 'data_' + str(npoly) + '.csv')
+	fname_mask = os.path.join(outpath, 'mask_' + str(npoly) + '.gpkg')
+	print('Generating synthetic dataset with ' + str(npoly) + ' polygons ...')
+	poly = make_tessellation(npoly, area_km2 = area_km2, seed = seed)
+	poly.to_file(fname_poly, driver = 'GPKG')
+	if parquet:
+		write_polygons(poly, fname_poly.replace('.gpkg', '.parquet'))
+	make_attributes(poly, features = features, seed = seed).to_csv(fname_data, index = False)
+	make_mask(poly).to_file(fname_mask, driver = 'GPKG')
+	return fname_poly, fname_data, fname_mask, features + ['TOTAL']
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Generate synthetic census-like polygons, attribute table and mask')
+	parser.add_argument('--npoly', type = int, nargs = '+', default = [1000])
+	parser.add_argument('--area', type = float, default = 0.5, help = 'mean polygon area in km^2')
+	parser.add_argument('--nfeatures', type = int, default = len(FEATURES))
+	parser.add_argument('--seed', type = int, default = 0)
+	parser.add_argument('--parquet', action = 'store_true', help = 'also write polygons as GeoParquet boundary store')
+	parser.add_argument('--outpath', default = '../Data/Synthetic/')
+	args = parser.parse_args()
+	for npoly in args.npoly:
+		make_dataset(args.outpath, npoly, area_km2 = args.area, nfeatures = args.nfeatures, seed = args.seed, parquet = args.parquet)
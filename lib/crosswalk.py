@@ -0,0 +1,212 @@
+# Area-weighted crosswalk between polygon boundaries of different census years
+"""
+Author: Sebastian Haan
+Affiliation: Sydney Information Hub, The University of Sydney
+
+Comments:
+Features of one set of regions (e.g. 2006 CDs) are re-aggregated to another set of regions (e.g. 2016 SA1s) without raster intermediate.
+The overlap areas of all source and target polygons are computed once (candidate pairs from an STRtree, intersection areas
+with vectorized shapely functions) and stored as sparse matrix with shape (target, source).
+Any number of feature columns is then re-aggregated with one sparse matrix product:
+- intensive features (percentages, densities such as POPDENS_100m): area-weighted mean over the target region,
+  same as the average over all pixels of the target region in the rasterized data;
+- extensive features (counts such as TOTAL): sum of source values weighted by the fraction of the source area within the target region.
+Source values that are NaN are ignored (intensive features are averaged over the valid overlap area only).
+
+Example:
+cw = build_crosswalk(read_polygons('SYD06mask_COMB.gpkg'), read_polygons('SYD16mask_COMB.gpkg'), 'SA1_CODE7')
+data16 = cw.apply(comb06.set_index('SA1_CODE7'), ['LOW', 'POPDENS_100m'])
+"""
+
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+import shapely
+from scipy import sparse
+from .rasterize import read_polygons, write_polygons, geometry_hash
+from . import profiling
+
+# maximum number of candidate polygon pairs that are intersected at once (limits memory of intersection geometries)
+BATCHSIZE = 100000
+
+
+class Crosswalk:
+	""" Overlap areas between source and target regions
+
+	:param areas: sparse matrix (target, source) of overlap areas
+	:param source_index: index labels of source regions (columns of areas)
+	:param target_index: index labels of target regions (rows of areas)
+	:param source_area: total area of each source region (for extensive features)
+	"""
+	def __init__(self, areas, source_index, target_index, source_area):
+		self.areas = sparse.csr_matrix(areas)
+		self.source_index = pd.Index(source_index)
+		self.target_index = pd.Index(target_index)
+		self.source_area = np.asarray(source_area, dtype = float)
+
+	def coverage(self):
+		""" Area of each target region that is covered by source regions
+		"""
+		return np.asarray(self.areas.sum(axis = 1)).ravel()
+
+	def weights(self, kind = 'intensive'):
+		""" Sparse weight matrix (target, source), target values are weights @ source values (for source values without NaN)
+
+		:param kind: 'intensive' (rows normalised to 1, area-weighted mean) or 'extensive' (columns normalised by source area)
+		"""
+		if kind == 'intensive':
+			total = np.asarray(self.areas.sum(axis = 1)).ravel()
+			return sparse.diags(np.divide(1., total, out = np.zeros_like(total), where = total > 0)) @ self.areas
+		elif kind == 'extensive':
+			return self.areas @ sparse.diags(np.divide(1., self.source_area, out = np.zeros_like(self.source_area),
+				where = self.source_area > 0))
+		raise ValueError("Crosswalk: kind must be either 'intensive' or 'extensive', got " + str(kind))
+
+	def apply(self, data, columns = None, kind = 'intensive'):
+		""" Re-aggregates feature columns of source regions to target regions with one sparse matrix product
+
+		:param data: DataFrame with index labels of source regions as index (regions not in data are NaN)
+		:param columns: list of feature columns (Default: all numeric columns)
+		:param kind: 'intensive' (area-weighted mean, for percentages and densities) or 'extensive' (area-weighted sum, for counts),
+			or dictionary {column: kind}
+
+		RETURN
+		DataFrame of features with index labels of target regions as index, NaN for target regions without valid source data
+		"""
+		if columns is None:
+			columns = list(data.select_dtypes(include = 'number').columns)
+		kinds = kind if isinstance(kind, dict) else {col: kind for col in columns}
+		values = data.reindex(self.source_index)[columns].to_numpy(dtype = float)
+		valid = np.isfinite(values)
+		extensive = np.asarray([kinds[col] == 'extensive' for col in columns])
+		# extensive features are weighted by the fraction of each source region within target region
+		scale = np.divide(1., self.source_area, out = np.zeros_like(self.source_area), where = self.source_area > 0)[:, None]
+		values = np.where(valid, values, 0.) * np.where(extensive, scale, 1.)
+		# values and valid area of all features in one product
+		result = self.areas @ np.hstack([values, valid.astype(float)])
+		total, cover = result[:, :len(columns)], result[:, len(columns):]
+		mean = np.divide(total, cover, out = np.full(total.shape, np.nan), where = cover > 0)
+		result = np.where(extensive, np.where(cover > 0, total, np.nan), mean)
+		return pd.DataFrame(result, index = self.target_index, columns = columns)
+
+	def save(self, fname):
+		""" Saves crosswalk as .npz file
+		"""
+		areas = self.areas.tocsr()
+		fname_temp = fname + '.' + str(os.getpid()) + '.tmp.npz'
+		np.savez_compressed(fname_temp, data = areas.data, indices = areas.indices, indptr = areas.indptr, shape = areas.shape,
+			source_index = self.source_index.astype(str).to_numpy(dtype = str), target_index = self.target_index.astype(str).to_numpy(dtype = str),
+			source_area = self.source_area)
+		os.replace(fname_temp, fname)
+
+
+def load_crosswalk(fname):
+	""" Loads crosswalk saved with Crosswalk.save (index labels as strings)
+	"""
+	with np.load(fname, allow_pickle = False) as npz:
+		areas = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape = tuple(npz['shape']))
+		return Crosswalk(areas, npz['source_index'], npz['target_index'], npz['source_area'])
+
+
+def overlap_areas(source_geoms, target_geoms):
+	""" Sparse matrix of overlap areas of all intersecting pairs of target and source polygons
+
+	:param source_geoms: array or GeoSeries of source polygons
+	:param target_geoms: array or GeoSeries of target polygons (same crs as source)
+
+	RETURN
+	scipy.sparse csr matrix with shape (number of target polygons, number of source polygons)
+	"""
+	source_geoms = np.asarray(source_geoms, dtype = object)
+	target_geoms = np.asarray(target_geoms, dtype = object)
+	# Invalid polygons (e.g. self-intersections) are repaired, as intersection would fail otherwise
+	source_geoms = np.where(shapely.is_valid(source_geoms), source_geoms, shapely.make_valid(source_geoms))
+	target_geoms = np.where(shapely.is_valid(target_geoms), target_geoms, shapely.make_valid(target_geoms))
+	tree = shapely.STRtree(source_geoms)
+	itarget, isource = tree.query(target_geoms, predicate = 'intersects')
+	areas = np.zeros(len(itarget))
+	for start in range(0, len(itarget), BATCHSIZE):
+		sel = slice(start, start + BATCHSIZE)
+		areas[sel] = shapely.area(shapely.intersection(target_geoms[itarget[sel]], source_geoms[isource[sel]]))
+	# pairs that only touch have zero overlap area
+	keep = areas > 0
+	return sparse.csr_matrix((areas[keep], (itarget[keep], isource[keep])), shape = (len(target_geoms), len(source_geoms)))
+
+
+def build_crosswalk(source, target, indexname, target_indexname = None, crs = 'epsg:3577', cachedir = None):
+	""" Builds crosswalk from source to target regions
+
+	:param source: GeoDataFrame of source regions with index column indexname
+	:param target: GeoDataFrame of target regions with index column target_indexname
+	:param indexname: name of index column of source regions
+	:param target_indexname: name of index column of target regions (Default: indexname)
+	:param crs: coordinate reference system in meters for area calculation (Default 'epsg:3577' - Australian Albers meters)
+	:param cachedir: directory for caching crosswalk, named by content hash of source and target polygons (optional)
+
+	RETURN
+	Crosswalk
+	"""
+	target_indexname = indexname if target_indexname is None else target_indexname
+	if (source.crs is None) or (not source.crs.equals(crs)):
+		source = source.to_crs(crs)
+	if (target.crs is None) or (not target.crs.equals(crs)):
+		target = target.to_crs(crs)
+	if cachedir is not None:
+		key = '|'.join([geometry_hash(source.geometry), geometry_hash(target.geometry), str(crs),
+			','.join(source[indexname].astype(str)), ','.join(target[target_indexname].astype(str))])
+		fname_cache = os.path.join(cachedir, 'crosswalk_' + hashlib.sha1(key.encode()).hexdigest() + '.npz')
+		if os.path.exists(fname_cache):
+			print('Reading cached crosswalk ' + fname_cache + ' ...')
+			return load_crosswalk(fname_cache)
+	print('Calculating overlap areas of ' + str(len(source)) + ' source and ' + str(len(target)) + ' target regions ...')
+	areas = overlap_areas(source.geometry.values, target.geometry.values)
+	cw = Crosswalk(areas, source[indexname].astype(str).values, target[target_indexname].astype(str).values, source.area.values)
+	if cachedir is not None:
+		if not os.path.exists(cachedir):
+			os.makedirs(cachedir, exist_ok = True)
+		cw.save(fname_cache)
+	return cw
+
+
+@profiling.stage('crosswalk_changes')
+def crosswalk_changes(comb_files, target_year, pairs, featurelist, indexname = 'SA1_CODE7', outfile = None,
+	crs = 'epsg:3577', cachedir = None):
+	""" Re-aggregates features of all years to the regions of target_year and calculates changes per target region,
+	alternative to rasterdiff when changes are needed per region rather than per pixel.
+	All features are treated as intensive (percentages and POPDENS_100m, see combine_geodata).
+
+	:param comb_files: dictionary {year: path+filename of combined polygon file of year (output of combine_geodata)}
+	:param target_year: year of target regions, e.g. '16'
+	:param pairs: list of year pairs (year2, year1), change is year2 - year1, e.g. [('11', '06'), ('16', '11'), ('16', '06')]
+	:param featurelist: list of features
+	:param indexname: name of index column in all combined files
+	:param outfile: path+filename of output file (optional, .gpkg or GeoParquet boundary store .parquet)
+	:param crs: coordinate reference system in meters for area calculation
+	:param cachedir: directory for caching crosswalks (optional)
+
+	RETURN
+	GeoDataFrame of target regions with columns <feature>_20<year> for each year and change_20<year2>-20<year1>_<feature> for each pair
+	"""
+	target = read_polygons(comb_files[target_year])
+	target[indexname] = target[indexname].astype(str)
+	result = target[[indexname, 'geometry']].copy()
+	values = {}
+	for year, fname in comb_files.items():
+		if year == target_year:
+			values[year] = target.set_index(indexname)[featurelist]
+		else:
+			source = read_polygons(fname)
+			source[indexname] = source[indexname].astype(str)
+			with profiling.stage('crosswalk' + year):
+				cw = build_crosswalk(source, target, indexname, crs = crs, cachedir = cachedir)
+				values[year] = cw.apply(source.set_index(indexname), featurelist)
+		for feature in featurelist:
+			result[feature + '_20' + year] = values[year][feature].to_numpy()
+	for year2, year1 in pairs:
+		for feature in featurelist:
+			result['change_20' + year2 + '-20' + year1 + '_' + feature] = (values[year2][feature] - values[year1][feature]).to_numpy()
+	if outfile is not None:
+		print('Saving regional changes to ' + outfile + ' ...')
+		write_polygons(result, outfile)
+	return result
@@ -0,0 +1,240 @@
+# Spatio-temporal datacube of raster outputs with dimensions (year, feature, y, x)
+"""
+Author: Sebastian Haan
+Affiliation: Sydney Information Hub, The University of Sydney
+
+Comments:
+All rasters of all years and features (on the same grid) are stacked in one array, so changes between years are computed
+for all year pairs and features at once as array operations instead of one raster calculation per pair and feature.
+The cube can be saved as chunked Zarr store (.zarr) or NetCDF file (.nc); this requires xarray (and zarr or netCDF4),
+which are only imported when saving or loading the cube.
+write_datacube_changes builds the cube block by block (all years and features of one block, see read_datacube with window),
+so memory is bounded by the block size; only saving the cube needs the entire cube in memory.
+
+Example:
+cube = read_datacube({'06': {'LOW': 'Raster_2006/raster_100m_LOW.tif'}, '16': {'LOW': 'Raster_2016/raster_100m_LOW.tif'}})
+change = datacube_changes(cube, [('16', '06')])  # shape (1, 1, height, width)
+"""
+
+import os
+import numpy as np
+import rasterio
+from .rasterize import read_raster, output_profile
+from .rastercalc import BlockWriter, scales_from_range, _windows
+from . import profiling
+
+
+class Datacube:
+	""" Raster data of several years and features on a common grid
+
+	:param data: float array with shape (year, feature, y, x), NaN for no-data
+	:param years: list of year labels, e.g. ['06', '11', '16']
+	:param features: list of feature names
+	:param transform: affine transform of grid
+	:param crs: coordinate reference system of grid
+	"""
+	def __init__(self, data, years, features, transform, crs):
+		self.data = data
+		self.years = list(years)
+		self.features = list(features)
+		self.transform = transform
+		self.crs = crs
+
+	def sel(self, year = None, feature = None):
+		""" Returns data of one year and/or feature, e.g. time series of feature for all pixels with cube.sel(feature = 'LOW')
+		"""
+		data = self.data
+		if feature is not None:
+			data = data[:, self.features.index(feature)]
+		if year is not None:
+			data = data[self.years.index(year)]
+		return data
+
+	def to_xarray(self):
+		""" Returns cube as xarray.DataArray with coordinates year, feature, y, x (pixel centres)
+		"""
+		import xarray as xr
+		height, width = self.data.shape[2:]
+		xpos = self.transform.c + (np.arange(width) + 0.5) * self.transform.a
+		ypos = self.transform.f + (np.arange(height) + 0.5) * self.transform.e
+		return xr.DataArray(self.data, dims = ('year', 'feature', 'y', 'x'), name = 'data',
+			coords = {'year': self.years, 'feature': self.features, 'y': ypos, 'x': xpos},
+			attrs = {'crs': self.crs.to_wkt(), 'transform': list(self.transform)[:6]})
+
+	def save(self, fname, chunks = (1, 1, 512, 512)):
+		""" Saves cube as chunked Zarr store (fname ends with .zarr) or NetCDF file (.nc)
+
+		:param fname: path+filename of cube
+		:param chunks: chunk size (year, feature, y, x), default one year and feature per chunk for fast reading of single maps
+		"""
+		cube = self.to_xarray().to_dataset()
+		chunks = tuple(min(chunk, size) for chunk, size in zip(chunks, self.data.shape))
+		if fname.endswith('.zarr'):
+			cube.to_zarr(fname, mode = 'w', encoding = {'data': {'chunks': chunks}})
+		elif fname.endswith('.nc'):
+			cube.to_netcdf(fname, encoding = {'data': {'zlib': True, 'chunksizes': chunks}})
+		else:
+			raise ValueError('Datacube: filename must end with .zarr or .nc, got ' + fname)
+
+
+def load_datacube(fname):
+	""" Loads cube saved with Datacube.save (data is read lazily with dask if available)
+
+	RETURN
+	xarray.DataArray with dimensions (year, feature, y, x)
+	"""
+	import xarray as xr
+	if fname.endswith('.zarr'):
+		return xr.open_zarr(fname)['data']
+	return xr.open_dataset(fname, chunks = {})['data']
+
+
+def read_datacube(rasters, window = None, dtype = np.float64):
+	""" Reads single-band rasters of all years and features into one cube
+
+	:param rasters: dictionary {year: {feature: path+filename of raster}}, all years need the same features and all rasters the same grid
+	:param window: rasterio Window to read only one block of the grid (optional), transform of cube is then the transform of the block
+	:param dtype: float type of cube, default float64 (same as raster calculations, e.g. rasterdiff);
+		float32 halves memory, but changes then differ from rasterdiff by about 1e-7 (relative)
+
+	RETURN
+	Datacube
+	"""
+	years = list(rasters)
+	features = list(rasters[years[0]])
+	with rasterio.open(rasters[years[0]][features[0]]) as src:
+		grid, crs, shape = src.transform, src.crs, src.shape
+		transform = grid if window is None else src.window_transform(window)
+	data = np.full((len(years), len(features)) + (shape if window is None else (int(window.height), int(window.width))), np.nan, dtype = dtype)
+	for i, year in enumerate(years):
+		if list(rasters[year]) != features:
+			raise ValueError('Datacube: features of year ' + str(year) + ' differ from ' + str(features))
+		for j, feature in enumerate(features):
+			fname = rasters[year][feature]
+			with rasterio.open(fname) as src:
+				if (src.shape != shape) or (not src.transform.almost_equals(grid)):
+					raise ValueError('Datacube: raster ' + fname + ' is not on the same grid as ' + rasters[years[0]][features[0]])
+			data[i, j] = read_raster(fname, band = 1, window = window)
+	return Datacube(data, years, features, transform, crs)
+
+
+def datacube_changes(cube, pairs, features = None, norm = False):
+	""" Changes between years for all year pairs and features in one array operation, NaN if no-data in either year.
+	Same as rasterdiff for each pair and feature.
+
+	:param cube: Datacube
+	:param pairs: list of year pairs (year2, year1), change is year2 - year1
+	:param features: list of features (Default: all features of cube)
+	:param norm: relative change (year2 - year1) / year1, NaN where year1 <= 0
+
+	RETURN
+	float array with shape (pair, feature, y, x), for large grids use blocks of the cube (see write_datacube_changes)
+	"""
+	features = cube.features if features is None else features
+	fidx = [cube.features.index(feature) for feature in features]
+	data = cube.data[:, fidx]
+	i2 = [cube.years.index(year2) for year2, year1 in pairs]
+	i1 = [cube.years.index(year1) for year2, year1 in pairs]
+	change = data[i2] - data[i1]
+	if norm:
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			change = np.where(data[i1] > 0, change / data[i1], np.nan)
+	return change
+
+
+def datacube_population(cube, features, normfeature = 'POPDENS_100m'):
+	""" Population in each feature bin (feature percentage times population density) for all years at once, same as rasterprod
+
+	RETURN
+	Datacube with population of features
+	"""
+	values = cube.data[:, [cube.features.index(feature) for feature in features]]
+	norm = cube.data[:, [cube.features.index(normfeature)]]
+	pop = values * norm * (norm > 0) * (values >= 0)
+	return Datacube(pop, cube.years, features, cube.transform, cube.crs)
+
+
+def _datacube_outputs(cube, rasters, pairs, outpath, features, pix, calc_change = True, calc_change2 = False):
+	""" All changes (and population rasters) of cube as dictionary {output path+filename: array}, see write_datacube_changes
+	"""
+	outputs = {}
+	if calc_change:
+		change = datacube_changes(cube, pairs, features = features)
+		for i, (year2, year1) in enumerate(pairs):
+			for j, feature in enumerate(features):
+				outputs[outpath + 'rasterchange_20' + year2 + '-20' + year1 + '_' + feature + '_' + pix + 'm.tif'] = change[i, j]
+	if calc_change2:
+		pop = datacube_population(cube, features)
+		# population rasters next to feature rasters of each year
+		for i, year in enumerate(pop.years):
+			for j, feature in enumerate(features):
+				outputs[os.path.join(os.path.dirname(rasters[year][feature]), 'raster_pop_' + pix + 'm_' + feature + '.tif')] = pop.data[i, j]
+		change = datacube_changes(pop, pairs, norm = True)
+		for i, (year2, year1) in enumerate(pairs):
+			for j, feature in enumerate(features):
+				outputs[outpath + 'rasterchange_pop_20' + year2 + '-20' + year1 + '_' + feature + '_' + pix + 'm.tif'] = change[i, j]
+	return outputs
+
+
+def write_datacube_changes(rasters, pairs, outpath, features, pix, calc_change = True, calc_change2 = False,
+	fname_cube = None, profile = 'default', blocksize = 1024):
+	""" Computes all changes of all years and features as array operations on the datacube and writes them as GeoTiffs
+	with the same filenames as the single-raster calculations in mainscript.py.
+	The cube is built and processed block by block (blocksize x blocksize pixels of all years and features),
+	so memory is bounded by the block size and not by the extent of the rasters.
+
+	:param rasters: dictionary {year: {feature: path+filename of raster}}, including 'POPDENS_100m' for calc_change2
+	:param pairs: list of year pairs (year2, year1), e.g. [('11', '06'), ('16', '11'), ('16', '06')]
+	:param outpath: output path for change rasters
+	:param features: features for which changes are calculated
+	:param pix: pixel size as string for filenames
+	:param calc_change: write feature changes rasterchange_20<year2>-20<year1>_<feature>_<pix>m.tif
+	:param calc_change2: write population rasters raster_pop_<pix>m_<feature>.tif of each year and 
+		relative population changes rasterchange_pop_20<year2>-20<year1>_<feature>_<pix>m.tif
+	:param fname_cube: path+filename for saving the cube as .zarr or .nc (optional, the entire cube is then read into memory)
+	:param profile: output file profile, name in OUTPUT_PROFILES or dictionary (see lib/rasterize.py output_profile)
+	:param blocksize: size of square blocks in pixels that are processed at once
+
+	RETURN
+	list of written files
+	"""
+	years = list(rasters)
+	with rasterio.open(rasters[years[0]][list(rasters[years[0]])[0]]) as src:
+		transform, crs, shape = src.transform, src.crs, src.shape
+	if fname_cube is not None:
+		print('Saving datacube to ' + fname_cube + ' ...')
+		with profiling.stage('save_datacube'):
+			read_datacube(rasters).save(fname_cube)
+	if not (calc_change or calc_change2):
+		return []
+	print('Computing changes from datacube of ' + str(len(rasters)) + ' years ...')
+	prof = output_profile(profile)
+	windows = list(_windows(shape[0], shape[1], blocksize))
+	scales = None
+	if np.issubdtype(np.dtype(prof['dtype']), np.integer):
+		# scale factors of integer outputs from data range of all blocks (first pass) or from profile
+		with profiling.stage('datacube_range'):
+			outputs = {}
+			for window in windows:
+				for outfile, data in _datacube_outputs(read_datacube(rasters, window = window), rasters, pairs, outpath, features, pix, 
+					calc_change = calc_change, calc_change2 = calc_change2).items():
+					maxabs = np.nanmax(np.abs(data)) if np.isfinite(data).any() else 0.
+					outputs[outfile] = max(outputs.get(outfile, 0.), maxabs)
+			scales = scales_from_range(list(outputs.values()), prof) if prof['scale'] is None else [prof['scale']] * len(outputs)
+	writer = None
+	with profiling.stage('datacube_changes'):
+		try:
+			for window in windows:
+				outputs = _datacube_outputs(read_datacube(rasters, window = window), rasters, pairs, outpath, features, pix, 
+					calc_change = calc_change, calc_change2 = calc_change2)
+				if writer is None:
+					writer = BlockWriter(list(outputs), transform, crs, shape, profile = prof, scales = scales)
+				for i, data in enumerate(outputs.values()):
+					writer.write(i, data, window)
+			writer.close()
+		except BaseException:
+			if writer is not None:
+				writer.abort()
+			raise
+	print('Datacube changes written to ' + outpath)
+	return writer.outfiles
@@ -0,0 +1,286 @@
+# Task graph for running processing stages in parallel according to their dependencies
+"""
+Author: Sebastian Haan
+Affiliation: Sydney Information Hub, The University of Sydney
+
+Comments:
+Tasks are functions with arguments and a list of tasks they depend on. All tasks whose dependencies are finished
+are run in parallel on a process pool, so total run time is close to the longest chain of dependent tasks (critical path).
+Results of finished tasks can be passed as argument to other tasks with TaskGraph.result(), e.g.:
+
+graph = TaskGraph()
+graph.add('combine06', combine_geodata, poly06, data06, features, outfile = fname06)
+graph.add('raster06', poly2raster, fname06, outpath06, graph.result('combine06', 1))
+graph.run(workers = 4)
+
+With a build manifest (TaskGraph(manifest = 'build_manifest.json')) tasks with declared inputs and outputs are only run
+if their fingerprint (function, arguments and content hash of input files) changed since the last successful run
+or if their outputs were changed or removed. The manifest is updated after each finished task, so an interrupted run
+continues with the unfinished tasks.
+
+Each task runs as profiling stage with the task name (see lib/profiling.py), stages recorded in worker processes
+are merged into the run report of the main process.
+"""
+
+import os
+import glob
+import json
+import hashlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from . import profiling
+
+
+class TaskResult:
+	""" Placeholder for the result of a task (or item of result if task returns tuple), resolved when task is finished
+	"""
+	def __init__(self, name, item = None):
+		self.name = name
+		self.item = item
+
+	def resolve(self, results):
+		result = results[self.name]
+		return result if self.item is None else result[self.item]
+
+
+class BuildCache:
+	""" Manifest of fingerprints and output file hashes of finished tasks, saved as json file
+
+	:param fname: path + filename of manifest
+	"""
+	def __init__(self, fname):
+		self.fname = fname
+		self.manifest = {'tasks': {}, 'files': {}}
+		if os.path.exists(fname):
+			with open(fname) as f:
+				self.manifest = json.load(f)
+
+	def file_hash(self, fname):
+		""" Content hash (sha1) of file, only recalculated if file size or modification time changed
+		"""
+		stat = os.stat(fname)
+		entry = self.manifest['files'].get(fname)
+		if (entry is not None) and (entry['size'] == stat.st_size) and (entry['mtime'] == stat.st_mtime_ns):
+			return entry['sha1']
+		sha = hashlib.sha1()
+		with open(fname, 'rb') as f:
+			for chunk in iter(lambda: f.read(2**20), b''):
+				sha.update(chunk)
+		self.manifest['files'][fname] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': sha.hexdigest()}
+		return sha.hexdigest()
+
+	def fingerprint(self, func, args, kwargs, inputs, outputs = []):
+		""" Fingerprint of task from function name, arguments and content of input files (missing inputs are marked as such).
+		Files matching the task's own outputs are not counted as inputs.
+		"""
+		own = set(_expand(outputs))
+		files = {fname: self.file_hash(fname) if os.path.exists(fname) else 'missing' for fname in _expand(inputs) if fname not in own}
+		key = [func.__module__ + '.' + func.__qualname__, repr(args), repr(sorted(kwargs.items())), sorted(files.items())]
+		return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+	def is_current(self, name, fingerprint):
+		""" True if task finished before with same fingerprint and all its output files exist and are unchanged
+		"""
+		entry = self.manifest['tasks'].get(name)
+		if (entry is None) or (entry['fingerprint'] != fingerprint):
+			return False
+		for pattern in entry['patterns']:
+			if len(_expand([pattern])) == 0:
+				return False
+		for fname, sha in entry['outputs'].items():
+			if (not os.path.exists(fname)) or (self.file_hash(fname) != sha):
+				return False
+		return True
+
+	def result(self, name):
+		return self.manifest['tasks'][name]['result']
+
+	def record(self, name, fingerprint, outputs, result):
+		""" Records finished task with hashes of its outputs and saves manifest
+		"""
+		try:
+			json.dumps(result)
+		except (TypeError, ValueError):
+			# Task results that can't be saved in manifest are not cached, task is always run
+			print('Result of task ' + name + ' not saved in build manifest')
+			self.manifest['tasks'].pop(name, None)
+			return
+		# Missing outputs are recorded as well (without hash), so the task is run again in the next run
+		files = {}
+		for fname in _expand(outputs):
+			if os.path.exists(fname):
+				files[fname] = self.file_hash(fname)
+			else:
+				print('Warning: output ' + fname + ' of task ' + name + ' not found')
+				files[fname] = None
+		self.manifest['tasks'][name] = {'fingerprint': fingerprint, 'patterns': list(outputs), 'outputs': files, 'result': result}
+		self.save()
+
+	def save(self):
+		# Write to temporary file first so that an interrupted run never leaves a broken manifest
+		path = os.path.dirname(self.fname)
+		if path and not os.path.exists(path):
+			os.makedirs(path, exist_ok = True)
+		with open(self.fname + '.tmp', 'w') as f:
+			json.dump(self.manifest, f, indent = 1)
+		os.replace(self.fname + '.tmp', self.fname)
+
+
+def _expand(patterns):
+	""" Expands filenames with wildcards (e.g. 'path/*.tif') to sorted list of existing files, other filenames are kept
+	"""
+	result = []
+	for pattern in patterns:
+		if glob.has_magic(pattern):
+			result.extend(sorted(glob.glob(pattern)))
+		else:
+			result.append(pattern)
+	return result
+
+
+class TaskGraph:
+	""" Directed acyclic graph of tasks that are run on a process pool as soon as all their dependencies are finished
+
+	:param manifest: path + filename of build manifest (optional), enables skipping of unchanged tasks (see BuildCache)
+	"""
+	def __init__(self, manifest = None):
+		self.tasks = {}
+		self.cache = BuildCache(manifest) if manifest is not None else None
+
+	def add(self, name, func, *args, deps = None, inputs = None, outputs = None, **kwargs):
+		""" Adds task to graph. Tasks of TaskResult arguments are added as dependencies automatically.
+
+		:param name: unique name of task
+		:param func: function to run (must be importable by worker processes, e.g. defined at module level)
+		:param args: positional arguments of func
+		:param deps: list of task names that need to be finished before this task starts
+		:param inputs: list of input files of task (wildcards allowed), used for fingerprint if build manifest is enabled
+		:param outputs: list of output files of task (wildcards allowed); only tasks with outputs are skipped if unchanged
+		:param kwargs: keyword arguments of func
+		"""
+		if name in self.tasks:
+			raise ValueError('Task ' + name + ' already in task graph')
+		deps = list(deps) if deps is not None else []
+		for arg in list(args) + list(kwargs.values()):
+			if isinstance(arg, TaskResult) and arg.name not in deps:
+				deps.append(arg.name)
+		self.tasks[name] = {'func': func, 'args': args, 'kwargs': kwargs, 'deps': deps, 
+			'inputs': list(inputs) if inputs is not None else [], 'outputs': list(outputs) if outputs is not None else []}
+		return name
+
+	def result(self, name, item = None):
+		""" Returns placeholder for result of task name (or item of result), to be used as argument of other tasks
+		"""
+		return TaskResult(name, item)
+
+	def order(self):
+		""" Returns task names in topological order (each task after all its dependencies)
+		"""
+		for name, task in self.tasks.items():
+			for dep in task['deps']:
+				if dep not in self.tasks:
+					raise ValueError('Task ' + name + ' depends on unknown task ' + dep)
+		order, state = [], {}
+
+		def _visit(name, path):
+			if state.get(name) == 'done':
+				return
+			if state.get(name) == 'visiting':
+				raise ValueError('Cyclic dependency in task graph: ' + ' -> '.join(path + [name]))
+			state[name] = 'visiting'
+			for dep in self.tasks[name]['deps']:
+				_visit(dep, path + [name])
+			state[name] = 'done'
+			order.append(name)
+
+		for name in self.tasks:
+			_visit(name, [])
+		return order
+
+	def _call_args(self, name, results):
+		task = self.tasks[name]
+		args = [arg.resolve(results) if isinstance(arg, TaskResult) else arg for arg in task['args']]
+		kwargs = {key: val.resolve(results) if isinstance(val, TaskResult) else val for key, val in task['kwargs'].items()}
+		return args, kwargs
+
+	def _fingerprint(self, name, args, kwargs):
+		""" Fingerprint of task if build manifest is enabled and task has outputs, else None
+		"""
+		task = self.tasks[name]
+		if (self.cache is None) or (len(task['outputs']) == 0):
+			return None
+		return self.cache.fingerprint(task['func'], args, kwargs, task['inputs'], task['outputs'])
+
+	def _finished(self, name, fingerprint, result):
+		if fingerprint is not None:
+			self.cache.record(name, fingerprint, self.tasks[name]['outputs'], result)
+
+	def run(self, workers = 1):
+		""" Runs all tasks, tasks that depend on failed tasks are skipped.
+
+		:param workers: number of worker processes, with workers = 1 all tasks run in order in the current process
+
+		RETURN
+		Dictionary with results of finished tasks
+		"""
+		order = self.order()
+		results, failed, skipped = {}, [], []
+		if workers <= 1:
+			for name in order:
+				if any(dep in failed or dep in skipped for dep in self.tasks[name]['deps']):
+					skipped.append(name)
+					continue
+				args, kwargs = self._call_args(name, results)
+				fingerprint = self._fingerprint(name, args, kwargs)
+				if (fingerprint is not None) and self.cache.is_current(name, fingerprint):
+					print('Skipping task ' + name + ' (up to date)')
+					results[name] = self.cache.result(name)
+					continue
+				print('Running task ' + name + ' ...')
+				try:
+					with profiling.stage(name):
+						results[name] = self.tasks[name]['func'](*args, **kwargs)
+					self._finished(name, fingerprint, results[name])
+				except Exception:
+					print('Task ' + name + ' failed:\n' + traceback.format_exc())
+					failed.append(name)
+		else:
+			waiting = list(order)
+			running, fingerprints = {}, {}
+			with ProcessPoolExecutor(max_workers = workers) as pool:
+				while waiting or running:
+					# Submit all tasks whose dependencies are finished
+					for name in list(waiting):
+						deps = self.tasks[name]['deps']
+						if any(dep in failed or dep in skipped for dep in deps):
+							skipped.append(name)
+							waiting.remove(name)
+						elif all(dep in results for dep in deps):
+							waiting.remove(name)
+							args, kwargs = self._call_args(name, results)
+							fingerprints[name] = self._fingerprint(name, args, kwargs)
+							if (fingerprints[name] is not None) and self.cache.is_current(name, fingerprints[name]):
+								print('Skipping task ' + name + ' (up to date)')
+								results[name] = self.cache.result(name)
+								continue
+							print('Running task ' + name + ' ...')
+							running[pool.submit(profiling.collect, profiling.context(name), self.tasks[name]['func'], *args, **kwargs)] = name
+					if not running:
+						continue
+					done, _ = wait(running, return_when = FIRST_COMPLETED)
+					for future in done:
+						name = running.pop(future)
+						try:
+							results[name], records = future.result()
+							profiling.merge(records)
+							self._finished(name, fingerprints[name], results[name])
+							print('Task ' + name + ' finished')
+						except Exception:
+							print('Task ' + name + ' failed:\n' + traceback.format_exc())
+							failed.append(name)
+		if failed:
+			print('WARNING: failed tasks: ' + ', '.join(failed))
+		if skipped:
+			print('WARNING: skipped tasks because of failed dependencies: ' + ', '.join(skipped))
+		self.failed, self.skipped = failed, skipped
+		return results
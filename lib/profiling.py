@@ -0,0 +1,250 @@
+# Per-stage instrumentation of processing runs
+"""
+Author: Sebastian Haan
+Affiliation: Sydney Information Hub, The University of Sydney
+
+Comments:
+Stages are timed with the context manager stage(), stages can be nested (e.g. raster06/poly2raster/LOW/gdal_rasterize).
+For each stage the wall time, CPU time (including finished subprocesses), peak memory (RSS), bytes read and written
+and wall time of subprocesses (e.g. gdal command line tools, run with call()) are recorded.
+Recording is disabled until configure() is called, so stage() has no overhead in library use.
+Stages run in worker processes (e.g. tasks of TaskGraph) are recorded with collect() and merged into the report of the main process.
+A cProfile of named stages can be saved as <name>.prof (view e.g. with python -m pstats or snakeviz).
+
+Example:
+configure(profile_stages = ['raster06'], outpath = '../Results/Profiles/')
+with stage('combine06'):
+	combine_geodata(...)
+write_report('../Results/run_report.json')
+"""
+
+import os
+import sys
+import time
+import json
+import cProfile
+import resource
+import subprocess
+from contextlib import contextmanager
+
+_CONFIG = {'enabled': False, 'profile_stages': [], 'outpath': '.'}
+# stages of current process that are currently running (innermost last) and finished stage records
+_STACK = []
+_RECORDS = []
+_PROFILING = []
+
+
+def configure(enabled = True, profile_stages = None, outpath = '.'):
+	""" Enables recording of stages
+
+	:param enabled: record stages (False: stage() and call() only run the code)
+	:param profile_stages: list of stage names (e.g. 'raster06' or 'raster06/poly2raster') for which a cProfile is saved
+	:param outpath: output path for cProfile files
+	"""
+	_CONFIG.update({'enabled': enabled, 'profile_stages': list(profile_stages) if profile_stages is not None else [], 'outpath': outpath})
+
+
+def context(name = None):
+	""" Settings and current stage path of this process, to be passed to collect() in worker processes
+
+	:param name: name of stage that collect() runs in worker (optional)
+	"""
+	return dict(_CONFIG, path = [entry['name'] for entry in _STACK], name = name)
+
+
+def _memory():
+	""" Peak RSS of process in MB since last reset and bytes read/written by process (including finished subprocesses),
+	bytes are None where not available on this system
+	"""
+	peak = None
+	try:
+		with open('/proc/self/status') as f:
+			for line in f:
+				if line.startswith('VmHWM:'):
+					peak = int(line.split()[1]) / 1024.
+	except OSError:
+		pass
+	if peak is None:
+		# lifetime peak, ru_maxrss in kB on Linux, in bytes on macOS
+		scale = 1024. ** 2 if sys.platform == 'darwin' else 1024.
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+	io = {}
+	try:
+		with open('/proc/self/io') as f:
+			io = dict((key, int(val)) for key, val in (line.split(':') for line in f if ':' in line))
+	except OSError:
+		pass
+	return peak, io.get('rchar'), io.get('wchar')
+
+
+def _reset_peak():
+	""" Resets peak RSS of process (Linux only), so the peak of each stage is measured separately
+	"""
+	try:
+		with open('/proc/self/clear_refs', 'w') as f:
+			f.write('5')
+	except OSError:
+		pass
+
+
+def _cpu_time():
+	self_usage = resource.getrusage(resource.RUSAGE_SELF)
+	child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+	return self_usage.ru_utime + self_usage.ru_stime + child_usage.ru_utime + child_usage.ru_stime, child_usage.ru_maxrss
+
+
+@contextmanager
+def stage(name, **info):
+	""" Records wall time, CPU time, peak RSS, bytes read/written and subprocess time of code block, e.g.
+	with stage('poly2raster', pixsize = 100):
+		...
+	or of each call of a function when used as decorator @stage('rasterdiff')
+
+	:param name: name of stage, full name of nested stages is path of all running stages (e.g. raster06/poly2raster/LOW)
+	:param info: additional values saved in record of stage
+	"""
+	if not _CONFIG['enabled']:
+		yield
+		return
+	# peak of enclosing stage so far, as peak is reset for this stage
+	peak, read_start, write_start = _memory()
+	if _STACK:
+		_STACK[-1]['peak'] = max(_STACK[-1]['peak'], peak)
+	_reset_peak()
+	entry = {'name': name, 'peak': 0., 'subprocess': 0.}
+	_STACK.append(entry)
+	path = '/'.join(e['name'] for e in _STACK)
+	profiler = None
+	if ((name in _CONFIG['profile_stages']) or (path in _CONFIG['profile_stages'])) and not _PROFILING:
+		profiler = cProfile.Profile()
+		_PROFILING.append(profiler)
+		profiler.enable()
+	cpu_start, child_rss_start = _cpu_time()
+	start = time.perf_counter()
+	error = ''
+	try:
+		yield
+	except BaseException as e:
+		error = type(e).__name__ + ': ' + str(e)
+		raise
+	finally:
+		wall = time.perf_counter() - start
+		cpu_end, child_rss_end = _cpu_time()
+		if profiler is not None:
+			profiler.disable()
+			_PROFILING.pop()
+		peak, read_end, write_end = _memory()
+		_STACK.pop()
+		peak = max(entry['peak'], peak)
+		if _STACK:
+			_STACK[-1]['peak'] = max(_STACK[-1]['peak'], peak)
+		scale = 1024. ** 2 if sys.platform == 'darwin' else 1024.
+		record = {'stage': path, 'name': name, 'pid': os.getpid(), 'start': time.time() - wall, 'wall_s': round(wall, 4),
+			'cpu_s': round(cpu_end - cpu_start, 4), 'peak_rss_mb': round(peak, 1),
+			# children peak RSS is only known if it increased during stage
+			'subprocess_peak_rss_mb': round(child_rss_end / scale, 1) if child_rss_end > child_rss_start else None,
+			'read_mb': round((read_end - read_start) / 1024. ** 2, 3) if read_start is not None else None,
+			'write_mb': round((write_end - write_start) / 1024. ** 2, 3) if write_start is not None else None,
+			'subprocess_s': round(entry['subprocess'], 4), 'error': error}
+		if profiler is not None:
+			record['cprofile'] = _save_profile(profiler, path)
+		record.update(info)
+		_RECORDS.append(record)
+
+
+def _save_profile(profiler, path):
+	if not os.path.exists(_CONFIG['outpath']):
+		os.makedirs(_CONFIG['outpath'], exist_ok = True)
+	fname = os.path.join(_CONFIG['outpath'], 'profile_' + path.replace('/', '_') + '.prof')
+	profiler.dump_stats(fname)
+	print('cProfile of stage ' + path + ' saved to ' + fname)
+	return fname
+
+
+def call(cmd, name = None):
+	""" Runs shell command (as subprocess.call(cmd, shell = True)) as stage, wall time is added to subprocess time of all running stages
+
+	:param cmd: command line
+	:param name: name of stage (Default: program name, e.g. gdal_rasterize)
+
+	RETURN
+	return code of command
+	"""
+	if not _CONFIG['enabled']:
+		return subprocess.call(cmd, shell = True)
+	name = name if name is not None else os.path.basename(cmd.split()[0])
+	start = time.perf_counter()
+	with stage(name):
+		returncode = subprocess.call(cmd, shell = True)
+	wall = time.perf_counter() - start
+	for entry in _STACK:
+		entry['subprocess'] += wall
+	# record of this call was added last
+	_RECORDS[-1].update({'subprocess_s': round(wall, 4), 'returncode': returncode})
+	return returncode
+
+
+def collect(ctx, func, *args, **kwargs):
+	""" Runs func in worker process with settings and stage path ctx of parent process (see context()),
+	as stage ctx['name'] if given.
+
+	RETURN
+	result of func, list of stage records of worker (to be added with merge())
+	"""
+	_CONFIG.update({key: ctx[key] for key in ['enabled', 'profile_stages', 'outpath']})
+	# stages inherited from parent (fork) are replaced by stage path of parent
+	del _RECORDS[:]
+	_STACK[:] = [{'name': name, 'peak': 0., 'subprocess': 0.} for name in ctx['path']]
+	try:
+		if ctx['name'] is not None:
+			with stage(ctx['name']):
+				result = func(*args, **kwargs)
+		else:
+			result = func(*args, **kwargs)
+	finally:
+		records = list(_RECORDS)
+		del _RECORDS[:]
+		del _STACK[:]
+	return result, records
+
+
+def merge(records):
+	""" Adds stage records of worker process (see collect())
+	"""
+	_RECORDS.extend(records)
+
+
+def records():
+	""" Stage records of this process in order of finishing
+	"""
+	return list(_RECORDS)
+
+
+def reset():
+	del _RECORDS[:]
+
+
+def write_report(fname, info = None):
+	""" Writes run report as JSON file (fname ends with .json, with run info and list of stages)
+	and table of stages as csv file with same name (or only csv if fname ends with .csv)
+
+	:param fname: path + filename of report
+	:param info: dictionary with additional information about run (e.g. settings)
+	"""
+	import pandas as pd
+	path = os.path.dirname(fname)
+	if path and not os.path.exists(path):
+		os.makedirs(path, exist_ok = True)
+	stages = sorted(_RECORDS, key = lambda record: record['start'])
+	table = pd.DataFrame(stages)
+	if len(table) > 0:
+		table['start'] = (table['start'] - table['start'].min()).round(3)
+	base, ext = os.path.splitext(fname)
+	if ext == '.json':
+		report = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'host': os.uname().nodename, 'python': sys.version.split()[0],
+			'info': info if info is not None else {}, 'stages': json.loads(table.to_json(orient = 'records'))}
+		with open(fname, 'w') as f:
+			json.dump(report, f, indent = 1, default = str)
+	table.to_csv(base + '.csv', index = False)
+	print('Run report saved to ' + fname)
+	return table
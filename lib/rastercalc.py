@@ -0,0 +1,276 @@
+# Raster algebra with lazy, fused and block-wise evaluation of raster expressions
+"""
+Author: Sebastian Haan
+Affiliation: Sydney Information Hub, The University of Sydney
+
+Comments:
+In-process alternative to gdal_calc.py. Expressions are only evaluated when written: all expressions written
+together (including nested expressions) are computed in one pass over raster blocks, each input raster block is read only once,
+and no intermediate rasters are written to disk.
+
+Example (relative population change, see calc_change2 in mainscript.py):
+pop06 = RasterExpr(EXPR_PROD, A = 'raster_100m_LOW_06.tif', B = 'raster_100m_POPDENS_100m_06.tif')
+pop16 = RasterExpr(EXPR_PROD, A = 'raster_100m_LOW_16.tif', B = 'raster_100m_POPDENS_100m_16.tif')
+RasterExpr(EXPR_RELDIFF, A = pop16, B = pop06).write('rasterchange_pop_2016-2006_LOW_100m.tif')
+"""
+
+import os
+import numpy as np
+import rasterio
+from rasterio import shutil as rshutil
+from rasterio.windows import Window
+from .rasterize import output_profile, _creation_options, _output_nodata, _encode_band, _build_overviews
+from . import profiling
+
+# Expressions as used by rasterdiff and rasterprod (no-data masking is applied automatically)
+EXPR_DIFF = 'A - B'
+EXPR_RELDIFF = 'divide(A - B, B, out = full_like(A, nan), where = B > 0)'
+EXPR_PROD = '(A * B) * (B > 0) * (A >= 0)'
+
+# Namespace for expressions, all numpy functions are available (as in gdal_calc.py)
+_NUMPY_NAMESPACE = {name: getattr(np, name) for name in dir(np) if not name.startswith('_')}
+
+
+class RasterExpr:
+	""" Lazy raster expression, e.g. RasterExpr('A - B', A = 'raster1.tif', B = 'raster2.tif')
+	Inputs are raster filenames (band 1) or other RasterExpr objects, all on the same grid.
+	Pixels that are no-data in any input (or not finite in the result) are no-data in the output,
+	inside the expression no-data pixels have the value nodataval.
+
+	:param expr: numpy expression as string with input names as variables
+	:param nodataval: value for no-data entries (Default: -9999)
+	:param inputs: input names and rasters, e.g. A = 'raster1.tif', B = RasterExpr(...)
+	"""
+	def __init__(self, expr, nodataval = -9999, **inputs):
+		if len(inputs) == 0:
+			raise ValueError('RasterExpr needs at least one input raster')
+		self.expr = expr
+		self.code = compile(expr, '<RasterExpr>', 'eval')
+		self.nodataval = nodataval
+		self.inputs = inputs
+
+	def __getstate__(self):
+		# compiled code can't be pickled (e.g. for worker processes), compile again after unpickling
+		state = dict(self.__dict__)
+		del state['code']
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.code = compile(self.expr, '<RasterExpr>', 'eval')
+
+	def __repr__(self):
+		return 'RasterExpr(' + repr(self.expr) + ', ' + ', '.join(name + ' = ' + repr(inp) for name, inp in self.inputs.items()) + ')'
+
+	def files(self):
+		""" Returns set of all input raster files of expression graph
+		"""
+		result = set()
+		for inp in self.inputs.values():
+			if isinstance(inp, RasterExpr):
+				result |= inp.files()
+			else:
+				result.add(inp)
+		return result
+
+	def _evaluate(self, window, sources, cache):
+		""" Evaluates expression for one window, results of input reads and sub-expressions are shared via cache
+
+		RETURN
+		result values, valid pixels (boolean)
+		"""
+		key = id(self)
+		if key in cache:
+			return cache[key]
+		namespace = dict(_NUMPY_NAMESPACE)
+		valid = None
+		for name, inp in self.inputs.items():
+			if isinstance(inp, RasterExpr):
+				values, valid_inp = inp._evaluate(window, sources, cache)
+			else:
+				values, valid_inp = _read_block(inp, window, sources, cache)
+			namespace[name] = np.where(valid_inp, values, self.nodataval)
+			valid = valid_inp if valid is None else valid & valid_inp
+		with np.errstate(divide = 'ignore', invalid = 'ignore'):
+			result = np.broadcast_to(np.asarray(eval(self.code, namespace), dtype = float), valid.shape)
+		cache[key] = (result, valid & np.isfinite(result))
+		return cache[key]
+
+	def compute(self):
+		""" Evaluates expression for the entire grid and returns array with NaN for no-data
+		"""
+		sources = _open_sources([self])
+		try:
+			src = next(iter(sources.values()))
+			result, valid = self._evaluate(Window(0, 0, src.width, src.height), sources, {})
+		finally:
+			for src in sources.values():
+				src.close()
+		return np.where(valid, result, np.nan)
+
+	def write(self, outfile, profile = 'default', blocksize = 1024):
+		""" Evaluates expression block-wise and writes result as GeoTiff (see write_rasters)
+		"""
+		write_rasters([(self, outfile)], profile = profile, blocksize = blocksize)
+
+
+def _open_sources(exprs):
+	""" Opens all input rasters of expressions and checks that they share the same grid
+	"""
+	fnames = sorted(set().union(*[expr.files() for expr in exprs]))
+	sources = {fname: rasterio.open(fname) for fname in fnames}
+	ref = sources[fnames[0]]
+	for fname, src in sources.items():
+		if (src.shape != ref.shape) or (not src.transform.almost_equals(ref.transform)):
+			for src2 in sources.values():
+				src2.close()
+			raise ValueError('RasterExpr: raster ' + fname + ' is not on the same grid as ' + fnames[0])
+	return sources
+
+
+def _read_block(fname, window, sources, cache):
+	""" Reads window of band 1 as float with scale/offset applied, each file is read only once per window
+	"""
+	key = ('file', fname)
+	if key not in cache:
+		src = sources[fname]
+		data = src.read(1, window = window, masked = True)
+		values = data.data.astype(float) * src.scales[0] + src.offsets[0]
+		cache[key] = (values, ~np.ma.getmaskarray(data))
+	return cache[key]
+
+
+def _windows(height, width, blocksize):
+	""" Square windows covering the grid, row by row
+	"""
+	for row in range(0, height, blocksize):
+		for col in range(0, width, blocksize):
+			yield Window(col, row, min(blocksize, width - col), min(blocksize, height - row))
+
+
+class BlockWriter:
+	""" Single-band GeoTiffs on a common grid that are written block by block, with layout of output profile.
+	With overviews, blocks are written to temporary files that are copied with Cloud-Optimized layout in close();
+	after a failure abort() removes the temporary files.
+
+	:param outfiles: list of output path+filenames
+	:param transform: affine transform of grid
+	:param crs: coordinate reference system of grid
+	:param shape: shape of grid (height, width)
+	:param profile: output file profile, name in OUTPUT_PROFILES or dictionary (see lib/rasterize.py output_profile)
+	:param scales: scale factors of outputs for integer profiles (Default: 1)
+	:param nodataval: value for no-data pixels in float outputs (Default: -9999)
+	"""
+	def __init__(self, outfiles, transform, crs, shape, profile = 'default', scales = None, nodataval = -9999):
+		self.prof = output_profile(profile)
+		self.dtype = np.dtype(self.prof['dtype'])
+		self.outfiles = list(outfiles)
+		self.scales = list(scales) if scales is not None else [1.] * len(self.outfiles)
+		self.nodata = _output_nodata(self.dtype, nodataval)
+		meta = {'driver': 'GTiff', 'height': shape[0], 'width': shape[1], 'count': 1, 'dtype': self.dtype.name, 'crs': crs,
+			'transform': transform, 'nodata': self.nodata}
+		self.options = _creation_options(self.prof)
+		if self.prof['overviews']:
+			# Write tiled temporary file first, Cloud-Optimized layout is created when overviews are ready
+			self.options.update({'tiled': True, 'blockxsize': self.prof['blocksize'], 'blockysize': self.prof['blocksize']})
+			self.fnames = [outfile + '.' + str(os.getpid()) + '.tmp.tif' for outfile in self.outfiles]
+		else:
+			self.fnames = list(self.outfiles)
+		self.dsts = []
+		try:
+			for fname in self.fnames:
+				self.dsts.append(rasterio.open(fname, 'w', **meta, **self.options))
+		except BaseException:
+			self.abort()
+			raise
+
+	def write(self, i, data, window):
+		""" Writes float array data (NaN for no-data) of output i to window
+		"""
+		self.dsts[i].write(_encode_band(data, self.dtype, self.scales[i], self.nodata), 1, window = window)
+
+	def close(self):
+		""" Sets scale factors, builds overviews and copies temporary files to outputs
+		"""
+		try:
+			for i, dst in enumerate(self.dsts):
+				if self.scales[i] != 1.:
+					dst.scales = [self.scales[i]]
+				if self.prof['overviews']:
+					_build_overviews(dst, self.prof['blocksize'])
+		finally:
+			for dst in self.dsts:
+				dst.close()
+		if self.prof['overviews']:
+			for fname, outfile in zip(self.fnames, self.outfiles):
+				rshutil.copy(fname, outfile, driver = 'GTiff', copy_src_overviews = True, **self.options)
+				os.remove(fname)
+
+	def abort(self):
+		""" Closes files after a failure, temporary files are removed so they are not picked up as rasters (e.g. by *.tif patterns)
+		"""
+		for dst in self.dsts:
+			if not dst.closed:
+				dst.close()
+		if self.prof['overviews']:
+			for fname in self.fnames:
+				if os.path.exists(fname):
+					os.remove(fname)
+
+
+@profiling.stage('write_rasters')
+def write_rasters(targets, profile = 'default', blocksize = 1024):
+	""" Evaluates several raster expressions together in one block-wise pass and writes each result as GeoTiff.
+	Each input raster block is read once for all expressions, so memory is bounded by the block size.
+
+	:param targets: list of tuples (RasterExpr, output path+filename)
+	:param profile: output file profile, name in OUTPUT_PROFILES or dictionary (see lib/rasterize.py output_profile)
+	:param blocksize: size of square blocks in pixels that are evaluated at once
+	"""
+	prof = output_profile(profile)
+	exprs = [expr for expr, outfile in targets]
+	sources = _open_sources(exprs)
+	ref = next(iter(sources.values()))
+	height, width = ref.shape
+	try:
+		scales = [1.] * len(targets)
+		if np.issubdtype(np.dtype(prof['dtype']), np.integer):
+			scales = _integer_scales(exprs, sources, prof, blocksize)
+		writer = BlockWriter([outfile for expr, outfile in targets], ref.transform, ref.crs, ref.shape, profile = prof, 
+			scales = scales, nodataval = exprs[0].nodataval)
+		try:
+			for window in _windows(height, width, blocksize):
+				cache = {}
+				for i, expr in enumerate(exprs):
+					result, valid = expr._evaluate(window, sources, cache)
+					writer.write(i, np.where(valid, result, np.nan), window)
+			writer.close()
+		except BaseException:
+			writer.abort()
+			raise
+	finally:
+		for src in sources.values():
+			src.close()
+
+
+def _integer_scales(exprs, sources, prof, blocksize):
+	""" Scale factors for integer output profiles; if not set in profile, a first pass determines the data range
+	"""
+	if prof['scale'] is not None:
+		return [prof['scale']] * len(exprs)
+	maxabs = np.zeros(len(exprs))
+	height, width = next(iter(sources.values())).shape
+	for window in _windows(height, width, blocksize):
+		cache = {}
+		for i, expr in enumerate(exprs):
+			result, valid = expr._evaluate(window, sources, cache)
+			if valid.any():
+				maxabs[i] = max(maxabs[i], np.abs(result[valid]).max())
+	return scales_from_range(maxabs, prof)
+
+
+def scales_from_range(maxabs, prof):
+	""" Scale factors for integer output profile from maximum absolute values of outputs
+	"""
+	intmax = np.iinfo(np.dtype(prof['dtype'])).max - 1
+	return [m / intmax if m > 0 else 1. for m in maxabs]
@@ -1,9 +1,27 @@
 # Rasterisation Script
 import os
+import shutil
+import hashlib
+import tempfile
 import numpy as np
 import subprocess
 import geopandas as gpd
 import pandas as pd
+from scipy import sparse
+import shapely
+import rasterio
+from rasterio import Affine
+from rasterio import features as rfeatures
+from rasterio import shutil as rshutil
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+from . import profiling
+try:
+	# pyogrio reads only requested columns and features within bbox (optionally via Arrow), fiona is used otherwise
+	import pyogrio
+except ImportError:
+	pyogrio = None
 
 """
 Author: Sebastian Haan
@@ -12,94 +30,792 @@ Affiliation: Sydney Information Hub, The University of Sydney
 Comments:
 For computational speed most functions in this script make use of the gdal libraries using system commands.
 There exist various python bindings for gdal (such as osgeo), but seem to be at the current state not as reliable or flexible enough.
+Alternatively poly2raster can run in-process with rasterio and numpy (engine = 'rasterio'), which reads the polygons 
+only once and rasterizes all features in a single pass without temporary files.
 """
 
-def poly2raster(infile, outpath, featurelist, polymask = None, pixsize = 100, nodataval = '-9999', interpol = 'average', crs = 'epsg:3577'):
+# Upsampling factor for the intermediate raster (area weighting by averaging over upsampled pixels)
+UPSAMPLE = 4
+
+# Output profiles for GeoTiff files (see write_raster), either select by name or pass dictionary to overwrite 'default' settings.
+# 'cog' profiles are tiled Cloud-Optimized GeoTiffs with internal overviews, 
+# 'int16' profiles store round(value / scale) with scale factor in file metadata (scale = None: determined from data range);
+# note that gdal_calc.py ignores the scale factor, so int16 files are meant as final outputs and not as input to gdal tools.
+OUTPUT_PROFILES = {
+	'default': {'dtype': 'float64', 'tiled': False, 'blocksize': 512, 'compress': None, 'predictor': None, 'overviews': False, 'scale': None},
+	'cog': {'dtype': 'float32', 'tiled': True, 'blocksize': 512, 'compress': 'deflate', 'predictor': 3, 'overviews': True, 'scale': None},
+	'cog_zstd': {'dtype': 'float32', 'tiled': True, 'blocksize': 512, 'compress': 'zstd', 'predictor': 3, 'overviews': True, 'scale': None},
+	'cog_int16': {'dtype': 'int16', 'tiled': True, 'blocksize': 512, 'compress': 'deflate', 'predictor': 2, 'overviews': True, 'scale': None},
+}
+
+def poly2raster(infile, outpath, featurelist, polymask = None, pixsize = 100, nodataval = '-9999', interpol = 'average', crs = 'epsg:3577', 
+	engine = 'gdal', multiband = False, cachedir = None, weighting = 'upsample', profile = 'default'):
 	""" Generates rasterfiles in GeoTiff format from polygon shapefile for each feature in featurelist.  
-	Rastergeneration is performed with gdal in two steps: 
+	Rastergeneration is performed in two steps: 
 	1) Upsampled raster generation at four times raster resolution
 	2) Downsampling and interpolation to final raster
+	With engine = 'gdal' each step runs as gdal command line call per feature; 
+	with engine = 'rasterio' the polygons are read once and all features are rasterized in-process in a single pass.
+	With a list of pixel sizes, the features are rasterized once at the smallest pixel size and rasters with larger pixel sizes 
+	(integer multiples of the smallest) are aggregated from these (see aggregation_factors).
 
 	INPUT
-	:param infile: Path and filename of input polygon file (in .shp or .gpkg format); need to inlude default column with 'geometry'
+	:param infile: Path and filename of input polygon file (in .shp, .gpkg or .parquet format); need to inlude default column with 'geometry'
+		or a GeoDataFrame, e.g. as returned by combine_geodata
 	:param outpath: Path name to output directory
 	:param featurelist: List of Features (columns) name of feature to rasterize, in string format ['feature1', 'feature2']
 	:param polymask: Path+name of mask shapefile (.shp or .gpkg format) that is used to clip raster according to shapefile geometry
-	:param pixsize: pixelsize in meters (same for x and y), default 100m x 100m
+	:param pixsize: pixelsize in meters (same for x and y), default 100m x 100m, or list of pixel sizes, e.g. [50, 100, 250, 1000]
 	:param nodataval: Value for No-data entries (Default: -9999)
 	:param interpol: Raster Interpolation option ('average' (recommended), 'near', 'bilinear', 'cubic', cubicspline) 
 	:param crs: Coordinate reference system (Default 'epsg:3577' - Australian Albers meters) 	
+	:param engine: 'gdal' (default, gdal command line tools) or 'rasterio' (in-process rasterization with rasterio and numpy)
+	:param multiband: if True, write all features as bands of one raster file 'raster_<pixsize>m_features.tif' 
+		instead of one file per feature (only for engine = 'rasterio')
+	:param cachedir: directory for caching the polygon index grid (engine = 'rasterio') and the mask grid (both engines), 
+		default None: no caching. The index grid is reused for any feature as long as polygons, mask, crs and pixsize are unchanged, 
+		the mask grid as long as mask, crs and pixsize are unchanged (e.g. for all census years).
+	:param weighting: area weighting for engine = 'rasterio': 'upsample' (default, average over upsampled raster as in gdal engine)
+		or 'exact' (exact fractional coverage of each pixel by each polygon as sparse weight matrix, mass conserving), 
+		'exact' always gives the area-weighted mean and can't be combined with interpol = 'sum'
+	:param profile: output file profile, name of profile in OUTPUT_PROFILES (e.g. 'default', 'cog', 'cog_int16') or dictionary 
+		with profile settings (see OUTPUT_PROFILES)
 	"""
 
 	### Check if output path exists, if not create path
 	if not os.path.exists(outpath):
 		os.makedirs(outpath)
 
+	if engine not in ['gdal', 'rasterio']:
+		raise ValueError("poly2raster: engine must be either 'gdal' or 'rasterio', got " + str(engine))
+	pixsize, factors = aggregation_factors(pixsize)
+	with profiling.stage('poly2raster', engine = engine, pixsize = pixsize):
+		if engine == 'rasterio':
+			_poly2raster_rasterio(infile, outpath, featurelist, polymask = polymask, pixsize = pixsize, 
+				nodataval = float(nodataval), interpol = interpol, crs = crs, multiband = multiband, cachedir = cachedir, 
+				weighting = weighting, profile = profile, factors = factors)
+			return
+
+		### All intermediate files are written to a unique temporary directory that is always removed at the end, 
+		# so that several runs (e.g. in parallel) can use the same outpath
+		tempdir = tempfile.mkdtemp(prefix = 'poly2raster_', dir = outpath)
+		try:
+			_poly2raster_gdal(infile, outpath, featurelist, tempdir, polymask = polymask, pixsize = pixsize, nodataval = nodataval, 
+				interpol = interpol, crs = crs, cachedir = cachedir, profile = profile)
+		finally:
+			shutil.rmtree(tempdir, ignore_errors = True)
+		### Larger pixel sizes aggregated from rasters at smallest pixel size
+		for factor in factors[1:]:
+			for feature in featurelist:
+				fname = outpath + 'raster_' + str(int(pixsize)) + 'm_' + feature + '.tif'
+				if os.path.exists(fname):
+					aggregate_raster(fname, outpath + 'raster_' + str(int(pixsize * factor)) + 'm_' + feature + '.tif', factor, 
+						interpol = interpol, nodataval = float(nodataval), profile = profile)
+	#print('FINISHED')
+	
+
+def _poly2raster_gdal(infile, outpath, featurelist, tempdir, polymask = None, pixsize = 100, nodataval = '-9999', interpol = 'average', 
+	crs = 'epsg:3577', cachedir = None, profile = 'default'):
+	""" Version of poly2raster with gdal command line tools (see poly2raster for parameters), intermediate files are written to tempdir
+	"""
 	### Reproject input polygon file to meter system
-	print("Reading in polygon file....")
-	poly = gpd.read_file(infile)
-	# Read coordinate reference system (crs) of source:
-	crs_current = poly.crs
-	crs_meter = {'init': crs}
-	if crs_current != crs_meter:
-		print('Converting input file to meters...')
-		poly = poly.to_crs({'init': crs})
-		poly = poly[featurelist + ['geometry']]
-		fname_poly = outpath + 'poly_temp.shp'
-		poly.to_file(fname_poly)
-		# Flag to clean and renove this temporary polygon file later again:
-		clean_polytemp = True
+	if isinstance(infile, gpd.GeoDataFrame):
+		poly = infile
+	else:
+		print("Reading in polygon file....")
+		poly = read_polygons(infile)
+	# gdal tools read GeoPackage, other inputs are written to temporary GeoPackage
+	if isinstance(infile, gpd.GeoDataFrame) or is_boundary_store(infile) or (poly.crs is None) or (not poly.crs.equals(crs)):
+		if (poly.crs is None) or (not poly.crs.equals(crs)):
+			print('Converting input file to meters...')
+			poly = poly.to_crs(crs)
+		# Temporary GeoPackage (no truncation of column names as in shapefiles)
+		fname_poly = os.path.join(tempdir, 'poly_temp.gpkg')
+		poly[featurelist + ['geometry']].to_file(fname_poly, driver = 'GPKG')
 	else:
 		fname_poly = infile
-		clean_polytemp = False
 
 	###Create raster image for each feature in featurelist
 	xres = yres = str(int(pixsize))
-	xres_up = yres_up = str(int(pixsize // 4))
+	xres_up = yres_up = str(pixsize / UPSAMPLE)
 	srcfile = fname_poly
 	nfeature = len(featurelist)
-	dstfile_temp = outpath + 'temp.tif'
-	dstfile_temp2 = outpath + 'temp2.tif'
+	dstfile_temp = os.path.join(tempdir, 'temp.tif')
+	str_extent = ''
+	if polymask is not None:
+		# Crop extent and mask grid at upsampled resolution are computed only once for all features
+		mask_geoms = read_mask(polymask, crs)
+		transform, shape = raster_grid(mask_geoms.total_bounds, pixsize)
+		xmin, ymax = transform.c, transform.f
+		str_extent = ' -te ' + ' '.join(str(x) for x in [xmin, ymax - shape[0] * pixsize, xmin + shape[1] * pixsize, ymax]) + ' '
+		transform_up = transform * Affine.scale(1. / UPSAMPLE)
+		shape_up = (shape[0] * UPSAMPLE, shape[1] * UPSAMPLE)
+		inside = rasterize_mask(mask_geoms, transform_up, shape_up, crs, cachedir = cachedir)
 
 	for i, feature in enumerate(featurelist):
-		tempfile = dstfile_temp
-		print('Rasterizing feature ' + feature + ' ...')
-		# Define raster output filename:
-		dstfile = outpath + 'raster_' + str(int(pixsize)) + 'm_' + feature + '.tif'
-		str_rasterize_options =  '-a ' + feature  + ' -a_nodata ' + nodataval + ' -tr ' + xres_up + ' ' + yres_up + ' -ot Float64 '
-		# Create upsampled raster file
-		cmd = subprocess.call('gdal_rasterize ' + str_rasterize_options + srcfile + ' ' + dstfile_temp, shell=True)
-		if cmd == 0:
+		with profiling.stage(feature):
+			print('Rasterizing feature ' + feature + ' ...')
+			# Define raster output filename:
+			dstfile = outpath + 'raster_' + str(int(pixsize)) + 'm_' + feature + '.tif'
+			str_rasterize_options =  '-a ' + feature  + ' -a_nodata ' + nodataval + str_extent + ' -tr ' + xres_up + ' ' + yres_up + ' -ot Float64 '
+			# Create upsampled raster file
+			cmd = profiling.call('gdal_rasterize ' + str_rasterize_options + srcfile + ' ' + dstfile_temp)
+			if cmd != 0:
+				print('Failed to create rasterfile with gdal_rasterize.')
+				continue
 			if polymask is not None:
-				# Crop raster to cutline and overwite temporary file with cropped file
-				print("Cropping of raster with polygon mask ...")
-				cmd_mask = subprocess.call('gdalwarp -srcnodata ' + nodataval + ' -dstnodata ' + nodataval + 
-					' -crop_to_cutline -cutline ' + polymask + ' ' + dstfile_temp + ' ' + dstfile_temp2, shell=True)
-				tempfile = dstfile_temp2
+				# Apply mask grid to upsampled raster
+				with rasterio.open(dstfile_temp, 'r+') as dst:
+					data = dst.read(1)
+					data[~inside] = float(nodataval)
+					dst.write(data, 1)
 			# if upsample sucessfull start with interpolation to final downsampled raster
-			str_warp_options = '-tr ' + xres + ' ' + yres + ' -srcnodata ' + nodataval + ' -dstnodata ' + nodataval + ' -r ' + interpol + ' '
-			cmd2 = subprocess.call('gdalwarp ' + str_warp_options + tempfile + ' ' + dstfile, shell=True)
+			str_warp_options = '-overwrite -tr ' + xres + ' ' + yres + ' -srcnodata ' + nodataval + ' -dstnodata ' + nodataval + ' -r ' + interpol + ' '
+			cmd2 = profiling.call('gdalwarp ' + str_warp_options + dstfile_temp + ' ' + dstfile)
 			if cmd2 == 0: 
+				if output_profile(profile) != OUTPUT_PROFILES['default']:
+					rewrite_raster(dstfile, profile = profile)
 				print('Rasterfile ' + str(i+1) + ' created out of ' + str(nfeature) + ' : ' + dstfile)
-				# Clean up and remove temporary upsampled file 
-				#print('Cleaning up...')
-				os.remove(dstfile_temp)
 			else:
 				print('Failed to create downsampled rasterfile with gdalwarp.')
-			if cmd_mask == 0:
-					os.remove(dstfile_temp2)
-		else:
-			print('Failed to create rasterfile with gdal_rasterize.')
-	if clean_polytemp:
-		print("Cleaning up ...")
-		os.remove(outpath + 'poly_temp.shp')
-		os.remove(outpath + 'poly_temp.cpg')
-		os.remove(outpath + 'poly_temp.dbf')
-		os.remove(outpath + 'poly_temp.prj')
-		os.remove(outpath + 'poly_temp.shx')
-	#print('FINISHED')
+			# Remove temporary upsampled file before next feature
+			os.remove(dstfile_temp)
+
+
+def raster_grid(bounds, pixsize):
+	""" Defines a regular raster grid that covers a bounding box, with origin at the upper left corner
+
+	:param bounds: bounding box (xmin, ymin, xmax, ymax) in crs units
+	:param pixsize: pixelsize in crs units (same for x and y)
+
+	RETURN
+	Affine transform of grid
+	Shape of grid (height, width)
+	"""
+	xmin, ymin, xmax, ymax = bounds
+	width = max(int(np.ceil((xmax - xmin) / pixsize)), 1)
+	height = max(int(np.ceil((ymax - ymin) / pixsize)), 1)
+	return from_origin(xmin, ymax, pixsize, pixsize), (height, width)
+
+
+def aggregation_factors(pixsize):
+	""" Smallest pixel size and aggregation factors of all pixel sizes relative to it
+
+	:param pixsize: pixel size or list of pixel sizes, all need to be integer multiples of the smallest pixel size
+
+	RETURN
+	smallest pixel size, list of integer factors (first factor is 1)
+	"""
+	pixsizes = sorted(set(pixsize)) if isinstance(pixsize, (list, tuple)) else [pixsize]
+	factors = [int(round(size / pixsizes[0])) for size in pixsizes]
+	for size, factor in zip(pixsizes, factors):
+		if abs(size - factor * pixsizes[0]) > 1e-6 * size:
+			raise ValueError('poly2raster: pixel size ' + str(size) + ' is not an integer multiple of smallest pixel size ' + str(pixsizes[0]))
+	return pixsizes[0], factors
+
+
+def aggregate_raster(fname_in, fname_out, factor, interpol = 'average', nodataval = -9999., profile = 'default'):
+	""" Writes raster with factor times larger pixels (same origin), aggregated from raster fname_in ignoring no-data pixels:
+	mean of all valid pixels (interpol = 'average' or 'near') or sum (interpol = 'sum')
+	"""
+	with rasterio.open(fname_in) as src:
+		transform, crs, descriptions = src.transform, src.crs, src.descriptions
+	data = read_raster(fname_in)
+	# pad to multiple of factor so that border pixels are included
+	height, width = -(-data.shape[1] // factor) * factor, -(-data.shape[2] // factor) * factor
+	data = np.pad(data, ((0, 0), (0, height - data.shape[1]), (0, width - data.shape[2])), constant_values = np.nan)
+	result = np.stack([block_reduce(band, factor, interpol = 'sum' if interpol == 'sum' else 'average') for band in data])
+	write_raster(fname_out, result, transform * Affine.scale(factor), crs, nodataval = nodataval, 
+		descriptions = None if all(desc is None for desc in descriptions) else list(descriptions), profile = profile)
+	print('Rasterfile ' + fname_out + ' aggregated from ' + fname_in)
+
+
+def polygon_index(geoms, transform, shape):
+	""" Rasterizes polygons to a grid of polygon indices (position of polygon in geoms), -1 where no polygon.
+	All features of the polygons can be rasterized afterwards by a simple lookup: values[index]
+
+	:param geoms: list or GeoSeries of polygon geometries
+	:param transform: affine transform of output grid
+	:param shape: shape of output grid (height, width)
+	"""
+	shapes = ((geom, i) for i, geom in enumerate(geoms) if geom is not None and not geom.is_empty)
+	return rfeatures.rasterize(shapes, out_shape = shape, transform = transform, fill = -1, dtype = 'int32')
+
+
+def geometry_hash(geoms):
+	""" Content hash (sha1) of geometries, independent of any attribute columns.
+	Polygon files with the same polygons in same order (e.g. outputs of combine_geodata with different features) have the same hash.
+
+	:param geoms: list or GeoSeries of geometries
+	"""
+	sha = hashlib.sha1()
+	for geom in geoms:
+		sha.update(b'\x00' if geom is None else geom.wkb)
+	return sha.hexdigest()
+
+
+def _cache_name(cachedir, prefix, suffix, geoms, mask_geoms, crs, transform, shape):
+	""" Cache filename from content hash of polygons, mask geometries, crs and grid definition
+	"""
+	mask_hash = geometry_hash(mask_geoms) if mask_geoms is not None else 'nomask'
+	key = '|'.join([geometry_hash(geoms), mask_hash, str(crs), str(tuple(transform)), str(tuple(shape))])
+	return os.path.join(cachedir, prefix + hashlib.sha1(key.encode()).hexdigest() + suffix)
+
+
+def cached_polygon_index(geoms, transform, shape, crs, mask_geoms = None, cachedir = None):
+	""" Rasterizes polygons to grid of polygon indices (see polygon_index), optionally cropped to mask geometries.
+	If cachedir is given, the index grid is saved as GeoTiff named by a content hash of polygons, mask, crs and grid definition,
+	and read from there in all following calls with the same inputs.
+
+	:param geoms: list or GeoSeries of polygon geometries
+	:param transform: affine transform of output grid
+	:param shape: shape of output grid (height, width)
+	:param crs: coordinate reference system of grid
+	:param mask_geoms: list or GeoSeries of mask geometries in crs (optional), pixels outside mask are set to -1
+	:param cachedir: directory for cached index files (optional)
+	"""
+	if cachedir is not None:
+		fname_cache = _cache_name(cachedir, 'polyindex_', '.tif', geoms, mask_geoms, crs, transform, shape)
+		if os.path.exists(fname_cache):
+			print('Reading cached polygon index ' + fname_cache + ' ...')
+			with rasterio.open(fname_cache) as src:
+				return src.read(1)
+	print('Rasterizing polygon index ...')
+	index = polygon_index(geoms, transform, shape)
+	if mask_geoms is not None:
+		print("Cropping of raster with polygon mask ...")
+		index[~rasterize_mask(mask_geoms, transform, shape, crs, cachedir = cachedir)] = -1
+	if cachedir is not None:
+		if not os.path.exists(cachedir):
+			os.makedirs(cachedir, exist_ok = True)
+		# Write to unique temporary name first so that concurrent runs never read incomplete files
+		fname_temp = fname_cache + '.' + str(os.getpid()) + '.tmp'
+		with rasterio.open(fname_temp, 'w', driver = 'GTiff', height = shape[0], width = shape[1], count = 1, dtype = 'int32', 
+			crs = crs, transform = transform, nodata = -1, compress = 'deflate', tiled = True) as dst:
+			dst.write(index, 1)
+		os.replace(fname_temp, fname_cache)
+	return index
+
+
+def read_mask(polymask, crs):
+	""" Reads mask file and converts geometries to crs
+
+	:param polymask: Path+name of mask shapefile (.shp or .gpkg format)
+	:param crs: coordinate reference system
+	"""
+	gpd_mask = gpd.read_file(polymask)
+	if (gpd_mask.crs is None) or (not gpd_mask.crs.equals(crs)):
+		gpd_mask = gpd_mask.to_crs(crs)
+	return gpd_mask.geometry
+
+
+# Rasterized masks of current process (see rasterize_mask)
+_MASK_CACHE = {}
+
+def rasterize_mask(mask_geoms, transform, shape, crs, cachedir = None):
+	""" Rasterizes mask geometries to boolean grid (True for pixels with center inside mask), equivalent to cropping with gdalwarp -cutline.
+	The mask grid is computed only once per mask and grid: it is kept in memory for following calls 
+	and, if cachedir is given, saved as GeoTiff named by content hash of mask, crs and grid definition.
+
+	:param mask_geoms: list or GeoSeries of mask geometries in crs
+	:param transform: affine transform of grid
+	:param shape: shape of grid (height, width)
+	:param crs: coordinate reference system of grid
+	:param cachedir: directory for cached mask files (optional)
+	"""
+	key = (geometry_hash(mask_geoms), str(crs), tuple(transform), tuple(shape))
+	if key in _MASK_CACHE:
+		return _MASK_CACHE[key]
+	fname_cache = None
+	if cachedir is not None:
+		fname_cache = _cache_name(cachedir, 'mask_', '.tif', mask_geoms, None, crs, transform, shape)
+	if (fname_cache is not None) and os.path.exists(fname_cache):
+		with rasterio.open(fname_cache) as src:
+			inside = src.read(1).astype(bool)
+	else:
+		print('Rasterizing polygon mask ...')
+		inside = rfeatures.geometry_mask(mask_geoms, out_shape = shape, transform = transform, invert = True)
+		if fname_cache is not None:
+			if not os.path.exists(cachedir):
+				os.makedirs(cachedir, exist_ok = True)
+			fname_temp = fname_cache + '.' + str(os.getpid()) + '.tmp'
+			with rasterio.open(fname_temp, 'w', driver = 'GTiff', height = shape[0], width = shape[1], count = 1, dtype = 'uint8', 
+				crs = crs, transform = transform, compress = 'deflate', tiled = True, nbits = 1) as dst:
+				dst.write(inside.astype('uint8'), 1)
+			os.replace(fname_temp, fname_cache)
+	_MASK_CACHE[key] = inside
+	return inside
+
+
+def coverage_weights(geoms, transform, shape, mask_geoms = None):
+	""" Calculates exact fraction of each pixel area that is covered by each polygon.
+	A feature raster is then the area-weighted mean of polygon values: (weights @ values) / (weights @ 1)
+
+	:param geoms: list or GeoSeries of polygon geometries
+	:param transform: affine transform of grid (north-up, no rotation)
+	:param shape: shape of grid (height, width)
+	:param mask_geoms: list or GeoSeries of mask geometries (optional), polygons are clipped to mask first
+
+	RETURN
+	Sparse matrix (scipy csr) with shape (height * width, number of polygons), rows are flattened pixels
+	"""
+	geoms = np.asarray(geoms, dtype = object)
+	if mask_geoms is not None:
+		geoms = shapely.intersection(geoms, shapely.union_all(np.asarray(mask_geoms, dtype = object)))
+	res = transform.a
+	x0, y0 = transform.c, transform.f
+	height, width = shape
+	pixarea = res * abs(transform.e)
+	bounds = shapely.bounds(geoms)
+	rows, cols, data = [], [], []
+	for j, geom in enumerate(geoms):
+		if geom is None or geom.is_empty:
+			continue
+		# Pixel range of polygon bounding box
+		col0 = max(int(np.floor((bounds[j, 0] - x0) / res)), 0)
+		col1 = min(int(np.ceil((bounds[j, 2] - x0) / res)), width)
+		row0 = max(int(np.floor((y0 - bounds[j, 3]) / abs(transform.e))), 0)
+		row1 = min(int(np.ceil((y0 - bounds[j, 1]) / abs(transform.e))), height)
+		if (col1 <= col0) or (row1 <= row0):
+			continue
+		rr, cc = np.mgrid[row0:row1, col0:col1]
+		rr, cc = rr.ravel(), cc.ravel()
+		cells = shapely.box(x0 + cc * res, y0 - (rr + 1) * abs(transform.e), x0 + (cc + 1) * res, y0 - rr * abs(transform.e))
+		# Only pixels at polygon boundary need an intersection, pixels inside are fully covered
+		shapely.prepare(geom)
+		frac = np.ones(len(cells))
+		inside = shapely.contains_properly(geom, cells)
+		frac[~inside] = shapely.area(shapely.intersection(cells[~inside], geom)) / pixarea
+		sel = frac > 0
+		rows.append(rr[sel] * width + cc[sel])
+		cols.append(np.full(sel.sum(), j))
+		data.append(frac[sel])
+	if len(data) == 0:
+		return sparse.csr_matrix((height * width, len(geoms)))
+	return sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))), shape = (height * width, len(geoms)))
+
+
+def cached_coverage_weights(geoms, transform, shape, crs, mask_geoms = None, cachedir = None):
+	""" Coverage weight matrix (see coverage_weights), saved in cachedir as sparse .npz file named by content hash
+	of polygons, mask, crs and grid definition, and read from there in all following calls with the same inputs.
+
+	:param geoms: list or GeoSeries of polygon geometries
+	:param transform: affine transform of grid
+	:param shape: shape of grid (height, width)
+	:param crs: coordinate reference system of grid
+	:param mask_geoms: list or GeoSeries of mask geometries in crs (optional)
+	:param cachedir: directory for cached weight files (optional)
+	"""
+	if cachedir is not None:
+		fname_cache = _cache_name(cachedir, 'coverage_', '.npz', geoms, mask_geoms, crs, transform, shape)
+		if os.path.exists(fname_cache):
+			print('Reading cached coverage weights ' + fname_cache + ' ...')
+			return sparse.load_npz(fname_cache).tocsr()
+	print('Calculating exact pixel coverage weights ...')
+	weights = coverage_weights(geoms, transform, shape, mask_geoms = mask_geoms)
+	if cachedir is not None:
+		if not os.path.exists(cachedir):
+			os.makedirs(cachedir, exist_ok = True)
+		fname_temp = fname_cache + '.' + str(os.getpid()) + '.tmp.npz'
+		sparse.save_npz(fname_temp, weights)
+		os.replace(fname_temp, fname_cache)
+	return weights
+
+
+def coverage_area_error(weights, pixarea, areas):
+	""" Relative difference between polygon areas recovered from coverage weights and reference areas,
+	e.g. reference from column 'AREASQKM' * 1e6 (mass conservation check)
+
+	:param weights: sparse coverage weight matrix (see coverage_weights)
+	:param pixarea: area of one pixel in crs units
+	:param areas: reference area for each polygon
+	"""
+	area_weights = np.asarray(weights.sum(axis = 0)).ravel() * pixarea
+	areas = np.asarray(areas, dtype = float)
+	return np.divide(area_weights - areas, areas, out = np.zeros_like(areas), where = areas > 0)
+
+
+def block_reduce(data, factor, interpol = 'average'):
+	""" Downsamples 2D array by integer factor, ignoring NaN values (equivalent to gdalwarp with -srcnodata).
+	Output pixels without any valid input pixels are NaN.
+
+	:param data: 2D numpy array with shape (height * factor, width * factor), NaN for no-data
+	:param factor: integer downsampling factor
+	:param interpol: 'average' (mean of all valid input pixels), 'sum' (sum of all valid input pixels) 
+		or 'near' (input pixel closest to center)
+	"""
+	height, width = data.shape[0] // factor, data.shape[1] // factor
+	blocks = data[:height * factor, :width * factor].reshape(height, factor, width, factor)
+	if interpol == 'near':
+		return blocks[:, factor // 2, :, factor // 2].copy()
+	elif interpol not in ['average', 'sum']:
+		raise ValueError("block_reduce: interpol must be either 'average', 'sum' or 'near', got " + str(interpol))
+	valid = ~np.isnan(blocks)
+	count = valid.sum(axis = (1, 3))
+	total = np.where(valid, blocks, 0.).sum(axis = (1, 3))
+	if interpol == 'sum':
+		return np.where(count > 0, total, np.nan)
+	return np.divide(total, count, out = np.full(total.shape, np.nan), where = count > 0)
+
+
+def output_profile(profile = 'default'):
+	""" Returns output file profile as dictionary (see OUTPUT_PROFILES)
+
+	:param profile: name of profile in OUTPUT_PROFILES or dictionary with settings that overwrite the 'default' profile
+	"""
+	if profile is None:
+		profile = 'default'
+	if isinstance(profile, str):
+		if profile not in OUTPUT_PROFILES:
+			raise ValueError('Output profile ' + profile + ' not known, select one of ' + str(list(OUTPUT_PROFILES)))
+		return dict(OUTPUT_PROFILES[profile])
+	result = dict(OUTPUT_PROFILES['default'])
+	result.update(profile)
+	return result
+
+
+def write_raster(fname, data, transform, crs, nodataval = -9999, descriptions = None, profile = 'default'):
+	""" Writes 2D array or 3D array (bands, height, width) as GeoTiff file, NaN values are written as nodataval
+
+	:param fname: path + filename of output raster
+	:param data: numpy array, either 2D or 3D with bands as first dimension
+	:param transform: affine transform of raster grid
+	:param crs: coordinate reference system of raster grid
+	:param nodataval: value for no-data entries (Default: -9999), for integer profiles the minimum integer value is used
+	:param descriptions: list of band descriptions, e.g. feature names (optional)
+	:param profile: output file profile, name in OUTPUT_PROFILES or dictionary (see output_profile)
+	"""
+	prof = output_profile(profile)
+	if data.ndim == 2:
+		data = data[np.newaxis]
+	dtype = np.dtype(prof['dtype'])
+	nodata_out = _output_nodata(dtype, nodataval)
+	scales = [_output_scale(data[band], prof) for band in range(data.shape[0])]
+	meta = {'driver': 'GTiff', 'height': data.shape[1], 'width': data.shape[2], 'count': data.shape[0], 'dtype': dtype.name, 
+		'crs': crs, 'transform': transform, 'nodata': nodata_out}
+	options = _creation_options(prof)
+
+	def _write_bands(dst):
+		for band in range(data.shape[0]):
+			dst.write(_encode_band(data[band], dtype, scales[band], nodata_out), band + 1)
+			if descriptions is not None:
+				dst.set_band_description(band + 1, descriptions[band])
+		if scales != [1.] * data.shape[0]:
+			dst.scales = scales
+
+	if not prof['overviews']:
+		with rasterio.open(fname, 'w', **meta, **options) as dst:
+			_write_bands(dst)
+		return
+	# Cloud-Optimized layout: build overviews in memory and copy with overviews ahead of full resolution data
+	with MemoryFile() as memfile:
+		with memfile.open(**meta, **options) as mem:
+			_write_bands(mem)
+			_build_overviews(mem, prof['blocksize'])
+		with memfile.open() as src:
+			rshutil.copy(src, fname, driver = 'GTiff', copy_src_overviews = True, **options)
+
+
+def _creation_options(prof):
+	""" GeoTiff creation options (tiling and compression) of output profile
+	"""
+	options = {}
+	if prof['tiled']:
+		options.update({'tiled': True, 'blockxsize': prof['blocksize'], 'blockysize': prof['blocksize']})
+	if prof['compress'] is not None:
+		options['compress'] = prof['compress']
+		if prof['predictor'] is not None:
+			options['predictor'] = prof['predictor']
+	return options
+
+
+def _output_nodata(dtype, nodataval):
+	""" No-data value in output file, minimum integer value for integer types
+	"""
+	return np.iinfo(dtype).min if np.issubdtype(dtype, np.integer) else nodataval
+
+
+def _output_scale(data, prof):
+	""" Scale factor for integer output profiles (1 for float types), from profile or from data range if not set in profile
+	"""
+	dtype = np.dtype(prof['dtype'])
+	if not np.issubdtype(dtype, np.integer):
+		return 1.
+	if prof['scale'] is not None:
+		return prof['scale']
+	maxabs = np.nanmax(np.abs(data)) if np.isfinite(data).any() else 0.
+	return maxabs / (np.iinfo(dtype).max - 1) if maxabs > 0 else 1.
+
+
+def _encode_band(data, dtype, scale, nodata_out):
+	""" Converts float array with NaN for no-data to output type, integer types store round(data / scale)
+	"""
+	if np.issubdtype(dtype, np.integer):
+		return np.where(np.isnan(data), nodata_out, np.round(np.nan_to_num(data) / scale)).astype(dtype)
+	return np.where(np.isnan(data), nodata_out, data).astype(dtype)
+
+
+def _build_overviews(dst, blocksize):
+	""" Builds internal overviews (average) with factors 2, 4, 8, ... until overview is smaller than half a block
+	"""
+	factors = []
+	while (max(dst.height, dst.width) // 2**(len(factors) + 1)) >= blocksize // 2:
+		factors.append(2**(len(factors) + 1))
+	if len(factors) > 0:
+		dst.build_overviews(factors, Resampling.average)
+		dst.update_tags(ns = 'rio_overview', resampling = 'average')
+
+
+def read_raster(fname, band = None, window = None):
+	""" Reads raster file as float array with NaN for no-data and scale/offset of file metadata applied
+
+	:param fname: path + filename of raster
+	:param band: band number (starting with 1) to return as 2D array, if None all bands are returned as 3D array
+	:param window: rasterio Window to read only part of the raster (optional)
+	"""
+	with rasterio.open(fname) as src:
+		bands = list(range(1, src.count + 1)) if band is None else [band]
+		data = src.read(bands, window = window, masked = True).astype(float)
+		for i, bandnr in enumerate(bands):
+			data[i] = data[i] * src.scales[bandnr - 1] + src.offsets[bandnr - 1]
+	data = data.filled(np.nan)
+	return data if band is None else data[0]
+
+
+def rewrite_raster(fname, profile = 'default', fname_out = None):
+	""" Rewrites raster file with different output profile, e.g. to convert files created by gdal tools to Cloud-Optimized GeoTiffs
+
+	:param fname: path + filename of input raster
+	:param profile: output file profile, name in OUTPUT_PROFILES or dictionary (see output_profile)
+	:param fname_out: path + filename of output raster, default None overwrites input file
+	"""
+	with rasterio.open(fname) as src:
+		transform, crs, nodataval = src.transform, src.crs, src.nodata
+		descriptions = list(src.descriptions) if any(src.descriptions) else None
+	data = read_raster(fname)
+	if (nodataval is None) or (not np.issubdtype(np.dtype(output_profile(profile)['dtype']), np.floating)):
+		nodataval = -9999
+	write_raster(fname if fname_out is None else fname_out, data, transform, crs, nodataval = nodataval, 
+		descriptions = descriptions, profile = profile)
+
+
+def _poly2raster_rasterio(infile, outpath, featurelist, polymask = None, pixsize = 100, nodataval = -9999., interpol = 'average', 
+	crs = 'epsg:3577', multiband = False, cachedir = None, weighting = 'upsample', profile = 'default', factors = [1]):
+	""" In-process version of poly2raster (see poly2raster for parameters), polygons and mask are read only once, 
+	rasterized once as polygon index grid at upsampled resolution (or as exact coverage weight matrix), 
+	and each feature is then a lookup of polygon values (or one sparse matrix-vector product).
+	Rasters with factor times larger pixels (factors) are aggregated from the sums of values and covered area of each pixel, 
+	so they are the same as the area-weighted mean (or sum) over the covered area of their pixels.
+	"""
+	if isinstance(infile, gpd.GeoDataFrame):
+		poly = infile
+	else:
+		print("Reading in polygon file....")
+		poly = read_polygons(infile)
+	if (poly.crs is None) or (not poly.crs.equals(crs)):
+		print('Converting input file to meters...')
+		poly = poly.to_crs(crs)
+	### Define output grid (cropped to bounds of mask if available) and upsampled grid
+	if polymask is not None:
+		mask_geoms = read_mask(polymask, crs)
+		bounds = mask_geoms.total_bounds
+	else:
+		bounds = poly.total_bounds
+		mask_geoms = None
+	if weighting not in ['upsample', 'exact']:
+		raise ValueError("poly2raster: weighting must be either 'upsample' or 'exact', got " + str(weighting))
+	if (weighting == 'exact') and (interpol == 'sum'):
+		# exact weights give area-weighted means, sums would only be used for the larger pixel sizes
+		raise ValueError("poly2raster: interpol = 'sum' is not supported with weighting = 'exact', use weighting = 'upsample'")
+	transform, shape = raster_grid(bounds, pixsize)
+	# Features are only computed for pixels covered by polygons (see lib/sparseraster.py)
+	from .sparseraster import SparseGrid, SparseRaster
+	if weighting == 'exact':
+		### Exact pixel coverage weights once for all features (or read from cache)
+		weights = cached_coverage_weights(poly.geometry, transform, shape, crs, mask_geoms = mask_geoms, cachedir = cachedir)
+		if (mask_geoms is None) and ('AREASQKM' in poly.columns):
+			area_error = coverage_area_error(weights, pixsize**2, poly['AREASQKM'].to_numpy(dtype = float) * 1e6)
+			print('Maximum relative area difference of coverage weights to AREASQKM: ' + str(np.round(np.abs(area_error).max(), 4)))
+		# only rows of covered pixels
+		rows = np.flatnonzero(np.diff(weights.indptr))
+		weights = weights[rows]
+		grid = SparseGrid(rows, transform, shape, crs)
+	else:
+		### Rasterize polygon indices once for all features (or read from cache)
+		transform_up = transform * Affine.scale(1. / UPSAMPLE)
+		shape_up = (shape[0] * UPSAMPLE, shape[1] * UPSAMPLE)
+		index = cached_polygon_index(poly.geometry, transform_up, shape_up, crs, mask_geoms = mask_geoms, cachedir = cachedir)
+		grid, index_up, pixel_up = upsampled_groups(index, UPSAMPLE, transform, crs, interpol = interpol)
+		del index
+	# grids with larger pixels and position of their pixel for each pixel of smallest grid
+	levels = [(factor,) + (grid.coarsen(factor) if factor > 1 else (grid, None)) for factor in factors]
+	nfeature = len(featurelist)
+	bands = {factor: [] for factor in factors}
+	for i, feature in enumerate(featurelist):
+		with profiling.stage(feature):
+			print('Rasterizing feature ' + feature + ' ...')
+			values = poly[feature].to_numpy(dtype = float)
+			if weighting == 'exact':
+				valid = np.isfinite(values)
+				total = weights @ np.where(valid, values, 0.)
+				cover = weights @ valid.astype(float)
+			else:
+				total, cover = sparse_block_sums(values[index_up], pixel_up, len(grid))
+			for factor, grid_level, pixel in levels:
+				if factor == 1:
+					result = block_result(total, cover, interpol = 'average' if weighting == 'exact' else interpol)
+				else:
+					result = block_result(np.bincount(pixel, weights = total, minlength = len(grid_level)), 
+						np.bincount(pixel, weights = cover, minlength = len(grid_level)), interpol = 'sum' if interpol == 'sum' else 'average')
+				if multiband:
+					bands[factor].append(result)
+				else:
+					dstfile = outpath + 'raster_' + str(int(pixsize * factor)) + 'm_' + feature + '.tif'
+					SparseRaster(grid_level, result, descriptions = [feature]).write(dstfile, nodataval = nodataval, profile = profile)
+					print('Rasterfile ' + str(i+1) + ' created out of ' + str(nfeature) + ' : ' + dstfile)
+	if multiband:
+		for factor, grid_level, pixel in levels:
+			dstfile = outpath + 'raster_' + str(int(pixsize * factor)) + 'm_features.tif'
+			SparseRaster(grid_level, np.stack(bands[factor]), descriptions = featurelist).write(dstfile, nodataval = nodataval, profile = profile)
+			print('Rasterfile with ' + str(nfeature) + ' bands created: ' + dstfile)
+
+
+def upsampled_groups(index, factor, transform, crs, interpol = 'average'):
+	""" Assigns the covered pixels of an upsampled polygon index grid to the pixels of the output grid, 
+	so features can be aggregated for covered pixels only (see sparse_block_sums)
+
+	:param index: polygon index grid at upsampled resolution (see polygon_index), -1 where no polygon
+	:param factor: upsampling factor
+	:param transform: affine transform of output grid
+	:param crs: coordinate reference system of output grid
+	:param interpol: 'average', 'sum' or 'near' (only the upsampled pixel closest to the center of each output pixel is used)
+
+	RETURN
+	SparseGrid of output pixels with at least one covered upsampled pixel, polygon index of used upsampled pixels,
+	position of output pixel in SparseGrid for each used upsampled pixel
+	"""
+	from .sparseraster import SparseGrid
+	if interpol not in ['average', 'sum', 'near']:
+		raise ValueError("poly2raster: interpol must be either 'average', 'sum' or 'near', got " + str(interpol))
+	height, width = index.shape[0] // factor, index.shape[1] // factor
+	index = index[:height * factor, :width * factor]
+	rows_up, cols_up = np.nonzero(index >= 0)
+	if interpol == 'near':
+		sel = (rows_up % factor == factor // 2) & (cols_up % factor == factor // 2)
+		rows_up, cols_up = rows_up[sel], cols_up[sel]
+	pixels = (rows_up // factor) * width + cols_up // factor
+	grid_index, pixel_up = np.unique(pixels, return_inverse = True)
+	return SparseGrid(grid_index, transform, (height, width), crs), index[rows_up, cols_up], pixel_up
+
+
+def sparse_block_sums(values_up, pixel_up, npixel):
+	""" Sum and number of valid values of upsampled pixels in each output pixel (as block_reduce, but only for covered pixels)
+
+	:param values_up: values of upsampled pixels, NaN values are ignored
+	:param pixel_up: position of output pixel of each upsampled pixel (see upsampled_groups)
+	:param npixel: number of output pixels
+
+	RETURN
+	sum of values, number of valid values
+	"""
+	valid = np.isfinite(values_up)
+	count = np.bincount(pixel_up, weights = valid, minlength = npixel)
+	total = np.bincount(pixel_up, weights = np.where(valid, values_up, 0.), minlength = npixel)
+	return total, count
+
+
+def block_result(total, count, interpol = 'average'):
+	""" Pixel values from sums and number (or covered area) of valid values, see sparse_block_sums
 	
+	:param interpol: 'average' (mean), 'sum' or 'near' (one upsampled pixel per output pixel)
+	"""
+	if interpol in ['sum', 'near']:
+		return np.where(count > 0, total, np.nan)
+	return np.divide(total, count, out = np.full(total.shape, np.nan), where = count > 0)
+
+
+# Columns with bounding box of each polygon in boundary store (GeoParquet), used for filtering row groups while reading
+BBOX_COLUMNS = ['bbox_xmin', 'bbox_ymin', 'bbox_xmax', 'bbox_ymax']
+
+def is_boundary_store(fname):
+	""" True if fname is a GeoParquet boundary store (see write_polygons)
+	"""
+	return isinstance(fname, str) and fname.endswith('.parquet')
+
+
+def write_polygons(gdf, fname, row_group_size = 10000):
+	""" Writes polygons as GeoPackage or, if fname ends with '.parquet', as GeoParquet boundary store:
+	rows are sorted along a Hilbert curve so that each row group covers a compact region, 
+	and the bounding box of each polygon is stored in columns BBOX_COLUMNS. Reading with a bbox (see read_polygons) 
+	then skips all row groups outside the bbox using the row group statistics.
+
+	:param gdf: GeoDataFrame
+	:param fname: path+filename of output file (.gpkg or .parquet)
+	:param row_group_size: number of polygons per row group (only for .parquet)
+	"""
+	if not is_boundary_store(fname):
+		gdf.to_file(fname, driver = 'GPKG', index = False)
+		return
+	gdf = gdf[gdf.geometry.notnull() & ~gdf.geometry.is_empty]
+	gdf = gdf.iloc[np.argsort(gdf.geometry.hilbert_distance(), kind = 'stable')].reset_index(drop = True)
+	bounds = gdf.geometry.bounds.values
+	for i, col in enumerate(BBOX_COLUMNS):
+		gdf[col] = bounds[:, i]
+	gdf.to_parquet(fname, index = False, row_group_size = row_group_size)
+
+
+def vector_info(fname):
+	""" Returns crs and field names of vector file without reading its features
+	"""
+	if is_boundary_store(fname):
+		import json
+		from pyarrow import parquet
+		from pyproj import CRS
+		schema = parquet.read_schema(fname)
+		geo = json.loads(schema.metadata[b'geo'])
+		# crs missing in GeoParquet metadata means longitude/latitude (OGC:CRS84)
+		crs = CRS.from_user_input(geo['columns'][geo['primary_column']].get('crs', 'OGC:CRS84'))
+		return crs, [name for name in schema.names if name not in BBOX_COLUMNS + [geo['primary_column']]]
+	if pyogrio is not None:
+		info = pyogrio.read_info(fname)
+		return info['crs'], list(info['fields'])
+	import fiona
+	with fiona.open(fname) as src:
+		return src.crs, list(src.schema['properties'])
+
+
+def read_polygons(fname, columns = None, bbox = None):
+	""" Reads polygon file with only the given columns and only features that intersect bbox.
+	Filters are applied by the driver while reading, so features outside bbox are not parsed.
+	GeoParquet boundary stores (see write_polygons) are read with Arrow, only row groups that overlap bbox are read.
 
+	:param fname: path+filename of polygon file (.shp, .gpkg or .parquet format)
+	:param columns: list of columns to read (columns missing in file are ignored), None for all columns
+	:param bbox: bounding box (xmin, ymin, xmax, ymax) in crs of file (optional)
+	"""
+	if columns is not None:
+		fields = vector_info(fname)[1]
+		columns = [col for col in columns if col in fields]
+	if is_boundary_store(fname):
+		filters = None
+		if bbox is not None:
+			xmin, ymin, xmax, ymax = bbox
+			filters = [('bbox_xmax', '>=', xmin), ('bbox_xmin', '<=', xmax), ('bbox_ymax', '>=', ymin), ('bbox_ymin', '<=', ymax)]
+		poly = gpd.read_parquet(fname, columns = None if columns is None else columns + ['geometry'], filters = filters)
+		return poly.drop(columns = [col for col in BBOX_COLUMNS if col in poly])
+	if pyogrio is not None:
+		try:
+			import pyarrow
+			use_arrow = True
+		except ImportError:
+			use_arrow = False
+		return gpd.read_file(fname, engine = 'pyogrio', columns = columns, bbox = bbox, use_arrow = use_arrow)
+	if columns is None:
+		return gpd.read_file(fname, bbox = bbox)
+	return gpd.read_file(fname, bbox = bbox, ignore_fields = [col for col in vector_info(fname)[1] if col not in columns])
+
+
+@profiling.stage('combine_geodata')
 def combine_geodata(fname_poly, fname_data, featurelist, polymask = None,  outfile = None, indexname = 'SA1_7DIG11'):
 	"""Combines feature data with geopolygons
 
@@ -108,7 +824,7 @@ def combine_geodata(fname_poly, fname_data, featurelist, polymask = None,  outfi
 	:param fname_data: Data table with features (columns) for each of the region (rows). Format as .csv file
 	:param featurelist: list of feature names as appear in header of fname_data, i string format e.g. ['feature1', 'feature2', ... ]
 	:param polymask: Path+filename of mask shapefile (.shp or .gpkg format) that is used to clip regions of source file
-	:param outfile:  Directory Path and filename for combined output file (optional) 
+	:param outfile:  Directory Path and filename for combined output file (optional), GeoParquet boundary store if filename ends with .parquet
 	:param indexname: String, name of index that is shared between polygons data and feature data
 	Both files, polygon file and feature data, need to have same index in first column with leable in headre as indexname.
 	Note that alogoritthm selects only regions which match index, others will be disregarded
@@ -117,24 +833,44 @@ def combine_geodata(fname_poly, fname_data, featurelist, polymask = None,  outfi
 	Geopandas dataframe
 	Feature list
 	"""
-	poly = gpd.read_file(fname_poly)
-	poly[indexname] = poly[indexname].astype(str)
-	crs_current = poly.crs
+	# Read only index and area column of polygons, and with mask only polygons within bounding box of mask
+	columns = [indexname, 'AREASQKM']
+	poly_crs = vector_info(fname_poly)[0]
+	gpd_mask = None
 	if polymask is not None:
-		#Select only polygons that intersect with mask (hard-crop to cutline applied later in poly2raster):
-		print("Clipping source file polygons that intersect with mask ... ")
 		gpd_mask = gpd.read_file(polymask)
-		if gpd_mask.crs != crs_current:
+		if gpd_mask.crs != poly_crs:
 			# If crs of mask is different from source, convert mask's crs to source crs:
-			gpd_mask = gpd_mask.to_crs(crs_current)
-		join = gpd.sjoin(gpd_mask, poly, how = 'inner',op='intersects') # fastest method for intersection since using rtree internally
-		poly = poly.loc[join.index_right]
-		#poly = poly[poly.geometry.intersects(gpd_mask.geometry[0])] # alterbative to sjoin but very slow
-	df = pd.read_csv(fname_data) 
+			gpd_mask = gpd_mask.to_crs(poly_crs)
+	poly = read_polygons(fname_poly, columns = columns, bbox = None if gpd_mask is None else tuple(gpd_mask.total_bounds))
+	poly[indexname] = poly[indexname].astype(str)
+	if gpd_mask is not None:
+		#Select only polygons that intersect with mask (hard-crop to cutline applied later in poly2raster):
+		print("Clipping source file polygons that intersect with mask ... ")
+		join = gpd.sjoin(gpd_mask, poly, how = 'inner', predicate = 'intersects') # fastest method for intersection since using rtree internally
+		poly = poly.loc[join.index_right.unique()]
+	# Read only index and feature columns of data table
+	df = pd.read_csv(fname_data, usecols = [indexname] + featurelist, dtype = {indexname: str}) 
 	df[indexname] = df[indexname].astype(str)
-	df = df[[indexname] + featurelist]
-	# Merge the two files based on common index name:
-	comb = poly.merge(df, how = 'left', on = indexname)
+	comb, featurelist = merge_features(poly, df, featurelist, indexname)
+	print('Saving file to ' + outfile + ' ...')
+	if outfile is not None:
+		write_polygons(comb, outfile)
+	return comb, featurelist
+
+
+def merge_features(poly, df, featurelist, indexname):
+	""" Merges feature table with polygons and replaces TOTAL with population density POPDENS_100m (see combine_geodata)
+
+	:param poly: GeoDataFrame of polygons with columns indexname and AREASQKM
+	:param df: Dataframe with columns indexname and featurelist
+
+	RETURN
+	Geopandas dataframe with columns indexname, features and geometry
+	Feature list
+	"""
+	# Merge the two files based on common index name (raises MergeError if the index is not unique in the data table):
+	comb = poly.merge(df, how = 'left', on = indexname, validate = 'many_to_one')
 	# Check for non-valid data (e.g. if not all regions have data)
 	null = len(comb[comb[featurelist[0]].isnull()]) 
 	if null > 0:
@@ -146,41 +882,178 @@ def combine_geodata(fname_poly, fname_data, featurelist, polymask = None,  outfi
 		comb["POPDENS_100m"] = comb.TOTAL.values / (comb.AREASQKM.values * 100) 
 		featurelist = featurelist + ['POPDENS_100m']
 		featurelist.remove('TOTAL')
-	print('Saving file to ' + outfile + ' ...')
-	comb = comb[[indexname] + featurelist + ['geometry']]
-	if outfile is not None:
-		comb.to_file(outfile, driver = 'GPKG', index = False)
-	return comb, featurelist
+	return comb[[indexname] + featurelist + ['geometry']], featurelist
 
 
-def rasterdiff(name_raster1, name_raster2, outfile, norm = False):
+@profiling.stage('rasterdiff')
+def rasterdiff(name_raster1, name_raster2, outfile, norm = False, profile = 'default', engine = 'gdal'):
 	""" Subtract raster2 from raster 1 and applies optional normalisation using another rastser
 	:param raster1: path+fielname for input raster 1
 	:param raster2: path+fielname for input raster 2, same shape as raster 1
 	:param outfile: path+fielname for output raster
 	:param norm: calculate relative chnage
+	:param profile: output file profile, name in OUTPUT_PROFILES or dictionary (see output_profile)
+	:param engine: 'gdal' (default, gdal_calc.py), 'rasterio' (in-process block-wise evaluation, see lib/rastercalc.py)
+		or 'sparse' (in-process evaluation of valid pixels only, see lib/sparseraster.py)
 	"""
+	if engine == 'rasterio':
+		from .rastercalc import RasterExpr, EXPR_DIFF, EXPR_RELDIFF
+		RasterExpr(EXPR_RELDIFF if norm else EXPR_DIFF, A = name_raster1, B = name_raster2).write(outfile, profile = profile)
+		return
+	elif engine == 'sparse':
+		from .rastercalc import EXPR_DIFF, EXPR_RELDIFF
+		from .sparseraster import read_sparse, evaluate
+		evaluate(EXPR_RELDIFF if norm else EXPR_DIFF, A = read_sparse(name_raster1), B = read_sparse(name_raster2)).write(outfile, profile = profile)
+		return
 	# example: gdal_calc.py -A input.tif -B input2.tif --NoDataValue=-9999 --outfile=result.tif --calc="(A+B)/2"
 	dstfile = outfile
 	if norm:
 		str_operation = " --overwrite --quiet --NoDataValue=-9999 --calc='divide(A-B,B, out=zeros_like(A)-9999, where=(A>-9999) & (B>0))'" 
-		cmd = subprocess.call("gdal_calc.py -A " + name_raster1 + " -B " + name_raster2 + " --outfile=" + dstfile + str_operation, shell=True)
+		cmd = profiling.call("gdal_calc.py -A " + name_raster1 + " -B " + name_raster2 + " --outfile=" + dstfile + str_operation)
 	else:
 		str_operation = " --overwrite --quiet --NoDataValue=-9999 --calc='(A-B) * (A>-9999) * (B>-9999)'"
-		cmd = subprocess.call("gdal_calc.py -A " + name_raster1 + " -B " + name_raster2 + " --outfile=" + dstfile + str_operation, shell=True)
+		cmd = profiling.call("gdal_calc.py -A " + name_raster1 + " -B " + name_raster2 + " --outfile=" + dstfile + str_operation)
 	if cmd != 0:
 		print("rasterdiff failed!")
+	elif output_profile(profile) != OUTPUT_PROFILES['default']:
+		rewrite_raster(dstfile, profile = profile)
 
 
-def rasterprod(name_raster1, name_raster2, outfile):
+@profiling.stage('rasterprod')
+def rasterprod(name_raster1, name_raster2, outfile, profile = 'default', engine = 'gdal'):
 	""" Subtract raster2 from raster 1 and applies optional normalisation using another rastser
 	:param raster1: path+fielname for input raster 1
 	:param raster2: path+fielname for input raster 2, same shape as raster 1
 	:param outfile: path+fielname for output raster
+	:param profile: output file profile, name in OUTPUT_PROFILES or dictionary (see output_profile)
+	:param engine: 'gdal' (default, gdal_calc.py), 'rasterio' (in-process block-wise evaluation, see lib/rastercalc.py)
+		or 'sparse' (in-process evaluation of valid pixels only, see lib/sparseraster.py)
 	"""
+	if engine == 'rasterio':
+		from .rastercalc import RasterExpr, EXPR_PROD
+		RasterExpr(EXPR_PROD, A = name_raster1, B = name_raster2).write(outfile, profile = profile)
+		return
+	elif engine == 'sparse':
+		from .rastercalc import EXPR_PROD
+		from .sparseraster import read_sparse, evaluate
+		evaluate(EXPR_PROD, A = read_sparse(name_raster1), B = read_sparse(name_raster2)).write(outfile, profile = profile)
+		return
 	# example: gdal_calc.py -A input.tif -B input2.tif --NoDataValue=-9999 --outfile=result.tif --calc="(A+B)/2"
 	dstfile = outfile
 	str_operation = " --overwrite --quiet --NoDataValue=-9999 --calc='(A* B)* (B>0) * (A>=0)'"
-	cmd = subprocess.call("gdal_calc.py -A " + name_raster1 + " -B " + name_raster2 + " --outfile=" + dstfile + str_operation, shell=True)
+	cmd = profiling.call("gdal_calc.py -A " + name_raster1 + " -B " + name_raster2 + " --outfile=" + dstfile + str_operation)
 	if cmd != 0:
 		print("rasterdiff failed!")
+	elif output_profile(profile) != OUTPUT_PROFILES['default']:
+		rewrite_raster(dstfile, profile = profile)
+
+
+# Label grids of zone polygons of current process (see zone_labels)
+_ZONE_CACHE = {}
+
+# Statistics of zonal_stats (in addition to percentiles)
+ZONAL_STATS = ['count', 'sum', 'mean', 'std', 'min', 'max']
+
+def zone_labels(geoms, transform, shape, crs, cachedir = None):
+	""" Rasterizes zone polygons to grid of zone labels (position of zone in geoms, -1 outside of zones, see polygon_index).
+	The label grid is computed only once per zones and grid: it is kept in memory for following calls 
+	and, if cachedir is given, saved as GeoTiff named by content hash of zones, crs and grid definition (see cached_polygon_index).
+
+	:param geoms: list or GeoSeries of zone polygons in crs
+	:param transform: affine transform of grid
+	:param shape: shape of grid (height, width)
+	:param crs: coordinate reference system of grid
+	:param cachedir: directory for cached label grids (optional)
+	"""
+	key = (geometry_hash(geoms), str(crs), tuple(transform), tuple(shape))
+	if key not in _ZONE_CACHE:
+		_ZONE_CACHE[key] = cached_polygon_index(geoms, transform, shape, crs, cachedir = cachedir)
+	return _ZONE_CACHE[key]
+
+
+def _group_stats(labels, values, nzone, stats, percentiles):
+	""" Statistics of values grouped by zone labels (0 ... nzone-1), see zonal_stats
+
+	RETURN
+	dictionary {statistic: array of length nzone}
+	"""
+	count = np.bincount(labels, minlength = nzone)
+	total = np.bincount(labels, weights = values, minlength = nzone)
+	valid = count > 0
+	mean = np.divide(total, count, out = np.full(nzone, np.nan), where = valid)
+	result = {'count': count, 'sum': np.where(valid, total, np.nan), 'mean': mean}
+	if 'std' in stats:
+		var = np.bincount(labels, weights = (values - mean[labels]) ** 2, minlength = nzone)
+		result['std'] = np.sqrt(np.divide(var, count, out = np.full(nzone, np.nan), where = valid))
+	if ('min' in stats) or ('max' in stats) or percentiles:
+		# values sorted within each zone, values of zone i at positions first[i] ... last[i], 
+		# zones without values point to NaN appended at the end
+		values_sorted = np.append(values[np.lexsort((values, labels))], np.nan)
+		first = np.where(valid, np.cumsum(count) - count, len(values))
+		last = np.where(valid, first + count - 1, len(values))
+		result['min'] = values_sorted[first]
+		result['max'] = values_sorted[last]
+		for perc in percentiles:
+			# linear interpolation between closest values (as np.percentile)
+			pos = first + perc / 100. * (last - first)
+			low = np.floor(pos).astype(np.int64)
+			high = np.minimum(low + 1, last)
+			result['p' + '%g' % perc] = values_sorted[low] + (pos - low) * (values_sorted[high] - values_sorted[low])
+	return result
+
+
+@profiling.stage('zonal_stats')
+def zonal_stats(zones, rasters, stats = ['count', 'sum', 'mean'], percentiles = None, indexname = None, cachedir = None):
+	""" Statistics of raster values within each zone polygon (e.g. suburbs, LGAs), for all bands of all rasters.
+	Zones are rasterized once to a grid of zone labels (pixels with center inside zone, see zone_labels), 
+	statistics of each band are then computed for all zones at once with np.bincount (percentiles from one sort of values by zone).
+	Rasters need to be on the same grid, e.g. all outputs of poly2raster with the same mask and pixel size. 
+	No-data pixels are ignored; zones should not overlap (pixels are assigned to the last zone that contains them).
+
+	:param zones: GeoDataFrame or path+filename of zone polygons (.shp, .gpkg or .parquet)
+	:param rasters: path+filename of raster, list of filenames or dictionary {name: filename}
+	:param stats: list of statistics: 'count', 'sum', 'mean', 'std', 'min', 'max'
+	:param percentiles: list of percentiles in range [0, 100] (optional), e.g. [10, 50, 90]
+	:param indexname: name of index column of zones (Default: index of zones), used as index of result
+	:param cachedir: directory for cached label grids (optional)
+
+	RETURN
+	Dataframe with one row per zone (same order as zones) and columns <name>_<statistic> (e.g. raster_100m_LOW_mean, raster_100m_LOW_p50)
+	with name as raster filename without extension (or key of rasters dictionary) and band description for multiband rasters.
+	Statistics of zones without valid pixels are NaN (count 0). Join to zones with e.g. zones.merge(result, on = indexname)
+	"""
+	for stat in stats:
+		if stat not in ZONAL_STATS:
+			raise ValueError('zonal_stats: statistic must be one of ' + str(ZONAL_STATS) + ', got ' + str(stat))
+	percentiles = list(percentiles) if percentiles is not None else []
+	if isinstance(rasters, str):
+		rasters = [rasters]
+	if not isinstance(rasters, dict):
+		rasters = {os.path.splitext(os.path.basename(fname))[0]: fname for fname in rasters}
+	if isinstance(zones, str):
+		zones = read_polygons(zones, columns = None if indexname is None else [indexname])
+	fname_first = list(rasters.values())[0]
+	with rasterio.open(fname_first) as src:
+		transform, shape, crs = src.transform, src.shape, src.crs
+	if (zones.crs is None) or (not zones.crs.equals(crs)):
+		zones = zones.to_crs(crs)
+	labels = zone_labels(zones.geometry.values, transform, shape, crs, cachedir = cachedir).ravel()
+	# only pixels inside of zones are read from rasters
+	pixels = np.flatnonzero(labels >= 0)
+	labels = labels[pixels]
+	columns = {}
+	for name, fname in rasters.items():
+		with rasterio.open(fname) as src:
+			if (src.shape != shape) or (not src.transform.almost_equals(transform)) or (src.crs != crs):
+				raise ValueError('zonal_stats: raster ' + fname + ' is not on the same grid as ' + fname_first)
+			descriptions = src.descriptions
+		data = read_raster(fname)
+		for band in range(data.shape[0]):
+			values = data[band].ravel()[pixels]
+			valid = np.isfinite(values)
+			bandname = name if data.shape[0] == 1 else name + '_' + (descriptions[band] if descriptions[band] else 'b' + str(band + 1))
+			result = _group_stats(labels[valid], values[valid], len(zones), stats, percentiles)
+			for stat in stats + ['p' + '%g' % perc for perc in percentiles]:
+				columns[bandname + '_' + stat] = result[stat]
+	index = pd.Index(zones[indexname].values, name = indexname) if indexname is not None else zones.index
+	return pd.DataFrame(columns, index = index)
@@ -0,0 +1,177 @@
+# Batch processing of several regions (e.g. all Greater Capital Cities) from one read of the polygon boundaries
+"""
+Author: Sebastian Haan
+Affiliation: Sydney Information Hub, The University of Sydney
+
+Comments:
+Running combine_geodata and poly2raster once per region mask reads the (national) polygon boundaries
+and builds the spatial join index again for every region. Here the boundaries and the data table are read once,
+polygons are partitioned to all regions with a single spatial join and the combined file and mask of each region are saved.
+The rasterization of all regions then runs in parallel as tasks of a TaskGraph (see lib/pipeline.py).
+Regions are given either as dictionary {region name: mask file} or as one mask layer with a column of region names
+(one or more polygons per region). Polygons that intersect several regions (e.g. at borders) are included in each of them.
+
+Example:
+batch_regions('SA1_2016_AUST_meters.gpkg', 'NEWPERC_INC16.csv', features, '../Data/GCCSA_2016.gpkg', '../Results/Regions/',
+	'SA1_CODE7', regionname = 'GCC_NAME16', suffix = '16', workers = 8, engine = 'rasterio')
+"""
+
+import os
+import re
+import pandas as pd
+import geopandas as gpd
+from .rasterize import read_polygons, vector_info, write_polygons, merge_features, poly2raster
+from .pipeline import TaskGraph
+from . import profiling
+
+
+def region_label(name):
+	""" Region name as used in filenames and task names (characters other than letters, digits, - and _ replaced by _)
+	"""
+	return re.sub('[^A-Za-z0-9_-]+', '_', str(name)).strip('_')
+
+
+def region_paths(outpath, name, suffix = '', ext = '.gpkg'):
+	""" Output files of region
+
+	RETURN
+	path+filename of combined polygon file, path+filename of mask file, output path for rasters
+	"""
+	path = outpath + region_label(name) + '/'
+	return path + 'COMB' + suffix + ext, path + 'mask' + suffix + '.gpkg', path + 'Raster' + suffix + '/'
+
+
+def region_names(regions, regionname = 'region'):
+	""" Names of regions
+
+	:param regions: dictionary {region name: mask file} or path+filename of mask layer with region names in column regionname
+	:param regionname: name of column with region names in mask layer
+	"""
+	if isinstance(regions, dict):
+		return list(regions)
+	return list(pd.unique(read_polygons(regions, columns = [regionname])[regionname].astype(str)))
+
+
+def read_regions(regions, crs, regionname = 'region'):
+	""" Reads region masks (see region_names) and converts geometries to crs
+
+	RETURN
+	GeoDataFrame with columns 'region' and geometry
+	"""
+	if isinstance(regions, dict):
+		parts = []
+		for name, fname in regions.items():
+			gpd_mask = gpd.read_file(fname)
+			if (gpd_mask.crs is None) or (not gpd_mask.crs.equals(crs)):
+				gpd_mask = gpd_mask.to_crs(crs)
+			parts.append(gpd.GeoDataFrame({'region': [name] * len(gpd_mask)}, geometry = gpd_mask.geometry.values, crs = crs))
+		return pd.concat(parts, ignore_index = True)
+	gpd_regions = read_polygons(regions, columns = [regionname])
+	if (gpd_regions.crs is None) or (not gpd_regions.crs.equals(crs)):
+		gpd_regions = gpd_regions.to_crs(crs)
+	return gpd.GeoDataFrame({'region': gpd_regions[regionname].astype(str).values}, geometry = gpd_regions.geometry.values, crs = crs)
+
+
+def partition_polygons(poly, gpd_regions):
+	""" Assigns polygons to all regions they intersect with one spatial join
+
+	:param poly: GeoDataFrame of polygons
+	:param gpd_regions: GeoDataFrame of region masks with column 'region' (see read_regions), same crs as poly
+
+	RETURN
+	dictionary {region name: index labels of polygons in poly}, each polygon only once per region
+	"""
+	join = gpd.sjoin(gpd_regions, poly, how = 'inner', predicate = 'intersects')
+	# regions with several mask polygons return the same polygon once per mask polygon
+	join = join[['region', 'index_right']].drop_duplicates()
+	groups = join.groupby('region', sort = False)['index_right']
+	return {name: groups.get_group(name).to_numpy() if name in groups.groups else poly.index[:0].to_numpy()
+		for name in pd.unique(gpd_regions['region'])}
+
+
+@profiling.stage('combine_regions')
+def combine_regions(fname_poly, fname_data, featurelist, regions, outpath, indexname = 'SA1_CODE7', regionname = 'region',
+	suffix = '', ext = '.gpkg'):
+	""" Combines feature data with polygons of all regions (as combine_geodata for each region mask),
+	polygon boundaries and data table are read only once.
+	Combined file and mask of each region are saved to the paths given by region_paths.
+
+	:param fname_poly: path+filename of polygons (.shp, .gpkg or .parquet)
+	:param fname_data: data table (.csv) with features (columns) for each polygon (rows)
+	:param featurelist: list of feature names in header of fname_data
+	:param regions: dictionary {region name: mask file} or path+filename of mask layer with region names in column regionname
+	:param outpath: output path, each region is saved in subfolder outpath/<region>/
+	:param indexname: name of index that is shared between polygons and data table
+	:param regionname: name of column with region names in mask layer
+	:param suffix: suffix of output filenames, e.g. census year '16'
+	:param ext: extension of combined files: '.gpkg' or '.parquet' (GeoParquet boundary store)
+
+	RETURN
+	Feature list of combined files (see combine_geodata)
+	"""
+	poly_crs = vector_info(fname_poly)[0]
+	gpd_regions = read_regions(regions, poly_crs, regionname = regionname)
+	# Read only index and area column of polygons within bounding box of all regions
+	poly = read_polygons(fname_poly, columns = [indexname, 'AREASQKM'], bbox = tuple(gpd_regions.total_bounds))
+	poly[indexname] = poly[indexname].astype(str)
+	df = pd.read_csv(fname_data, usecols = [indexname] + featurelist, dtype = {indexname: str})
+	df[indexname] = df[indexname].astype(str)
+	print('Partitioning ' + str(len(poly)) + ' polygons to ' + str(gpd_regions['region'].nunique()) + ' regions ...')
+	parts = partition_polygons(poly, gpd_regions)
+	comb, featurelist_comb = merge_features(poly, df, featurelist, indexname)
+	for name, index in parts.items():
+		fname_comb, fname_mask, rasterpath = region_paths(outpath, name, suffix = suffix, ext = ext)
+		if not os.path.exists(os.path.dirname(fname_comb)):
+			os.makedirs(os.path.dirname(fname_comb), exist_ok = True)
+		print('Saving ' + str(len(index)) + ' polygons of region ' + str(name) + ' to ' + fname_comb + ' ...')
+		# select by key, so that the result does not depend on the row order of the merge
+		write_polygons(comb[comb[indexname].isin(poly.loc[index, indexname])], fname_comb)
+		gpd_regions[gpd_regions['region'] == name].to_file(fname_mask, driver = 'GPKG')
+	return featurelist_comb
+
+
+def add_region_tasks(graph, fname_poly, fname_data, featurelist, regions, outpath, indexname = 'SA1_CODE7', regionname = 'region',
+	suffix = '', ext = '.gpkg', **kwargs):
+	""" Adds task combine_regions<suffix> and one rasterization task raster<suffix>_<region> per region to TaskGraph
+	(see combine_regions for parameters), rasters are saved in outpath/<region>/Raster<suffix>/
+
+	:param graph: TaskGraph
+	:param kwargs: parameters of poly2raster, e.g. pixsize, engine
+
+	RETURN
+	list of names of rasterization tasks
+	"""
+	names = region_names(regions, regionname = regionname)
+	fnames_mask = list(regions.values()) if isinstance(regions, dict) else [regions]
+	files = {name: region_paths(outpath, name, suffix = suffix, ext = ext) for name in names}
+	task = graph.add('combine_regions' + suffix, combine_regions, fname_poly, fname_data, list(featurelist), regions, outpath,
+		indexname = indexname, regionname = regionname, suffix = suffix, ext = ext, inputs = [fname_poly, fname_data] + fnames_mask,
+		outputs = [fname for fname_comb, fname_mask, rasterpath in files.values() for fname in [fname_comb, fname_mask]])
+	pixsizes = kwargs.get('pixsize', 100)
+	pixsizes = pixsizes if isinstance(pixsizes, (list, tuple)) else [pixsizes]
+	tasks = []
+	for name, (fname_comb, fname_mask, rasterpath) in files.items():
+		if not os.path.exists(rasterpath):
+			os.makedirs(rasterpath)
+		tasks.append(graph.add('raster' + suffix + '_' + region_label(name), poly2raster, fname_comb, rasterpath, graph.result(task),
+			polymask = fname_mask, inputs = [fname_comb, fname_mask],
+			outputs = [rasterpath + 'raster_' + str(int(pix)) + 'm_*.tif' for pix in pixsizes], **kwargs))
+	return tasks
+
+
+def batch_regions(fname_poly, fname_data, featurelist, regions, outpath, indexname = 'SA1_CODE7', regionname = 'region',
+	suffix = '', ext = '.gpkg', workers = 4, manifest = None, **kwargs):
+	""" Combines and rasterizes polygons of all regions, boundaries are read once and regions are rasterized in parallel
+	(see combine_regions and add_region_tasks for parameters)
+
+	:param workers: number of worker processes
+	:param manifest: path+filename of build manifest to skip unchanged regions (optional, see lib/pipeline.py)
+	:param kwargs: parameters of poly2raster, e.g. pixsize, engine
+
+	RETURN
+	Dictionary with results of finished tasks
+	"""
+	graph = TaskGraph(manifest = manifest)
+	add_region_tasks(graph, fname_poly, fname_data, featurelist, regions, outpath, indexname = indexname, regionname = regionname,
+		suffix = suffix, ext = ext, **kwargs)
+	return graph.run(workers = workers)
@@ -0,0 +1,185 @@
+# Compact raster representation with values of valid pixels only
+"""
+Author: Sebastian Haan
+Affiliation: Sydney Information Hub, The University of Sydney
+
+Comments:
+For irregular study areas (e.g. Greater Sydney mask) most pixels of the bounding-box grid are no-data.
+A SparseGrid stores the flat positions of the valid pixels of a grid once, a SparseRaster only the values at these positions,
+so computations scale with the number of valid pixels instead of the bounding box.
+Dense arrays are only created when writing GeoTiffs (SparseRaster.write).
+Raster expressions are the same as for lib/rastercalc.py (e.g. EXPR_DIFF, EXPR_RELDIFF, EXPR_PROD).
+
+Example:
+a = read_sparse('raster_100m_LOW_16.tif')
+b = read_sparse('raster_100m_LOW_06.tif')
+evaluate(EXPR_DIFF, A = a, B = b).write('rasterchange_2016-2006_LOW_100m.tif')
+"""
+
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio import Affine
+from rasterio.windows import Window
+from .rasterize import write_raster
+from .rastercalc import _NUMPY_NAMESPACE
+
+
+class SparseGrid:
+	""" Valid pixels of a raster grid
+
+	:param index: sorted flat positions (row * width + col) of valid pixels
+	:param transform: affine transform of grid
+	:param shape: shape of grid (height, width)
+	:param crs: coordinate reference system of grid
+	"""
+	def __init__(self, index, transform, shape, crs):
+		self.index = np.asarray(index, dtype = np.int64)
+		self.transform = transform
+		self.shape = tuple(shape)
+		self.crs = crs
+
+	def __len__(self):
+		return len(self.index)
+
+	@classmethod
+	def from_mask(cls, mask, transform, crs):
+		""" Grid of pixels where 2D boolean array mask is True
+		"""
+		return cls(np.flatnonzero(mask), transform, mask.shape, crs)
+
+	def rowcol(self):
+		""" Row and column of valid pixels
+		"""
+		return np.divmod(self.index, self.shape[1])
+
+	def xy(self):
+		""" Coordinates of pixel centres of valid pixels in crs of grid
+		"""
+		rows, cols = self.rowcol()
+		return self.transform * (cols + 0.5, rows + 0.5)
+
+	def same_grid(self, other):
+		""" True if other has the same raster grid (valid pixels may differ)
+		"""
+		return (self.shape == other.shape) and self.transform.almost_equals(other.transform) and (self.crs == other.crs)
+
+	def subset(self, sel):
+		""" Grid of valid pixels selected by boolean array or positions sel
+		"""
+		return SparseGrid(self.index[sel], self.transform, self.shape, self.crs)
+
+	def coarsen(self, factor):
+		""" Grid with factor times larger pixels (same origin), valid where any of its pixels is valid
+
+		RETURN
+		SparseGrid, position of coarse pixel in new grid for each valid pixel of this grid (e.g. for np.bincount)
+		"""
+		rows, cols = self.rowcol()
+		shape = (-(-self.shape[0] // factor), -(-self.shape[1] // factor))
+		index, inverse = np.unique((rows // factor) * shape[1] + cols // factor, return_inverse = True)
+		return SparseGrid(index, self.transform * Affine.scale(factor), shape, self.crs), inverse
+
+
+class SparseRaster:
+	""" Raster values of valid pixels of a SparseGrid
+
+	:param grid: SparseGrid
+	:param values: array with shape (number of valid pixels) or (bands, number of valid pixels)
+	:param descriptions: list of band descriptions (optional)
+	"""
+	def __init__(self, grid, values, descriptions = None):
+		values = np.asarray(values, dtype = float)
+		if values.shape[-1] != len(grid):
+			raise ValueError('SparseRaster: number of values ' + str(values.shape[-1]) + ' differs from valid pixels ' + str(len(grid)))
+		self.grid = grid
+		self.values = values
+		self.descriptions = descriptions
+
+	@classmethod
+	def from_dense(cls, data, transform, crs, descriptions = None):
+		""" Sparse raster of 2D array (or 3D with bands first), pixels that are NaN in all bands are not stored
+		"""
+		data = np.asarray(data, dtype = float)
+		valid = np.isfinite(data) if data.ndim == 2 else np.isfinite(data).any(axis = 0)
+		grid = SparseGrid.from_mask(valid, transform, crs)
+		return cls(grid, data.reshape(data.shape[:-2] + (-1,))[..., grid.index], descriptions = descriptions)
+
+	def to_dense(self):
+		""" Array with shape of grid (bands first for multiband rasters), NaN for no-data
+		"""
+		data = np.full(self.values.shape[:-1] + (self.grid.shape[0] * self.grid.shape[1],), np.nan)
+		data[..., self.grid.index] = self.values
+		return data.reshape(self.values.shape[:-1] + self.grid.shape)
+
+	def write(self, fname, nodataval = -9999, profile = 'default'):
+		""" Writes raster as GeoTiff (see write_raster in lib/rasterize.py)
+		"""
+		write_raster(fname, self.to_dense(), self.grid.transform, self.grid.crs, nodataval = nodataval,
+			descriptions = self.descriptions, profile = profile)
+
+	def to_points(self, zfilter = None):
+		""" Dataframe with columns X,Y,Z of pixel centres (in crs of grid) and values of valid pixels (first band)
+
+		:param zfilter: only values above treshold value are included (optional)
+		"""
+		values = self.values if self.values.ndim == 1 else self.values[0]
+		sel = np.isfinite(values)
+		if zfilter is not None:
+			sel &= values > zfilter
+		xpos, ypos = self.grid.subset(sel).xy()
+		return pd.DataFrame({'X': xpos, 'Y': ypos, 'Z': values[sel]})
+
+
+def read_sparse(fname, band = 1, blocksize = 2**20):
+	""" Reads one band of raster file in strips of rows and keeps only valid pixels (scale/offset of file metadata applied),
+	so memory scales with the number of valid pixels plus one strip
+
+	:param fname: path + filename of raster
+	:param band: band number (starting with 1)
+	:param blocksize: approximate number of pixels read at once (strips are multiples of the block height of the file)
+
+	RETURN
+	SparseRaster
+	"""
+	index, values = [], []
+	with rasterio.open(fname) as src:
+		width = src.width
+		scale, offset = src.scales[band - 1], src.offsets[band - 1]
+		block_height = src.block_shapes[band - 1][0]
+		nrows = max(1, blocksize // (width * block_height)) * block_height
+		for row in range(0, src.height, nrows):
+			window = Window(0, row, width, min(nrows, src.height - row))
+			data = src.read(band, window = window, masked = True)
+			valid = ~np.ma.getmaskarray(data) & np.isfinite(data.data)
+			index.append(np.flatnonzero(valid) + row * width)
+			values.append(data.data[valid].astype(float) * scale + offset)
+		desc = src.descriptions[band - 1]
+		grid = SparseGrid(np.concatenate(index), src.transform, src.shape, src.crs)
+	return SparseRaster(grid, np.concatenate(values), descriptions = [desc] if desc is not None else None)
+
+
+def evaluate(expr, **inputs):
+	""" Evaluates numpy expression on sparse rasters on the same grid (same as RasterExpr in lib/rastercalc.py):
+	pixels that are no-data in any input or not finite in the result are no-data
+
+	:param expr: numpy expression as string with input names as variables, e.g. EXPR_DIFF from lib/rastercalc.py
+	:param inputs: input names and SparseRasters, e.g. A = read_sparse('raster1.tif')
+
+	RETURN
+	SparseRaster
+	"""
+	rasters = list(inputs.values())
+	grid = rasters[0].grid
+	index = grid.index
+	for raster in rasters[1:]:
+		if not grid.same_grid(raster.grid):
+			raise ValueError('evaluate: input rasters are not on the same grid')
+		index = np.intersect1d(index, raster.grid.index, assume_unique = True)
+	namespace = dict(_NUMPY_NAMESPACE)
+	for name, raster in inputs.items():
+		namespace[name] = raster.values[..., np.searchsorted(raster.grid.index, index)]
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		result = np.broadcast_to(np.asarray(eval(expr, namespace), dtype = float), index.shape)
+	valid = np.isfinite(result)
+	return SparseRaster(SparseGrid(index[valid], grid.transform, grid.shape, grid.crs), result[valid])
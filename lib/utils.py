@@ -9,41 +9,80 @@ import pandas as pd
 from scipy.interpolate import interp1d
 
 
-def calc_weights(bins, ubins, perc, pop):
+# Default breakpoints of new income bins relative to median income: 
+# very low (<50%), low (50-80%), moderate (80-120%), high (120-200%) and very high (>200%)
+INCOME_STEPS = [0., 0.5, 0.8, 1.2, 2., 100]
+
+
+def interval_weights(bins, ubins, breakpoints):
+	"""
+	Calculate the overlap matrix of old bins with new bins: weight of old bin j in new bin i is the fraction of
+	interval [bins[j], ubins[j]] that lies within [breakpoints[i], breakpoints[i+1]] (population uniform within each old bin).
+	All inputs can have leading batch dimensions (e.g. regions or years) that are broadcast against each other, 
+	so weight matrices for many regions are computed in one call.
+	:param bins: lower boundary of old bins, shape (..., Nbinsold)
+	:param ubins: upper boundary of old bins, shape (..., Nbinsold)
+	:param breakpoints: increasing boundaries of new bins, shape (..., Nbinsnew + 1)
+	RETURN
+	weights with shape (..., Nbinsnew, Nbinsold)
+	"""
+	bins = np.asarray(bins, dtype = float)[..., None, :]
+	ubins = np.asarray(ubins, dtype = float)[..., None, :]
+	breakpoints = np.asarray(breakpoints, dtype = float)
+	lower = breakpoints[..., :-1, None]
+	upper = breakpoints[..., 1:, None]
+	overlap = np.clip(np.minimum(ubins, upper) - np.maximum(bins, lower), 0., None)
+	width = ubins - bins
+	return np.divide(overlap, width, out = np.zeros(np.broadcast(overlap, width).shape), where = width > 0)
+
+
+def median_income(ubins, perc):
+	"""
+	Median income by linear interpolation of upper bin boundaries at the 50% percentile, 
+	same as interp1d(perc, ubins)(50) but for any number of leading batch dimensions (regions)
+	:param ubins: upper boundary of bins, shape (..., Nbins)
+	:param perc: Cumulative percentage of income bin, shape (..., Nbins)
+	"""
+	perc = np.asarray(perc, dtype = float)
+	ubins = np.broadcast_to(np.asarray(ubins, dtype = float), perc.shape)
+	# first bin that reaches 50% and the bin before
+	i1 = np.argmax(perc >= 50, axis = -1)[..., None]
+	i0 = np.maximum(i1 - 1, 0)
+	x0, x1 = np.take_along_axis(perc, i0, -1)[..., 0], np.take_along_axis(perc, i1, -1)[..., 0]
+	y0, y1 = np.take_along_axis(ubins, i0, -1)[..., 0], np.take_along_axis(ubins, i1, -1)[..., 0]
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		med = np.where(x1 > x0, y0 + (50. - x0) * (y1 - y0) / (x1 - x0), y1)
+	# no valid median for regions without population
+	return np.where(np.isfinite(perc).all(axis = -1) & (perc[..., -1] >= 50), med, np.nan)
+
+
+def calc_weights(bins, ubins, perc, pop, steps = INCOME_STEPS, breakpoints = None):
 	"""
 	Calculate the transformtaion matrix to convert income bins to customised bins 
-	(see/change incsteps below)
+	(default: 5 bins relative to median, see INCOME_STEPS).
+	perc and pop can have a leading dimension for regions (or years), then weights are computed for all regions at once
+	with each region's own median.
 	:param bins: lower boundary of bins
 	:param ubins: upper boundary of bins
-	:param perc: Cumulative percentage of income bin
-	:param pop: Population in each income bin
+	:param perc: Cumulative percentage of income bin, shape (Nbinsold) or (Nregions, Nbinsold)
+	:param pop: Population in each income bin, same shape as perc
+	:param steps: boundaries of new bins relative to median income
+	:param breakpoints: absolute boundaries of new bins (optional), if given steps and median are not used for the bins
+	RETURN
+	weights with shape (Nbinsnew, Nbinsold) or (Nregions, Nbinsnew, Nbinsold)
+	population percentage in new bins
+	median income
 	"""
 	# calculate median:
-	fit = interp1d(perc, ubins, kind = 'linear')
-	med = fit(50).mean()
-	# calcualte conversion matrix from income bin to new 5 bins relative to median:
-	incsteps = np.asarray([0., 0.5, 0.8, 1.2, 2.,100]) * med
-	# total population number:
-	pop_total = np.sum(pop)
-	# initialise weight matrix:
-	weights = np.zeros((5, len(bins)))
-	perc_pop = np.zeros(5)
-	# calculating weight matrix:
-	for i in range(len(incsteps)-1):
-		for j in range(len(bins)):
-			if (bins[j] > incsteps[i]) & (ubins[j] < incsteps[i+1]):
-				weights[i, j] = 1.
-			elif (bins[j] > incsteps[i]) & (bins[j] < incsteps[i+1]) & (ubins[j] > incsteps[i+1]):
-				weights[i, j] = (incsteps[i+1] - bins[j]) / (ubins[j] - bins[j])
-			elif (bins[j] < incsteps[i]) & (ubins[j] > incsteps[i]) & (ubins[j] < incsteps[i+1]):
-				weights[i, j] = (ubins[j] - incsteps[i]) / (ubins[j] - bins[j])
-			elif (bins[j] < incsteps[i]) & (ubins[j] > incsteps[i+1]):
-				weights[i, j] = (incsteps[i+1] - incsteps[i]) / (ubins[j] - bins[j])
-			else:
-				weights[i, j] = 0.
-		# calculate population percentage for the new customised bins:
-		perc_pop[i] = np.dot(weights[i], pop)
-	perc_pop = np.round((perc_pop / pop_total * 100.), 2)
+	med = median_income(ubins, perc)
+	# calcualte conversion matrix from income bins to new bins:
+	if breakpoints is None:
+		breakpoints = np.asarray(steps, dtype = float) * med[..., None]
+	weights = interval_weights(bins, ubins, breakpoints)
+	# calculate population percentage for the new customised bins:
+	pop = np.asarray(pop, dtype = float)
+	perc_pop = np.einsum('...ij,...j->...i', weights, pop)
+	perc_pop = np.round((perc_pop / np.sum(pop, axis = -1)[..., None] * 100.), 2)
 	return weights, perc_pop, np.round(med, 1)
 
 def lin_transform(df, Aw, newcol_names = None, decround=None):
@@ -52,24 +91,19 @@ def lin_transform(df, Aw, newcol_names = None, decround=None):
 	With * the dot product (each new bin is sum of old bins multiplied with esepctive weight)
 	Weight can be calculated first with function calc_weight()
 	:input df: Pandas dataframe with original income bins (oldbins), first column should be anindex
-	:param Aw: weight matrix with shape (newbins, oldbins)
+	:param Aw: weight matrix with shape (newbins, oldbins), or (rows, newbins, oldbins) with one weight matrix for each row of df
 	:param newcol_names: define new column names, e.g. ['bin1', 'bin2', 'bin3',...], same number as length of bins
 	:param decround: number of decimals after comma to round final dataframe
 	"""
+	Nbinsnew, Nbinsold = Aw.shape[-2], Aw.shape[-1]
 	if newcol_names is None:
-		newcol_names = []
-		for i in range(Nbinsnew):
-			newcol_names = np.append(newcol_names, 'Bin' + str(int(i)))
+		newcol_names = ['Bin' + str(int(i)) for i in range(Nbinsnew)]
 	newcol_names = np.asarray(newcol_names).astype(str)
-	Nbinsnew, Nbinsold = Aw.shape[0], Aw.shape[1]
-	data = df.iloc[:,1 : Nbinsold + 1].to_numpy()
+	data = df.iloc[:,1 : Nbinsold + 1].to_numpy().astype(float)
 	index = list(df)[0]
 	newdf = df[[index]].copy()
-	#newdf = df.copy()
-	#newdata = np.zeros((len(data), Nbinsnew))
-	#for i in range(len(data)):
-	#	newdata[i] = np.dot(Aw, data[i])
-	newdata = np.dot(Aw, data.T).T
+	# one weight matrix for all rows or one per row (batched, shape (rows, newbins, oldbins))
+	newdata = np.einsum('...ij,...j->...i', Aw, data)
 	# include in dataframe
 	total = np.nansum(newdata, axis = 1)
 	#newdata = newdata / total.reshape(-1,1)
@@ -17,29 +17,92 @@ see also https://docs.mapbox.com/help/troubleshooting/how-to-use-mapbox-securely
 
 import os
 import subprocess
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 import pydeck as pdk
 import rasterio
+from rasterio import Affine
+from rasterio.enums import Resampling
+from rasterio.warp import transform as warp_transform, calculate_default_transform, transform_bounds
+from rasterio.windows import Window, from_bounds
 from matplotlib import pyplot as plt
 from matplotlib import cm
 from matplotlib import colors
 from matplotlib.colors import LogNorm
+from .rasterize import block_reduce
+from .sparseraster import read_sparse
+from . import profiling
 
 
 
+# Pixel mappings for reprojection, computed once per source grid and target crs (see reprojection_index)
+_REPROJECTION_CACHE = {}
+
+def reprojection_index(src_crs, src_transform, src_shape, crs_out = 'EPSG:4326'):
+    """nearest neighbour mapping of output pixels to source pixels for reprojection of grid into crs_out 
+    (same output grid and resampling as gdalwarp -t_srs). The mapping is cached, so all rasters on the same grid 
+    are reprojected with one coordinate transformation.
+    :param src_crs: crs of source grid
+    :param src_transform: affine transform of source grid
+    :param src_shape: shape of source grid (height, width)
+    :param crs_out: string of ccordinate reference system (crs) in EPSG fromat e.g. 'EPSG:4326'
+
+    RETURN
+    output transform, output shape, index of source pixel for each output pixel (flat, -1 outside source grid)
+    """
+    key = (str(src_crs), tuple(src_transform), tuple(src_shape), crs_out)
+    if key in _REPROJECTION_CACHE:
+        return _REPROJECTION_CACHE[key]
+    height, width = src_shape
+    left, top = src_transform * (0, 0)
+    right, bottom = src_transform * (width, height)
+    dst_transform, dst_width, dst_height = calculate_default_transform(src_crs, crs_out, width, height, 
+        left = left, bottom = bottom, right = right, top = top)
+    # Centres of output pixels in source crs
+    rows, cols = np.divmod(np.arange(dst_height * dst_width), dst_width)
+    xpos, ypos = dst_transform * (cols + 0.5, rows + 0.5)
+    xpos, ypos = warp_transform(crs_out, src_crs, xpos, ypos)
+    src_cols, src_rows = ~src_transform * (np.asarray(xpos), np.asarray(ypos))
+    src_cols, src_rows = np.floor(src_cols).astype(np.int64), np.floor(src_rows).astype(np.int64)
+    inside = (src_cols >= 0) & (src_cols < width) & (src_rows >= 0) & (src_rows < height)
+    index = np.where(inside, src_rows * width + src_cols, -1)
+    _REPROJECTION_CACHE[key] = (dst_transform, (dst_height, dst_width), index)
+    return _REPROJECTION_CACHE[key]
+
+
 # First transform image into Lat/Lng coorindate system
-def transform_crs(fname_in, fname_out, crs_out = 'EPSG:4326'):
-    """transforms raster coordinate system into new crs
+def transform_crs(fname_in, fname_out, crs_out = 'EPSG:4326', nodataval = -9999):
+    """transforms raster coordinate system into new crs (in-process, nearest neighbour as gdalwarp default). 
+    The pixel mapping is computed once for each grid (see reprojection_index), all bands are then reprojected by array indexing.
     :param fname_in: input path and filename 
     :param fname_in: ouput path and filename
     :param crs_out: string of ccordinate reference system (crs) in EPSG fromat e.g. 'EPSG:4326'
+    :param nodataval: value for no-data pixels in output if input has no no-data value (Default: -9999), 
+        otherwise the no-data value of the input is kept (e.g. for scaled int16 outputs, where -9999 can be a valid value)
     """
-    str_op = "gdalwarp -overwrite -srcnodata '-9999' -dstnodata '-9999' -q -t_srs "
-    cmd = subprocess.call(str_op + crs_out + ' ' + fname_in + ' ' + fname_out, shell=True)
+    with rasterio.open(fname_in) as src:
+        dst_transform, dst_shape, index = reprojection_index(src.crs, src.transform, src.shape, crs_out)
+        data = src.read()
+        nodata = src.nodata if src.nodata is not None else nodataval
+        profile = src.profile.copy()
+        scales, offsets, descriptions = src.scales, src.offsets, src.descriptions
+    inside = index >= 0
+    result = np.full((data.shape[0], dst_shape[0] * dst_shape[1]), nodata, dtype = data.dtype)
+    result[:, inside] = data.reshape(data.shape[0], -1)[:, index[inside]]
+    for key in ['blockxsize', 'blockysize', 'tiled']:
+        profile.pop(key, None)
+    profile.update(driver = 'GTiff', crs = crs_out, transform = dst_transform, height = dst_shape[0], width = dst_shape[1], nodata = nodata)
+    with rasterio.open(fname_out, 'w', **profile) as dst:
+        dst.write(result.reshape(data.shape[0], dst_shape[0], dst_shape[1]))
+        dst.scales, dst.offsets = scales, offsets
+        for i, desc in enumerate(descriptions):
+            if desc:
+                dst.set_band_description(i + 1, desc)
 
 def raster2csv(input_file, path_out, fname_out, nodataval = -9999, zfilter = None):
-    """transforms raster coordinate system into new crs
+    """saves cell centres (in crs of raster) and values of all valid raster cells as csv file
+    Only valid cells are read and written (see read_sparse in lib/sparseraster.py)
     :param input_file: input path and filename of raster tif file ()
     :param path_out: path for output filen
     :param fname_out: output filename, should end with .csv
@@ -49,21 +112,75 @@ def raster2csv(input_file, path_out, fname_out, nodataval = -9999, zfilter = Non
     saves csv file with header X,Y,Z
     """
     if not os.path.exists(path_out):
-        os.makedirs(outpath)
-    str_op = "gdal_translate -r average -a_nodata " + str(nodataval) + " -epo -unscale -q -of xyz -co ADD_HEADER_LINE=YES -co COLUMN_SEPARATOR=',' "
-    if zfilter is None: 
-        cmd = subprocess.call(str_op + input_file + ' ' + path_out + fname_out, shell=True)
+        os.makedirs(path_out)
+    points = read_sparse(input_file).to_points(zfilter = zfilter)
+    points = points[points.Z != nodataval]
+    points.to_csv(path_out + fname_out, index = False)
+
+
+def raster2points(input_file, nodataval = -9999, zfilter = None, crs_out = 'EPSG:4326', factor = 1, aggregate = 'mean', clipbox = None):
+    """extracts cell centres and values of all valid raster cells (alternative to raster2csv without intermediate files)
+    Only the centres of valid cells are transformed to crs_out, the raster itself is not reprojected.
+    :param input_file: input path and filename of raster tif file
+    :param nodataval: exclude valuse of nodata
+    :param zfilter: values below treshold value are excluded
+    :param crs_out: string of ccordinate reference system (crs) of cell centres, default 'EPSG:4326' (Lng, Lat)
+    :param factor: aggregation factor, cells are blocks of factor x factor raster pixels (default 1: no aggregation)
+    :param aggregate: aggregation of valid pixels in block, 'mean' or 'sum'
+    :param clipbox: [min_lng, max_lng, min_lat, max_lat] (in crs_out), only cells with centre inside box are returned (optional)
+
+    RETURN
+    Dataframe with columns X,Y,Z, bounding box of raster in crs_out, cell size
+    """
+    with rasterio.open(input_file) as raster:
+        rasterdata = raster.read(1, masked = True)
+        zval = rasterdata.data.astype(float) * raster.scales[0] + raster.offsets[0]
+        zval[np.ma.getmaskarray(rasterdata) | (zval == nodataval)] = np.nan
+        transform = raster.transform
+        if factor > 1:
+            # pad to multiple of factor so that border pixels are included in aggregation
+            height, width = -(-zval.shape[0] // factor) * factor, -(-zval.shape[1] // factor) * factor
+            zval = np.pad(zval, ((0, height - zval.shape[0]), (0, width - zval.shape[1])), constant_values = np.nan)
+            zval = block_reduce(zval, factor, interpol = 'average' if aggregate == 'mean' else aggregate)
+            transform = transform * Affine.scale(factor)
+        valid = np.isfinite(zval)
+        if zfilter is not None:
+            valid &= zval > zfilter
+        rows, cols = np.nonzero(valid)
+        # cell centres from affine transform
+        xpos, ypos = transform * (cols + 0.5, rows + 0.5)
+        bbox = raster.bounds
+        if (raster.crs is not None) and (raster.crs != rasterio.crs.CRS.from_user_input(crs_out)):
+            xpos, ypos = warp_transform(raster.crs, crs_out, xpos, ypos)
+            xbox, ybox = warp_transform(raster.crs, crs_out, [bbox[0], bbox[2], bbox[0], bbox[2]], [bbox[1], bbox[1], bbox[3], bbox[3]])
+            bbox = [min(xbox), min(ybox), max(xbox), max(ybox)]
+        # cell size in meters for GridCellLayer (100m if raster is not projected)
+        cellsize = abs(transform.a) if (raster.crs is not None) and raster.crs.is_projected else 100. * factor
+    # coordinates rounded to 6 decimals (< 1m for Lng/Lat) to keep html output small
+    data = pd.DataFrame({'X': np.round(xpos, 6), 'Y': np.round(ypos, 6), 'Z': zval[valid]})
+    if clipbox is not None:
+        data = data[(data.X >= clipbox[0]) & (data.X <= clipbox[1]) & (data.Y >= clipbox[2]) & (data.Y <= clipbox[3])].reset_index(drop = True)
+    return data, bbox, cellsize
+
+def colormap_rgba(values, cmap = 'viridis', clip_percentile = 99, vmax = None):
+    """maps values to RGBA colors (uint8), values above percentile clip_percentile are clipped
+    :param values: array of values
+    :param cmap: matplotlub color map to use, default 'viridis'
+    :param clip_percentile: percentile for upper limit of color scale
+    :param vmax: upper limit of color scale (optional, e.g. to use same colors for several layers), replaces clip_percentile
+
+    RETURN
+    Dataframe with columns R,G,B,A
+    """
+    cmap = plt.get_cmap(cmap)
+    # Clip and normalise colorscheme:  
+    if vmax is None:
+        colval = np.minimum(values, np.percentile(values, clip_percentile)).astype(float)
+        colval /= colval.max()
     else:
-        # Write temporary file first and then filter rows that are above treshold and are finite
-        cmd = subprocess.call(str_op + input_file + ' ' + path_out + 'temp.csv', shell=True)
-        if cmd == 0:
-            temp = pd.read_csv(path_out + 'temp.csv')
-            temp = temp[(temp.Z != nodataval) & (temp.Z > zfilter) & (~temp.Z.isnull()) & (~temp.X.isnull()) & (~temp.Y.isnull())]
-            temp.to_csv(path_out + fname_out, index = False)
-            # Clean up:
-            os.remove(path_out + 'temp.csv')
-    if cmd != 0:
-        print('raster2csv failed!')
+        colval = np.minimum(values, vmax).astype(float) / vmax
+    colrgb = cmap(colval, bytes = True)
+    return pd.DataFrame(colrgb, columns = ['R', 'G', 'B', 'A'])
 
 def simplemap2d(fname_in, fname_out, zoombox = None, logscale = False, nodataval = -9999, show = False, cmap= 'viridis', dpi = 300):
     """plot image in static 2D and save as png
@@ -79,7 +196,9 @@ def simplemap2d(fname_in, fname_out, zoombox = None, logscale = False, nodataval
     #rasterio.plot.show(fname_in, cmap = cmap) #
     # Use instead matplotlib version
     raster = rasterio.open(fname_in)
-    rasterdata = raster.read(1) 
+    # read as float with scale factor applied (e.g. for int16 outputs)
+    rasterdata = raster.read(1, masked = True)
+    rasterdata = (rasterdata.astype(float) * raster.scales[0] + raster.offsets[0]).filled(np.nan)
     # remove nodata values and replcae wigth nan values (ignored by matplotlib)
     rasterdata[rasterdata == nodataval] = np.nan
     if logscale & (np.nanmin(rasterdata) <= 0):
@@ -105,12 +224,168 @@ def simplemap2d(fname_in, fname_out, zoombox = None, logscale = False, nodataval
     if show: 
         plt.show()
 
-def webmap3d(input_file, path_out, fname_out, featurename = 'Z', zfilter = None, nodataval = -9999, cmap= 'viridis', mbkey = None):
+def read_map2d(fname_in, zoombox = None, nodataval = -9999, max_size = None):
+    """reads raster data for 2D map, only the zoombox window is read and, if the raster is larger than max_size, 
+    it is read at reduced resolution (using overviews if available)
+    :param fname_in: input path and filename of raster tif file 
+    :param zoombox: [min_lng, max_lng, min_lat, max_lat] (optional)
+    :param nodataval: exclude valuse of nodata
+    :param max_size: maximum number of pixels in width and height (optional)
+
+    RETURN
+    data as float with NaN for nodata, extent [xmin, xmax, ymin, ymax]
+    """
+    with rasterio.open(fname_in) as raster:
+        window = Window(0, 0, raster.width, raster.height)
+        if zoombox is not None:
+            # zoom window with one pixel margin, cropped to raster
+            zoom = from_bounds(zoombox[0], zoombox[2], zoombox[1], zoombox[3], raster.transform)
+            col0, row0 = int(np.floor(zoom.col_off)) - 1, int(np.floor(zoom.row_off)) - 1
+            zoom = Window(col0, row0, int(np.ceil(zoom.col_off + zoom.width)) + 1 - col0, int(np.ceil(zoom.row_off + zoom.height)) + 1 - row0)
+            try:
+                window = zoom.intersection(window)
+            except Exception:
+                # zoombox outside of raster
+                pass
+        height, width = int(window.height), int(window.width)
+        if (max_size is not None) and (max(height, width) > max_size):
+            reduce = max(height, width) / max_size
+            height, width = max(1, int(round(height / reduce))), max(1, int(round(width / reduce)))
+        rasterdata = raster.read(1, window = window, out_shape = (height, width), masked = True, resampling = Resampling.nearest)
+        # read as float with scale factor applied (e.g. for int16 outputs)
+        rasterdata = (rasterdata.astype(float) * raster.scales[0] + raster.offsets[0]).filled(np.nan)
+        bb = raster.window_bounds(window)
+    # remove nodata values and replcae wigth nan values (ignored by matplotlib)
+    rasterdata[rasterdata == nodataval] = np.nan
+    return rasterdata, [bb[0],bb[2],bb[1],bb[3]]
+
+
+# Value range of rasters of current process (see raster_range)
+_RANGES = {}
+
+def raster_range(fname_in, nodataval = -9999):
+    """minimum, maximum and minimum of positive values of first band of entire raster (read block by block, scale factor applied), 
+    computed once per file and modification time
+    :param fname_in: input path and filename of raster tif file 
+    :param nodataval: exclude valuse of nodata
+
+    RETURN
+    minimum, maximum, minimum of positive values (NaN if no valid values)
+    """
+    key = (os.path.abspath(fname_in), os.stat(fname_in).st_mtime_ns, nodataval)
+    if key in _RANGES:
+        return _RANGES[key]
+    vmin, vmax, vmin_pos = np.inf, -np.inf, np.inf
+    with rasterio.open(fname_in) as raster:
+        for _, window in raster.block_windows(1):
+            block = raster.read(1, window = window, masked = True)
+            block = (block.astype(float) * raster.scales[0] + raster.offsets[0]).filled(np.nan)
+            block = block[np.isfinite(block) & (block != nodataval)]
+            if len(block) > 0:
+                vmin, vmax = min(vmin, block.min()), max(vmax, block.max())
+                if np.any(block > 0):
+                    vmin_pos = min(vmin_pos, block[block > 0].min())
+    _RANGES[key] = tuple(val if np.isfinite(val) else np.nan for val in (vmin, vmax, vmin_pos))
+    return _RANGES[key]
+
+
+# Figure, image and colorbar of current process, reused for all images rendered with rendermap2d
+_FIGURES = {}
+
+def rendermap2d(fname_in, fname_out, zoombox = None, logscale = False, nodataval = -9999, cmap= 'viridis', dpi = 300):
+    """plot image in static 2D and save as png, same as simplemap2d but only the required window and resolution is read 
+    (see read_map2d) and the figure is reused between calls: only image data, color limits and axis limits are updated.
+    The color scale is the value range of the entire raster (see raster_range), so zoom images have the same colors as the full map.
+    :param fname_in: input path and filename of raster tif file 
+    :param fname_out: path and filenmae for output file (should end in .png)
+    :param zoombox: [min_lng, max_lng, min_lat, max_lat]
+    :param logscale: color scale in log
+    :param nodataval: exclude valuse of nodata
+    :param cmap: matplotlub color map to use, default 'viridis'
+    :param dpi: resolution in dots per inch, default 300
+    """
+    key = (cmap, logscale)
+    if key not in _FIGURES:
+        fig = plt.figure()
+        ax = fig.add_subplot(111)
+        im = ax.imshow(np.full((2, 2), np.nan), cmap = cmap, aspect ='equal', norm = LogNorm() if logscale else None)
+        _FIGURES[key] = (fig, ax, im, fig.colorbar(im))
+    fig, ax, im, cbar = _FIGURES[key]
+    # image pixels are not finer than output pixels
+    max_size = int(max(fig.get_size_inches()) * dpi)
+    rasterdata, ext = read_map2d(fname_in, zoombox = zoombox, nodataval = nodataval, max_size = max_size)
+    vmin, vmax, vmin_pos = raster_range(fname_in, nodataval = nodataval)
+    if logscale:
+        if vmin <= 0:
+            print('rendermap2d logscale WARNING: Data include values smaller than zero.')
+        vmin = vmin_pos
+    im.set_data(rasterdata)
+    im.set_extent(ext)
+    if np.isfinite(vmin) and np.isfinite(vmax):
+        im.set_clim(vmin, vmax)
+    if zoombox is not None:
+        ax.set_xlim(zoombox[0], zoombox[1])
+        ax.set_ylim(zoombox[2], zoombox[3])
+    else:
+        ax.set_xlim(ext[0], ext[1])
+        ax.set_ylim(ext[2], ext[3])
+    cbar.update_normal(im)
+    fig.tight_layout()
+    fig.savefig(fname_out, dpi=dpi)
+
+
+def _map2d_job(fname_raster, zoombox, crs_out):
+    with profiling.stage(os.path.basename(fname_raster), fname = fname_raster):
+        # Fisrt transform to unprojected coordinate system in Lat/Lng
+        fname_raster2 = fname_raster.replace('.tif', '_' + crs_out.replace(':', '').lower() + '.tif')
+        print("Plotting 2D images for rasterfile " + fname_raster2 + " ...")
+        transform_crs(fname_raster, fname_raster2, crs_out = crs_out)
+        # Make image of entire region:
+        rendermap2d(fname_raster2, fname_raster.replace('.tif', '.png'), logscale = False)
+        # Make image of zoomed-in region (sepcified in zbox parameter):
+        if zoombox is not None:
+            rendermap2d(fname_raster2, fname_raster.replace('.tif', '_zoom.png'), zoombox = zoombox)
+
+
+def _init_headless():
+    # worker processes render without display
+    plt.switch_backend('Agg')
+
+
+def make_maps2d(list_fnames, zoombox = None, crs_out = 'EPSG:4326', workers = 1):
+    """Creates 2D map (and zoom map) of each raster file, see rendermap2d. 
+    Rasters are first transformed to crs_out, saved as <name>_epsg4326.tif, images are saved as <name>.png and <name>_zoom.png
+    :param list_fnames: list of raster path and filenames
+    :param zoombox: [min_lng, max_lng, min_lat, max_lat] for zoom image, no zoom image if None
+    :param crs_out: string of ccordinate reference system (crs) in EPSG fromat e.g. 'EPSG:4326'
+    :param workers: number of worker processes (headless matplotlib backend), each rendering all images of one raster
+    """
+    if (workers <= 1) or (len(list_fnames) <= 1):
+        for fname_raster in list_fnames:
+            _map2d_job(fname_raster, zoombox, crs_out)
+        return
+    with ProcessPoolExecutor(max_workers = min(workers, len(list_fnames)), initializer = _init_headless) as pool:
+        # raise exception of first failed job, stages recorded in workers are added to profiling report
+        njob = len(list_fnames)
+        for result, records in pool.map(profiling.collect, [profiling.context()] * njob, [_map2d_job] * njob, list_fnames, 
+            [zoombox] * njob, [crs_out] * njob):
+            profiling.merge(records)
+
+
+@profiling.stage('webmap3d')
+def webmap3d(input_file, path_out, fname_out, featurename = 'Z', zfilter = None, nodataval = -9999, cmap= 'viridis', mbkey = None,
+    lod_levels = None, lod_aggregate = 'mean', lod_box = None):
     """Creates interactive 3D Webmap using pydeck (wrapper for deck.gl), currently limited to positive values only
     Use carefully, still in testing
     Includes following main processing stesp:
-    1) reprojection of cooridnate system to Lng and Lat and extration of grid cell positions in database
+    1) extraction of valid grid cells from raster and transformation of cell centres to Lng and Lat (see raster2points)
     2) Creating webmap with deck.gl
+    For large rasters a level-of-detail pyramid can be created with lod_levels, e.g. [1, 4, 16] for 100m, 400m and 1.6km cells:
+    each level is one layer of the map that is only drawn in the zoom range matched to its cell size 
+    (zoomed-out views show coarse cells, fine cells appear when zooming in), finer levels can be restricted to lod_box.
+    Cells of the coarsest level outside lod_box are drawn at all zooms, so zooming in outside the box still shows data.
+    All levels share the elevation and color scale of the finest level (whole raster): with lod_aggregate 'sum' heights and colors
+    are scaled per raster pixel (sum divided by number of pixels in cell), so the same height is the same density at all levels.
     :param input_file: input path and filename of raster tif file 
     :param path_out: output path, will be also used to save temporary files
     :param fname_out: filenmae for output file (ending.html fill be added automatically)
@@ -120,79 +395,116 @@ def webmap3d(input_file, path_out, fname_out, featurename = 'Z', zfilter = None,
     :param nodataval: exclude valuse of nodata
     :param cmap: matplotlub color map to use, default 'viridis' (others e.g. 'Reds', 'Blues'..)
     :param mbkey: Mapbox key (string), defaults to None if not set
+    :param lod_levels: list of aggregation factors for level-of-detail pyramid (optional), e.g. [1, 4, 16]
+    :param lod_aggregate: aggregation of pixels for coarser levels, 'mean' (e.g. for densities) or 'sum' (e.g. for counts)
+    :param lod_box: [min_lng, max_lng, min_lat, max_lat], levels finer than the coarsest contain only cells inside box (optional)
     """
     if not os.path.exists(path_out):
         os.makedirs(path_out)
-    # Open raster file
-    raster = rasterio.open(input_file)
-    # Check if rasterfile is not projected (not in meters buty in Lat Lng)
-    if raster.crs.is_projected:
-        # If projected, convert to non-projected system for Lat Lng values
-        outputEPSG = 'EPSG:4326'
-        print('Convert raster coordinate system to ' +  outputEPSG + ' ...')
-        fname_raster2 = path_out + fname_out + 't_crsproj.tif'
-        transform_crs(input_file, fname_raster2, crs_out = outputEPSG)
-        raster = rasterio.open(fname_raster2)
+    if lod_levels is None:
+        levels = [1]
     else:
-        fname_raster2 = input_file
-    # Read in raster coordinate info
-    bbox = raster.bounds
+        levels = sorted(lod_levels, reverse = True)
+    # view centre from raster bounds, independent of valid cells of levels
+    with rasterio.open(input_file) as raster:
+        bbox = raster.bounds
+        if (raster.crs is not None) and (raster.crs != rasterio.crs.CRS.from_user_input('EPSG:4326')):
+            bbox = transform_bounds(raster.crs, 'EPSG:4326', *bbox)
     view_lon = 0.5* (bbox[2] + bbox[0])
     view_lat = bbox[1]
-    print('Transform raster tif to csv file ...')
-    fname_csv ='temp_rasterdata.csv'
-    raster2csv(fname_raster2, path_out = path_out, fname_out = fname_csv, nodataval= nodataval, zfilter = zfilter)
-    # Read in data in Pandas dataframe
-    print('Processing Data ...')
-    data = pd.read_csv(path_out +fname_csv)
-    #offset = np.nanmin(data.Z.values)
-    #if offset > 0.: offset =0
-    el_scale = abs(1000/np.percentile(data.Z.values,  90))
-    el_range = [np.nanmin(data.Z.values) * el_scale, np.nanmax(data.Z.values) * el_scale] 
-    # Apply color map
-    cmap = plt.get_cmap(cmap)
-    # Clip and normalise colorscheme:  
-    z99 = np.percentile(data.Z.values,99)
-    colval = data.Z.values * 1.
-    colval[colval > z99] = z99
-    colval /= colval.max()
-    colrgb = cmap(colval) * 255
-    # Convert colors into RGBA values
-    colrgb_str = [list(colx) for colx in colrgb] 
-    data['color'] = colrgb_str
+    lods = []
+    for factor in levels:
+        # Cell centres in Lng and Lat and values of all valid cells, read directly from raster
+        print('Processing Data ' + ('' if lod_levels is None else 'for aggregation level ' + str(factor) + ' ') + '...')
+        data, _, cellsize = raster2points(input_file, nodataval = nodataval, zfilter = zfilter, factor = factor, 
+            aggregate = lod_aggregate)
+        if len(data) == 0:
+            print('WARNING: no valid cells for aggregation level ' + str(factor))
+            continue
+        lods.append((factor, data, cellsize))
+    if len(lods) == 0:
+        print('WARNING: no valid cells in ' + input_file + ', no webmap created')
+        return
+    # number of raster pixels per cell of level, sums are scaled per pixel so that all levels have the same unit
+    area = lambda factor: float(factor)**2 if lod_aggregate == 'sum' else 1.
+    # elevation and color scale of finest level before clipping to lod_box
+    zval = lods[-1][1].Z.values / area(lods[-1][0])
+    el_scale = abs(1000/np.percentile(zval,  90))
+    cmax = np.percentile(zval, 99)
+    outside = None
+    if (lod_box is not None) and (len(lods) > 1):
+        inbox = lambda data: (data.X >= lod_box[0]) & (data.X <= lod_box[1]) & (data.Y >= lod_box[2]) & (data.Y <= lod_box[3])
+        # coarsest level outside box is drawn at all zooms, finer levels only inside box
+        factor, data, cellsize = lods[0]
+        outside = (factor, data[~inbox(data)].reset_index(drop = True), cellsize)
+        lods = [(factor, data[inbox(data)].reset_index(drop = True), cellsize) for factor, data, cellsize in lods]
+        lods = [lod for lod in lods if len(lod[1]) > 0]
+    layers, ranges = [], []
+    for i, (factor, data, cellsize) in enumerate(lods):
+        layer_id = 'lod' + str(int(cellsize)) + 'm'
+        layers.append(_cell_layer(data, featurename, cmap, cellsize, el_scale / area(factor), cmax * area(factor), layer_id))
+        # zoom range of level: 2 zoom steps per 4x cell size, coarsest level starts at zoom 8
+        # (coarsest level is also drawn below zoom 8, finest level at all larger zooms)
+        conditions = ["layer.id == '" + layer_id + "'"]
+        if i > 0:
+            conditions.append('viewport.zoom >= ' + str(8 + np.log2(lods[0][0] / factor)))
+        if i < len(lods) - 1:
+            conditions.append('viewport.zoom < ' + str(8 + np.log2(lods[0][0] / lods[i + 1][0])))
+        ranges.append('(' + ' && '.join(conditions) + ')')
+    if (outside is not None) and (len(outside[1]) > 0):
+        factor, data, cellsize = outside
+        layer_id = 'lod' + str(int(cellsize)) + 'm_outside'
+        layers.append(_cell_layer(data, featurename, cmap, cellsize, el_scale / area(factor), cmax * area(factor), layer_id))
+        ranges.append("(layer.id == '" + layer_id + "')")
+    deck = _deck3d(layers, view_lon, view_lat, zoom = 8, max_zoom = 15, mbkey = mbkey)
+    if len(layers) > 1:
+        # deck.gl draws only the layer of the current zoom range (function from expression, see deck.gl JSON converter)
+        deck.layer_filter = '@@=' + ' || '.join(ranges)
+    print('Creating html page ...')
+    deck.to_html(path_out + fname_out + '.html', notebook_display=False)
+
+
+def _cell_layer(data, featurename, cmap, cellsize, el_scale, cmax, layer_id = 'cells'):
+    """pydeck GridCellLayer of cells in dataframe data (columns X,Y,Z, see raster2points)
+    with elevation scale el_scale and upper limit cmax of color scale
+    """
+    zval = data.Z.values
+    el_range = [np.nanmin(zval) * el_scale, np.nanmax(zval) * el_scale] 
+    # Apply color map as RGBA columns (uint8)
+    data = pd.concat([data, colormap_rgba(zval, cmap = cmap, vmax = cmax)], axis = 1)
     #rename layers for better labeling:
     data.rename(columns={"X": "LNG", "Y": "LAT", "Z": featurename}, inplace = True) 
-    print('Creating html page ...')
     # Deck Layer definition, using 'GridCellLayer'
-    layer = pdk.Layer(
+    return pdk.Layer(
         'GridCellLayer',
         data,
+        id=layer_id,
         get_position='[LNG, LAT]',
         auto_highlight=True,
         pickable=True,
-        cellsize=100,
+        cellsize=cellsize,
         elevation_scale=el_scale,
         elevation_range=el_range,
         get_elevation= featurename,
-        get_color='color',
+        get_color='[R, G, B, A]',
         extruded=True,               
         coverage=1)
+
+
+def _deck3d(layers, view_lon, view_lat, zoom = 8, max_zoom = 15, mbkey = None):
+    """pydeck Deck with layers and view
+    """
     # Set the viewport location
     view_state = pdk.ViewState(
         longitude=view_lon,
         latitude=view_lat,
-        zoom=8,
+        zoom=zoom,
         min_zoom=5,
-        max_zoom=15,
+        max_zoom=max_zoom,
         pitch=40.5,
         bearing=-27.36)
     # Render
-    r = pdk.Deck(
-        layers=[layer], 
+    return pdk.Deck(
+        layers=layers, 
         initial_view_state=view_state,
         mapbox_key = mbkey)
-    r.to_html(path_out + fname_out + '.html', notebook_display=False)
-    raster.close()
-    # Cleaning up temporary files if required (comment out):
-    #os.remove(fname_raster2)
-    #os.remove(path_out +fname_csv)
@@ -22,7 +22,13 @@ import yaml
 
 # import custom scripts
 from lib.rasterize import *
+from lib.rastercalc import *
+from lib.datacube import write_datacube_changes
+from lib.crosswalk import crosswalk_changes
+from lib.regions import add_region_tasks
 from lib.visual import *
+from lib.pipeline import TaskGraph
+from lib import profiling
 
 ### Import setting parameters and names:
 with open('settings.yaml') as f:
@@ -31,128 +37,184 @@ for key in cfg:
 	globals()[str(key)] = cfg[key]
 
 
-###### Preprocessing Geo Boundaries (Optional)
-if process_geodata:
-	import preprocess_geodata
-
-###### Preprocessing Income Input Data (Optional)
-if process_income:
-	import preprocess_income
-
-
-###### Rasterization of Data to Geo-Tiff files
-# See also rasterize.py
-poly_syd06 = inpath_preprocessed + name_poly06
-data_syd06 = inpath_preprocessed + name_data06
-poly_syd11 = inpath_preprocessed + name_poly11
-data_syd11 = inpath_preprocessed + name_data11
-poly_syd16 = inpath_preprocessed + name_poly16
-data_syd16 = inpath_preprocessed + name_data11
-# For each year combine feature data with polygon shape and run rasterization
-# 2006 
-fname = inpath_preprocessed + 'SYD06mask_COMB.gpkg'
-df06, features06 = combine_geodata(fname_poly = poly_syd06 , fname_data = data_syd06, 
-	featurelist = features, polymask = mask, outfile = fname, indexname = indexname)
-poly2raster(fname, outpath = outpath06, featurelist = features06, polymask = mask, pixsize = pixelsize)
-# 2011
-fname = inpath_preprocessed + 'SYD11mask_COMB.gpkg'
-df11, features11 = combine_geodata(fname_poly = poly_syd11 , fname_data = data_syd11 , 
-	featurelist = features, polymask = mask, outfile = fname, indexname = indexname)
-poly2raster(fname, outpath = outpath11, featurelist = features11, polymask = mask, pixsize = pixelsize)
-# 2016
-fname = inpath_preprocessed + 'SYD16mask_COMB.gpkg'
-df16, features16 = combine_geodata(fname_poly = poly_syd16 , fname_data = data_syd16 , 
-	featurelist = features, polymask = mask, outfile = fname, indexname = indexname)
-poly2raster(fname, outpath = outpath16, featurelist = features16, polymask = mask, pixsize = pixelsize)
-
-# CONTINUE TESTING FROM HERE  
-
-###### Calculate gain/loss for each feature over time
-outpath_change = '../Results/Income_change/'
-features.remove('TOTAL')
-
-if calc_change | calc_change2:
-	if not os.path.exists(outpath_change):
-		os.makedirs(outpath_change)
-	for i, feature in enumerate(features):
+def combine_features(**kwargs):
+	""" Runs combine_geodata and returns only the resulting feature list (combined data is saved in outfile)
+	"""
+	comb, featurelist = combine_geodata(**kwargs)
+	return featurelist
+
+
+def region_changes(*args, **kwargs):
+	""" Runs crosswalk_changes and returns only the output filename (table of regions is saved in outfile)
+	"""
+	crosswalk_changes(*args, **kwargs)
+	return kwargs['outfile']
+
+
+def plot_folders(paths, zoombox = None, workers = 1):
+	""" Makes 2D map and zoom map of all rasters in folders (see make_maps2d) on a pool of worker processes, 
+	run as task after all rasters are created
+	"""
+	list_fnames = [x for path in paths for x in sorted(glob.glob(path + '*.tif')) if not x.endswith('_epsg4326.tif')]
+	make_maps2d(list_fnames, zoombox = zoombox, crs_out = 'EPSG:4326', workers = workers)
+
+
+if __name__ == '__main__':
+
+	###### Run report of all stages (see lib/profiling.py)
+	if run_report is not None:
+		profiling.configure(profile_stages = profile_stages, outpath = os.path.dirname(run_report))
+
+	###### Preprocessing Geo Boundaries (Optional)
+	if process_geodata:
+		with profiling.stage('preprocess_geodata'):
+			import preprocess_geodata
+
+	###### Preprocessing Income Input Data (Optional)
+	if process_income:
+		import preprocess_income
+		with profiling.stage('preprocess_income'):
+			preprocess_income.main(cfg)
+
+
+	###### Task graph of all rasterization, change and plotting stages
+	# Tasks run on a process pool with 'workers' processes as soon as the tasks they depend on are finished;
+	# with a build manifest, tasks whose input files and settings did not change since the last run are skipped
+	graph = TaskGraph(manifest = build_manifest)
+
+	###### Rasterization of Data to Geo-Tiff files
+	# See also rasterize.py
+	poly_syd06 = inpath_preprocessed + name_poly06
+	data_syd06 = inpath_preprocessed + name_data06
+	poly_syd11 = inpath_preprocessed + name_poly11
+	data_syd11 = inpath_preprocessed + name_data11
+	poly_syd16 = inpath_preprocessed + name_poly16
+	data_syd16 = inpath_preprocessed + name_data16
+	# For each year combine feature data with polygon shape and run rasterization
+	years = {'06': (poly_syd06, data_syd06, outpath06), '11': (poly_syd11, data_syd11, outpath11), '16': (poly_syd16, data_syd16, outpath16)}
+	# Polygon boundaries and combined files as GeoParquet boundary store (see write_polygons in rasterize.py) or GeoPackage
+	ext_poly = '.parquet' if boundary_store else '.gpkg'
+	# one or several pixel sizes, larger pixel sizes are aggregated from rasters of smallest pixel size
+	pixelsizes = sorted(pixelsize) if isinstance(pixelsize, list) else [pixelsize]
+	# features of rasters (TOTAL is replaced by population density in combine_geodata)
+	raster_features = [feature for feature in features if feature != 'TOTAL'] + (['POPDENS_100m'] if 'TOTAL' in features else [])
+	for year, (poly_syd, data_syd, outpath) in years.items():
+		poly_syd = os.path.splitext(poly_syd)[0] + ext_poly
+		fname = inpath_preprocessed + 'SYD' + year + 'mask_COMB' + ext_poly
+		graph.add('combine' + year, combine_features, fname_poly = poly_syd , fname_data = data_syd, 
+			featurelist = list(features), polymask = mask, outfile = fname, indexname = indexname,
+			inputs = [poly_syd, data_syd, mask], outputs = [fname])
+		graph.add('raster' + year, poly2raster, fname, outpath = outpath, featurelist = graph.result('combine' + year), polymask = mask, 
+			pixsize = pixelsize, engine = engine, cachedir = cachepath, weighting = weighting, profile = output_profile,
+			inputs = [fname, mask], outputs = [outpath + 'raster_' + str(int(pix)) + 'm_' + feature + '.tif' for pix in pixelsizes for feature in raster_features])
+	if regions is not None:
+		## Batch mode: polygons of each year are read once and partitioned to all regions, regions are rasterized in parallel (see lib/regions.py)
+		for year, (poly_syd, data_syd, outpath) in years.items():
+			add_region_tasks(graph, os.path.splitext(poly_syd)[0] + ext_poly, data_syd, features, regions, outpath_regions, 
+				indexname = indexname, regionname = regionname, suffix = year, ext = ext_poly, pixsize = pixelsize, engine = engine, 
+				cachedir = cachepath, weighting = weighting, profile = output_profile)
+
+	###### Calculate gain/loss for each feature over time
+	outpath_change = '../Results/Income_change/'
+	features.remove('TOTAL')
+	# changes are calculated for smallest pixel size
+	pix = str(int(pixelsizes[0]))
+	if calc_change | calc_change2 | (crosswalk_year is not None):
+		if not os.path.exists(outpath_change):
+			os.makedirs(outpath_change)
+	if datacube and (calc_change | calc_change2):
+		# All changes computed together from one datacube of all years and features
+		pairs = [('11', '06'), ('16', '11'), ('16', '06')]
+		rasters = {year: {feature: outpath + 'raster_' + pix + 'm_' + feature + '.tif' for feature in features + ['POPDENS_100m']} 
+			for year, (_, _, outpath) in years.items()}
+		outfiles = [outpath_change + 'rasterchange_20' + year2 + '-20' + year1 + '_' + feature + '_' + pix + 'm.tif' 
+			for year2, year1 in pairs for feature in features if calc_change]
+		outfiles += [outpath_change + 'rasterchange_pop_20' + year2 + '-20' + year1 + '_' + feature + '_' + pix + 'm.tif' 
+			for year2, year1 in pairs for feature in features if calc_change2]
+		outfiles += [outpath + 'raster_pop_' + pix + 'm_' + feature + '.tif' for year, (_, _, outpath) in years.items() for feature in features if calc_change2]
+		graph.add('datacube', write_datacube_changes, rasters, pairs, outpath_change, features, pix, calc_change = calc_change, 
+			calc_change2 = calc_change2, fname_cube = fname_datacube, profile = output_profile, deps = ['raster' + year for year in years],
+			inputs = [fname for year in rasters for fname in rasters[year].values()], outputs = outfiles)
+	for feature in (features if not datacube else []):
+		infiles = {year: outpath + 'raster_' + pix + 'm_' + feature + '.tif' for year, (_, _, outpath) in years.items()}
 		## Calcuate income percentage changes for the three different time periods:
 		if calc_change:
-			print("Calculating Change rasters for " + feature + ' ...')
-			in06 = outpath06 + 'raster_' + str(int(pixelsize)) + 'm_' + feature + '.tif'
-			in11 = outpath11 + 'raster_' + str(int(pixelsize)) + 'm_' + feature + '.tif'
-			in16 = outpath16 + 'raster_' + str(int(pixelsize)) + 'm_' + feature + '.tif'
-			rasterdiff(in11, in06, outfile = outpath_change + 'rasterchange_2011-2006_'+ feature + '_' +str(int(pixelsize)) + 'm.tif')
-			rasterdiff(in16, in11, outfile = outpath_change + 'rasterchange_2016-2011_'+ feature + '_'+ str(int(pixelsize)) + 'm.tif')
-			rasterdiff(in16, in06, outfile = outpath_change + 'rasterchange_2016-2006_'+ feature + '_'+ str(int(pixelsize)) + 'm.tif')
+			for year2, year1 in [('11', '06'), ('16', '11'), ('16', '06')]:
+				graph.add('change20' + year2 + '-20' + year1 + '_' + feature, rasterdiff, infiles[year2], infiles[year1], 
+					outfile = outpath_change + 'rasterchange_20' + year2 + '-20' + year1 + '_' + feature + '_' + pix + 'm.tif', 
+					profile = output_profile, engine = engine, deps = ['raster' + year2, 'raster' + year1],
+					inputs = [infiles[year2], infiles[year1]], outputs = [outpath_change + 'rasterchange_20' + year2 + '-20' + year1 + '_' + feature + '_' + pix + 'm.tif'])
 		if calc_change2:
 			## Calcuate income population changes for the three different time periods:
 			# First calcuate population number in each income bin:
-			fname_pop06 = outpath06 + 'raster_pop_' + str(int(pixelsize)) + 'm_' + feature + '.tif'
-			fname_pop11 = outpath11 + 'raster_pop_' + str(int(pixelsize)) + 'm_' + feature + '.tif'
-			fname_pop16 = outpath16 + 'raster_pop_' + str(int(pixelsize)) + 'm_' + feature + '.tif'
-			norm06 = outpath06 + 'raster_' + str(int(pixelsize)) + 'm_' + 'POPDENS_100m.tif'
-			norm11 = outpath11 + 'raster_' + str(int(pixelsize)) + 'm_' + 'POPDENS_100m.tif'
-			norm16 = outpath16 + 'raster_' + str(int(pixelsize)) + 'm_' + 'POPDENS_100m.tif'
-			rasterprod(in06, norm06, outfile = fname_pop06)
-			rasterprod(in11, norm11, outfile = fname_pop11)
-			rasterprod(in16, norm16, outfile = fname_pop16)
-			# Now calcuate poplation change
-			rasterdiff(fname_pop11, fname_pop06, outfile = outpath_change + 'rasterchange_pop_2011-2006_'+ feature + '_'+ str(int(pixelsize)) + 'm.tif', norm = True)
-			rasterdiff(fname_pop16, fname_pop11, outfile = outpath_change + 'rasterchange_pop_2016-2011_'+ feature + '_'+ str(int(pixelsize)) + 'm.tif', norm = True)
-			rasterdiff(fname_pop16, fname_pop06, outfile = outpath_change + 'rasterchange_pop_2016-2006_'+ feature + '_'+ str(int(pixelsize)) + 'm.tif', norm = True)
-
-
-
-###### Visualisation (optional)
-# See also visual.py
-if make_plots2d:
-	# Make 2D plots of all tif files in results folders: outpath_change, outpath06, outpath11
-	list_all = glob.glob(outpath_change + '*.tif')
-	list_all.extend(glob.glob(outpath06 + '*.tif'))
-	list_all.extend(glob.glob(outpath11 + '*.tif'))
-	list_all.extend(glob.glob(outpath16 + '*.tif'))
-	# crs for unprojected coordinate system Lat/Lng
-	outputEPSG = 'EPSG:4326'
-	# Ceraet out files with projection  in meters
-	list_all2 =  [x.replace('.tif', '_epsg4326.tif') for x in list_all]
-	# Create corresponding output image names
-	list_fname_out = [x.replace('.tif', '.png') for x in list_all]
-	list_fname_out_zoom = [x.replace('.tif', '_zoom.png') for x in list_all]
-	print("Creating 2D map and zoom maps ...")
-	for i in range(len(list_all)):
-		# Fisrt transform to unprojected coordinate system in Lat/Lng
-		fname_raster = list_all[i]
-		fname_raster2 = list_all2[i]
-		fname_out = list_fname_out[i]
-		fname_out_zoom = list_fname_out_zoom[i]
-		print("Plotting 2D images for rasterfile " + fname_raster2 + " ...")
-		transform_crs(fname_raster, fname_raster2, crs_out = outputEPSG)
-		# Make image of entire region:
-		simplemap2d(fname_raster2, fname_out, logscale = False, show = False)   
-		# Make image of zoomed-in region (sepcified in zbox parameter):
-		simplemap2d(fname_raster2, fname_out_zoom, zoombox = zbox, show = False)  
-
-if make_webmap3d:
-	### Create interactive 3D webmap
-	# First, enable Mapbox for basemap layers
-	try:
-		# enable mapbox, read key form file:
-		keyfile = open(fname_mbox,"r") 
-		key_mbox = keyfile.read()
-		keyfile.close()
-	except:
-		key_mbox = None
-		print("WARNING: Failed to setup Mapbox from keyfile.") 
-		print("Continuing without mapbox basemap layers or set before in terminal with 'export MAPBOX_API_KEY=<mapbox-key-here>.' ")
-	# Run creation of 3D webmap
-	webmap3d(infname_3D, outpath_3D, outname_3D, featurename = featurename_3D, zfilter = zfilter_3D, nodataval = -9999, cmap= 'viridis', mbkey = key_mbox)
-	# infname_3D = '../Results/Income_change/rasterchange_2016-2006_VERY_LOW_100m.tif'  
-	# outname_3D = 'demo_rasterchange_2016-2006_VERY_LOW_100m'  
-	# featurename_3D  = 'Income_Change' 
-	# zfilter_3D = None                                                                                                                           
-	# webmap3d(infname_3D, outpath_3D, outname_3D, featurename = featurename_3D, zfilter = zfilter_3D, nodataval = -9999, cmap= 'viridis', mbkey = key_mbox)
-
-print("FINISHED")
+			fname_pop = {year: outpath + 'raster_pop_' + pix + 'm_' + feature + '.tif' for year, (_, _, outpath) in years.items()}
+			norm = {year: outpath + 'raster_' + pix + 'm_' + 'POPDENS_100m.tif' for year, (_, _, outpath) in years.items()}
+			fname_change = {(year2, year1): outpath_change + 'rasterchange_pop_20' + year2 + '-20' + year1 + '_' + feature + '_' + pix + 'm.tif'
+				for year2, year1 in [('11', '06'), ('16', '11'), ('16', '06')]}
+			if engine == 'rasterio':
+				# Population rasters and their changes are computed together in one pass over the input rasters
+				pop = {year: RasterExpr(EXPR_PROD, A = infiles[year], B = norm[year]) for year in years}
+				targets = [(pop[year], fname_pop[year]) for year in years]
+				targets += [(RasterExpr(EXPR_RELDIFF, A = pop[year2], B = pop[year1]), fname) for (year2, year1), fname in fname_change.items()]
+				graph.add('changepop_' + feature, write_rasters, targets, profile = output_profile, deps = ['raster' + year for year in years],
+					inputs = list(infiles.values()) + list(norm.values()), outputs = [fname for expr, fname in targets])
+			else:
+				for year in years:
+					graph.add('pop' + year + '_' + feature, rasterprod, infiles[year], norm[year], outfile = fname_pop[year], 
+						profile = output_profile, deps = ['raster' + year], inputs = [infiles[year], norm[year]], outputs = [fname_pop[year]])
+				# Now calcuate poplation change
+				for (year2, year1), fname in fname_change.items():
+					graph.add('changepop20' + year2 + '-20' + year1 + '_' + feature, rasterdiff, fname_pop[year2], fname_pop[year1], 
+						outfile = fname, norm = True, profile = output_profile, deps = ['pop' + year2 + '_' + feature, 'pop' + year1 + '_' + feature],
+						inputs = [fname_pop[year2], fname_pop[year1]], outputs = [fname])
+	if crosswalk_year is not None:
+		## Changes per region of census year crosswalk_year, features of other years are re-aggregated to these regions (see lib/crosswalk.py)
+		comb_files = {year: inpath_preprocessed + 'SYD' + year + 'mask_COMB' + ext_poly for year in years}
+		fname_regions = outpath_change + 'regionchange_SA1_20' + crosswalk_year + ext_poly
+		graph.add('crosswalk', region_changes, comb_files, crosswalk_year, [('11', '06'), ('16', '11'), ('16', '06')], 
+			features + ['POPDENS_100m'], indexname = indexname, outfile = fname_regions, cachedir = cachepath,
+			deps = ['combine' + year for year in years], inputs = list(comb_files.values()), outputs = [fname_regions])
+	processing_tasks = list(graph.tasks)
+
+
+	###### Visualisation (optional)
+	# See also visual.py
+	if make_plots2d:
+		# Make 2D plots of all tif files in results folders: outpath_change, outpath06, outpath11, outpath16
+		print("Creating 2D map and zoom maps ...")
+		paths = [outpath_change] + [outpath for year, (_, _, outpath) in years.items()]
+		graph.add('plots2d', plot_folders, paths, zoombox = zbox, workers = workers, deps = processing_tasks, 
+			inputs = [path + '*.tif' for path in paths], outputs = [path + '*.png' for path in paths] + [path + '*_epsg4326.tif' for path in paths])
+
+	if make_webmap3d:
+		### Create interactive 3D webmap
+		# First, enable Mapbox for basemap layers
+		try:
+			# enable mapbox, read key form file:
+			keyfile = open(fname_mbox,"r") 
+			key_mbox = keyfile.read()
+			keyfile.close()
+		except:
+			key_mbox = None
+			print("WARNING: Failed to setup Mapbox from keyfile.") 
+			print("Continuing without mapbox basemap layers or set before in terminal with 'export MAPBOX_API_KEY=<mapbox-key-here>.' ")
+		# Run creation of 3D webmap
+		graph.add('webmap3d', webmap3d, infname_3D, outpath_3D, outname_3D, featurename = featurename_3D, zfilter = zfilter_3D, 
+			nodataval = -9999, cmap= 'viridis', mbkey = key_mbox, lod_levels = lod_levels_3D, lod_aggregate = lod_aggregate_3D, 
+			lod_box = lod_box_3D, deps = processing_tasks, inputs = [infname_3D], 
+			outputs = [outpath_3D + outname_3D + '.html'])
+		# infname_3D = '../Results/Income_change/rasterchange_2016-2006_VERY_LOW_100m.tif'  
+		# outname_3D = 'demo_rasterchange_2016-2006_VERY_LOW_100m'  
+		# featurename_3D  = 'Income_Change' 
+		# zfilter_3D = None                                                                                                                           
+		# webmap3d(infname_3D, outpath_3D, outname_3D, featurename = featurename_3D, zfilter = zfilter_3D, nodataval = -9999, cmap= 'viridis', mbkey = key_mbox)
+
+	graph.run(workers = workers)
+
+	if run_report is not None:
+		profiling.write_report(run_report, info = cfg)
+
+	print("FINISHED")
 
 """
 add here other options and comments:
@@ -9,6 +9,7 @@ import numpy as np
 import geopandas as gpd
 import pandas as pd
 import yaml
+from lib.rasterize import write_polygons
 
 
 ########## Settings
@@ -22,6 +23,7 @@ for key in cfg:
 # parameters below defined in settings.yaml
 #outpath_preproc_geo = '../Data/Preprocessed/'
 #preprocess_all = True # formating of entire NSW geo data
+#write_boundary_store = False # additionally write boundaries as GeoParquet (.parquet) for fast reading
 
 
 if not os.path.exists(outpath_preproc_geo):
@@ -82,6 +84,8 @@ if preprocess_all:
 	df = df[df.geometry.notnull()]
 	df = df.to_crs({'init': 'epsg:3577'})
 	df.to_file(outpath_preproc_geo + 'SA1_2016_AUST_meters.gpkg', driver = 'GPKG', index = False)
+	if write_boundary_store:
+		write_polygons(df, outpath_preproc_geo + 'SA1_2016_AUST_meters.parquet')
 
 	#2011
 	print("Processing 2011  ...")
@@ -93,6 +97,8 @@ if preprocess_all:
 	df["AREASQKM"] = df.area * 1e-6
 	df.rename(columns={"SA1_7DIG11": "SA1_CODE7"}, inplace = True)
 	df.to_file(outpath_preproc_geo + 'SA1_2011_AUST_meters.gpkg', driver = 'GPKG', index = False)	
+	if write_boundary_store:
+		write_polygons(df, outpath_preproc_geo + 'SA1_2011_AUST_meters.parquet')
 
 	#2006
 	print("Processing 2006  ...")
@@ -104,5 +110,7 @@ if preprocess_all:
 	df["AREASQKM"] = df.area * 1e-6
 	df.rename(columns={"CD_CODE06": "SA1_CODE7"}, inplace = True)
 	df.to_file(outpath_preproc_geo + 'SA1_2006_NSW_meters.gpkg', driver = 'GPKG', index = False)	
+	if write_boundary_store:
+		write_polygons(df, outpath_preproc_geo + 'SA1_2006_NSW_meters.parquet')
 
 print('Preprocessing Geodata finished')
\ No newline at end of file
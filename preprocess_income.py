@@ -1,11 +1,10 @@
 # Income Data preprocesing and Plot Exploratory Data Characteristics
+import os
 import numpy as np
-import geopandas as gpd
 import pandas as pd
-from scipy.interpolate import interp1d
+from concurrent.futures import ProcessPoolExecutor
 from lib.utils import *
-import matplotlib.pyplot as plt
-import seaborn as sns
+from lib import profiling
 import yaml
 
 """
@@ -13,316 +12,217 @@ Author: Sebastian Haan
 Affiliation: Sydney Information Hub, The University of Sydney
 
 Comment: Highly customised to input data for processing raw input data;
-File names for coriginal input data have to changed below in script (not in settings.yaml)
+Census years and file names of original input data are defined in settings.yaml (census_years).
+Each census year is processed independently (see process_census_year), all years run in parallel on a process pool.
+Plots are made in a separate optional stage (plot_exp in settings.yaml), so the numeric processing does not need matplotlib.
+
+Run with: python preprocess_income.py (or from mainscript.py with process_income: True)
 """
 
 
 ########## Settings
 
-
-with open('settings.yaml') as f:
-	cfg = yaml.safe_load(f)
-for key in cfg:
-	globals()[str(key)] = cfg[key]
-
 ### set parameters below in settings.yaml:
 # outpath_preproc_inc = '../Results/preprocessed/'
 # plot_exp = False
+# census_years: list of census years with input file and name of index column
+def load_settings(fname = 'settings.yaml'):
+	with open(fname) as f:
+		return yaml.safe_load(f)
+
+
+def read_income(fname_inc, indexcol):
+	""" Reads income table of one census year, columns are index, lower boundaries of income bins and 'Total',
+	with the sum over all regions in row with index 'Total'
+
+	RETURN
+	income table, lower and upper boundaries of bins, population in each bin, total population, cumulative percentage
+	"""
+	inc = pd.read_csv(fname_inc)
+	tot = inc[inc[indexcol] == 'Total'].copy()
+	bins = list(tot)
+	bins = bins[1:-1]
+	bins = np.asarray(bins).astype(int)
+	ubins = bins[1:]
+	ubins = np.append(ubins, 2*bins[-1] - bins[-2])
+	ubins = np.asarray(ubins).astype(int)
+
+	array = tot.to_numpy()
+	array = array[0]
+	ntot = array[-1]
+	array = array[1:-1].astype(int)
+	perc = np.cumsum(array)/ntot * 100
+	return inc, bins, ubins, array, ntot, perc
+
+
+def process_census_year(year, fname_income, index, inpath, outpath, indexname = 'SA1_CODE7',
+	newcol_names = ['VERY_LOW', 'LOW', 'MID', 'HIGH', 'VERY_HIGH']):
+	""" Percentiles, weight matrix and new income bins for one census year, results are written to
+	Percentile_<year>.csv, weights<yy>.csv and NEWPERC_INC<yy>.csv in outpath
+
+	:param year: census year, e.g. 2016
+	:param fname_income: filename of income table relative to inpath
+	:param index: name of index column in income table
+	:param inpath: input path
+	:param outpath: output path
+	:param indexname: name of index column in output table
+	:param newcol_names: names of new income bins
+
+	RETURN
+	Dictionary with bins, population and percentages for plots (see plot_income)
+	"""
+	yy = str(year)[-2:]
+	with profiling.stage('read_income'):
+		inc, bins, ubins, array, ntot, perc = read_income(inpath + fname_income, index)
+
+	res = pd.DataFrame(np.asarray([bins, ubins,np.round(perc).astype(int)]).T, columns=['Weekly_Income_From', 'Weekly_Income_To', 'Percentile'])
+	print('Percentile ' + str(year))
+	diff = np.zeros(len(bins))
+	for i, p in enumerate(perc):
+		print(bins[i], '-', ubins[i], np.round(p,1))
+		if i < len(bins)-1:
+			diff[i] = 0.5 * (bins[i] + bins[i+1])
+		else:
+			diff[i] = bins[i] + (bins[i] - bins[i-1])
+	res.to_csv(outpath  + 'Percentile_' + str(year) + '.csv')
+
+	# Calculate weight matrix and percent of population:
+	print('Computing conversion matrix from old to new income bins for ' + str(year) + ' ...')
+	with profiling.stage('calc_weights'):
+		weights, percpop, med = calc_weights(bins * 1., ubins * 1., perc, array * 1.)
+	print("Median " + str(year) + ":", med)
+
+	### Write results of weights to file
+	np.savetxt(outpath +'weights' + yy + '.csv', weights, delimiter = ',')
+	#for loading data use np.loadtxt('weights...csv')
+
+	###
+	# Apply weights to calculate new income bins
+	# Note that "TOTAL" in input income data is more than sum of individual income bins of the input data (TOTAL = Total population including non-income?)
+	# Thus, the new 5 income bins are therefore given in percentage (each bin divided by sum of income bins) rather than "TOTAL"
+	print('Calculating and saving new income bins for ' + str(year) + ' ...')
+	with profiling.stage('lin_transform'):
+		dfnew = lin_transform(inc, weights, newcol_names = newcol_names, decround =4)
+	dfnew['TOTAL'] = inc['Total']
+	dfnew.rename(columns={index: indexname}, inplace = True)
+	dfnew.to_csv(outpath  + 'NEWPERC_INC' + yy + '.csv', index = False)
+	return {'year': year, 'bins': bins * 1., 'ubins': ubins * 1., 'diff': diff, 'pop': array * 1., 'ntot': ntot,
+		'perc': perc, 'percpop': percpop, 'med': med}
 
 
-### Explore Area sizes
-infile = inpath + 'SA1_Data_2016/1270055001_sa1_2016_aust_shape/SA1_2016_AUST.shp'
-
-d16 = gpd.read_file(infile)
-
-syd16 = d16[d16.GCC_NAME16 == 'Greater Sydney'].copy()
+def print_incbins(med):
+	print("Very low income (<50% median inc): <", np.round(med/2.).astype(int))
+	print("Low income (50% - 80% median inc):  ", np.round(0.5 * med).astype(int), ' to ', np.round(0.8 * med).astype(int))
+	print("Moderate income (80 - 120% median inc):  ", np.round(0.8 * med).astype(int), ' to ',  np.round(1.2 * med).astype(int))
+	print("High income (120% - 200% median inc):  ", np.round(1.2 * med).astype(int), ' to ',  np.round(2. * med).astype(int))
+	print("Very high income (>200% median inc):  >", np.round(2. * med).astype(int))
 
-selcols = ['SA1_7DIG16',
- 'AREASQKM16',
- 'geometry']
 
-syd16 = syd16[selcols]
-#syd16.to_file('SYD16.gpkg', driver = 'GPKG')
+### Plotting stage (optional)
 
-if plot_exp:
-	# histogram on log scale. 
+def plot_area(infile, outpath):
+	""" Histogram of region areas of Greater Sydney on log scale
+	"""
+	import geopandas as gpd
+	import matplotlib.pyplot as plt
+	d16 = gpd.read_file(infile)
+	syd16 = d16[d16.GCC_NAME16 == 'Greater Sydney'].copy()
+	plt.clf()
+	# histogram on log scale.
 	# Use non-equal bin sizes, such that they look equal on log scale.
 	logbins = np.logspace(np.log(syd16.AREASQKM16.min() * 1e6),np.log(syd16.AREASQKM16.max()* 1e6),100, base = np.exp(1))
 	plt.hist(syd16.AREASQKM16 * 1e6, bins=logbins)
-	#sns.distplot(syd16.AREASQKM16, bins=logbins)
 	plt.xscale('log')
 	plt.axvline(np.median(syd16.AREASQKM16)* 1e6, color='k')
 	plt.xlabel('AREA SQM 2016')
-	plt.savefig(outpath_preproc_inc  + 'Dist_area2016.png')
-	#plt.show()
-
-"""
-infile2 = inpath + 'SYD06.gpkg'
-d06 = gpd.read_file(infile2)
-
-d06 = d06.to_crs({'init': 'epsg:3577'})
-
-d06['AREA_SQM'] = d06.area
-
-if plot_exp:
-	logbins = np.logspace(np.log(d06.AREA_SQM.min()),np.log(d06.AREA_SQM.max()),100, base = np.exp(1))
-	plt.hist(d06.AREA_SQM, bins=logbins)
-	#sns.distplot(syd16.AREASQKM16, bins=logbins)
-	plt.xscale('log')
-	plt.axvline(np.median(d06.AREA_SQM), color='k')
-	plt.xlabel('AREA SQM 2006')
-	plt.savefig(outpath_preproc_inc  + 'Dist_area2006.png')
-	#plt.show()
-"""
-
-#### Test in income bins:
-
-# 2016
-fname_inc16 = inpath + 'SA1_Data_2016/SA1_NSW_2016_Income_edited.csv'
-fname_pop16 = inpath + 'SA1_Data_2016/SA1_NSW_2016_UR_edited.csv'
-
-inc16 = pd.read_csv(fname_inc16)
-tot16 = inc16[inc16.SA1_CODE7 == 'Total'].copy()
-bins = list(tot16)
-bins = bins[1:-1]
-bins = np.asarray(bins).astype(int)
-ubins = bins[1:]
-ubins = np.append(ubins, 2*bins[-1] - bins[-2])
-ubins = np.asarray(ubins).astype(int)
-
-array = tot16.to_numpy()
-array = array[0]
-ntot = array[-1]
-array = array[1:-1].astype(int)
-perc16 = np.cumsum(array)/ntot * 100
-
-
-
-res16 = pd.DataFrame(np.asarray([bins, ubins,np.round(perc16).astype(int)]).T, columns=['Weekly_Income_From', 'Weekly_Income_To', 'Percentile'])
-print('Percentile 2016')
-diff = np.zeros(len(bins))
-for i, perc in enumerate(perc16):
-	print(bins[i], '-', ubins[i], np.round(perc,1))
-	if i < len(bins)-1:
-		diff[i] = 0.5 * (bins[i] + bins[i+1])
-	else:
-		diff[i] = bins[i] + (bins[i] - bins[i-1])
-
-res16.to_csv(outpath_preproc_inc  + 'Percentile_2016.csv')
-
-array16 = array *1.
-bins16 = bins *1.
-ubins16 = ubins *1.
-diff16 = diff *1
-ntot16 = ntot * 1
-
-
-# 2011
-fname_inc11 = inpath + 'SA1_Data_2011/SA1_NSW_2011_Income_edited.csv'
-
-inc11 = pd.read_csv(fname_inc11)
-tot11 = inc11[inc11.SA1_CODE7 == 'Total'].copy()
-bins = list(tot11)
-bins = bins[1:-1]
-bins = np.asarray(bins).astype(int)
-ubins = bins[1:]
-ubins = np.append(ubins, 2*bins[-1] - bins[-2])
-ubins = np.asarray(ubins).astype(int)
-
-array = tot11.to_numpy()
-array = array[0]
-ntot = array[-1]
-array = array[1:-1].astype(int)
-perc11 = np.cumsum(array)/ntot * 100
-
-
-
-res11 = pd.DataFrame(np.asarray([bins,ubins, np.round(perc11).astype(int)]).T, columns=['Weekly_Income_From', 'Weekly_Income_To', 'Percentile'])
-print('Percentile 2011')
-diff = np.zeros(len(bins))
-for i, perc in enumerate(perc11):
-	print(bins[i], '-', ubins[i], np.round(perc,1))
-	if i < len(bins)-1:
-		diff[i] = 0.5 * (bins[i] + bins[i+1])
-	else:
-		diff[i] = bins[i] + (bins[i] - bins[i-1])
-
-res11.to_csv(outpath_preproc_inc  + 'Percentile_2011.csv')
-
-array11 = array *1.
-bins11 = bins *1.
-ubins11 = ubins *1.
-diff11 = diff *1.
-ntot11 = ntot * 1
-
-
-#### Calculatiung new income bins
-print('Computing conversion matrix from old to new income bins...')
-# 2006
-fname_inc06 = inpath + 'CCD_Data_2006/CCD_NSW_2006_Income_edited.csv'
-
-inc06 = pd.read_csv(fname_inc06)
-tot06 = inc06[inc06.ASGC_CODE7 == 'Total'].copy()
-bins = list(tot06)
-bins = bins[1:-1]
-bins = np.asarray(bins).astype(int)
-ubins = bins[1:]
-ubins = np.append(ubins, 2*bins[-1] - bins[-2])
-ubins = np.asarray(ubins).astype(int)
-
-array = tot06.to_numpy()
-array = array[0]
-ntot = array[-1]
-array = array[1:-1].astype(int)
-perc06 = np.cumsum(array)/ntot * 100
-
-
-
-res06 = pd.DataFrame(np.asarray([bins,ubins, np.round(perc06).astype(int)]).T, columns=['Weekly_Income_From', 'Weekly_Income_To','Percentile'])
-print('Percentile 2006')
-diff = np.zeros(len(bins))
-for i, perc in enumerate(perc06):
-	print(bins[i], '-', ubins[i], np.round(perc,1))
-	if i < len(bins)-1:
-		diff[i] = 0.5 * (bins[i] + bins[i+1])
-	else:
-		diff[i] = bins[i] + (bins[i] - bins[i-1])
-
-res06.to_csv(outpath_preproc_inc  + 'Percentile_2006.csv')
+	plt.savefig(outpath  + 'Dist_area2016.png')
 
-array06 = array *1.
-bins06 = bins *1.
-ubins06 = ubins *1.
-diff06 = diff *1.
-ntot06 = ntot * 1
 
-if plot_exp:
+def plot_percentiles(results, outpath):
+	""" Cumulative percentage of income for all census years
+	"""
+	import matplotlib.pyplot as plt
+	import seaborn as sns
 	plt.clf()
 	sns.set_style("whitegrid")
-	plt.plot(ubins16, perc16, color = 'darkblue', label = '2016')
-	plt.plot(ubins11, perc11, color = 'blue', label = '2011')
-	plt.plot(ubins06, perc06, color = 'lightblue', label = '2006')
+	# most recent year first
+	colors = ['darkblue', 'blue', 'lightblue']
+	for i, res in enumerate(sorted(results, key = lambda res: res['year'], reverse = True)):
+		plt.plot(res['ubins'], res['perc'], color = colors[i % len(colors)], label = str(res['year']))
 	plt.axhline(50, color='k', ls='dotted')
 	plt.legend(loc = 'upper left')
 	plt.xlabel('Weekly Income')
 	plt.ylabel('Percentile')
-	plt.savefig(outpath_preproc_inc  + 'Perc_income.png')
-
-
-fit = interp1d(perc06, ubins06, kind = 'linear')
-med06 = np.round(fit(50).mean(),1)
-fit = interp1d(perc11, ubins11, kind = 'linear')
-med11 = np.round(fit(50).mean(),1)
-fit = interp1d(perc16, ubins16, kind = 'linear')
-med16 = np.round(fit(50).mean(),1)
-
-print("Median 2006:", med06)
-print("Median 2011:", med11)
-print("Median 2016:", med16)
-
-
-# Calculate weight matrix and percent of population for each census year:		
-weights06, percpop06, med06 = calc_weights(bins06, ubins06, perc06, array06)
-weights11, percpop11, med11 = calc_weights(bins11, ubins11, perc11, array11)
-weights16, percpop16, med16 = calc_weights(bins16, ubins16, perc16, array16)
-
-
-def print_incbins(med):
-	print("Very low income (<50% median inc): <", np.round(med/2.).astype(int))
-	print("Low income (50% - 80% median inc):  ", np.round(0.5 * med).astype(int), ' to ', np.round(0.8 * med).astype(int))
-	print("Moderate income (80 - 120% median inc):  ", np.round(0.8 * med).astype(int), ' to ',  np.round(1.2 * med).astype(int))
-	print("High income (120% - 200% median inc):  ", np.round(1.2 * med).astype(int), ' to ',  np.round(2. * med).astype(int))
-	print("Very high income (>200% median inc):  >", np.round(2. * med).astype(int))
-
-
-if plot_exp:
-	widths = 2. * (diff06-bins06) - 20
-	plt.clf()
-	fig, ax = plt.subplots()
-	#sns.barplot(diff06.astype(int), y=array06/ntot06 * 100, facecolor='lightblue', ax = ax)
-	plt.bar(x = bins06, height = array06/ntot06 * 100, width=widths, align = 'edge', color='lightblue', edgecolor = 'darkblue')
-	#plt.axvline(med06, color = 'k')
-	plt.axvline(med06, color='k', label='median', ls='dotted')
-	plt.axvline(med06/2., color = 'r', ls = '--',label='0.5 median')
-	plt.axvline(0.8* med06, color = 'b', ls = '--',label='0.8 median')
-	plt.axvline(1.2* med06, color = 'b', ls = '--',label='1.2 median')
-	plt.axvline(2.* med06, color = 'r', ls = '--',label='2 median')
-	plt.xlim(0, bins06[-1] + 0.5 * widths[-1])
-	hmax = np.max(array06/ntot06 * 100)
-	xpos = 0.5 * np.asarray([0.5, (0.5 + 0.8), (0.8 + 1.2), (1.2 + 2.), (2 + 2.5)]) * med06
-	for i, txt in enumerate(percpop06):
-		plt.text(xpos[i],hmax, s= str(np.round(txt).astype(int)) + '%', horizontalalignment='center') 
-	plt.legend()
-	plt.xlabel('Weekly Income')
-	plt.ylabel('Population [%]')
-	plt.savefig(outpath_preproc_inc  + 'Income_2006.png')
+	plt.savefig(outpath  + 'Perc_income.png')
 
-	widths = 2. * (diff11-bins11) - 20
-	plt.clf()
-	fig, ax = plt.subplots()
-	#sns.barplot(diff06.astype(int), y=array06/ntot06 * 100, facecolor='lightblue', ax = ax)
-	plt.bar(x = bins11, height = array11/ntot11 * 100, width=widths, align = 'edge', color='lightblue', edgecolor = 'darkblue')
-	#plt.axvline(med06, color = 'k')
-	plt.axvline(med11, color='k', label='median', ls='dotted')
-	plt.axvline(med11/2., color = 'r', ls = '--',label='0.5 median')
-	plt.axvline(0.8* med11, color = 'b', ls = '--',label='0.8 median')
-	plt.axvline(1.2* med11, color = 'b', ls = '--',label='1.2 median')
-	plt.axvline(2.* med11, color = 'r', ls = '--',label='2 median')
-	plt.xlim(0, bins11[-1] + 0.5 * widths[-1])
-	hmax = np.max(array11/ntot11 * 100)
-	xpos = 0.5 * np.asarray([0.5, (0.5 + 0.8), (0.8 + 1.2), (1.2 + 2.), (2 + 2.5)]) * med11
-	for i, txt in enumerate(percpop11):
-		plt.text(xpos[i],hmax, s= str(np.round(txt).astype(int)) + '%', horizontalalignment='center') 
-	plt.legend()
-	plt.xlabel('Weekly Income')
-	plt.ylabel('Population [%]')
-	plt.savefig(outpath_preproc_inc  + 'Income_2011.png')
 
-	widths = 2. * (diff16-bins16) - 20
+def plot_income(res, outpath, steps = INCOME_STEPS):
+	""" Population in income bins of one census year with boundaries of new income bins
+	"""
+	import matplotlib.pyplot as plt
+	bins, diff, med = res['bins'], res['diff'], res['med']
+	pop = res['pop'] / res['ntot'] * 100
+	widths = 2. * (diff-bins) - 20
 	plt.clf()
 	fig, ax = plt.subplots()
-	#sns.barplot(diff06.astype(int), y=array06/ntot06 * 100, facecolor='lightblue', ax = ax)
-	plt.bar(x = bins16, height = array16/ntot16 * 100, width=widths, align = 'edge', color='lightblue', edgecolor = 'darkblue')
-	#plt.axvline(med06, color = 'k')
-	plt.axvline(med16, color='k', label='median', ls='dotted')
-	plt.axvline(med16/2., color = 'r', ls = '--',label='0.5 median')
-	plt.axvline(0.8* med16, color = 'b', ls = '--',label='0.8 median')
-	plt.axvline(1.2* med16, color = 'b', ls = '--',label='1.2 median')
-	plt.axvline(2.* med16, color = 'r', ls = '--',label='2 median')
-	plt.xlim(0, bins16[-1] + 0.5 * widths[-1])
-	hmax = np.max(array16/ntot16 * 100)
-	xpos = 0.5 * np.asarray([0.5, (0.5 + 0.8), (0.8 + 1.2), (1.2 + 2.), (2 + 2.5)]) * med16
-	for i, txt in enumerate(percpop16):
-		plt.text(xpos[i],hmax, s= str(np.round(txt).astype(int)) + '%', horizontalalignment='center') 
+	plt.bar(x = bins, height = pop, width=widths, align = 'edge', color='lightblue', edgecolor = 'darkblue')
+	plt.axvline(med, color='k', label='median', ls='dotted')
+	inner = steps[1:-1]
+	for i, step in enumerate(inner):
+		plt.axvline(step * med, color = 'r' if i in [0, len(inner) - 1] else 'b', ls = '--',label=str(step) + ' median')
+	plt.xlim(0, bins[-1] + 0.5 * widths[-1])
+	hmax = np.max(pop)
+	# text position in center of new bins, last bin is open-ended
+	upper = np.append(steps[1:-1], steps[-2] + 0.5)
+	xpos = 0.5 * (np.asarray(steps[:-1]) + upper) * med
+	for i, txt in enumerate(res['percpop']):
+		plt.text(xpos[i],hmax, s= str(np.round(txt).astype(int)) + '%', horizontalalignment='center')
 	plt.legend()
 	plt.xlabel('Weekly Income')
 	plt.ylabel('Population [%]')
-	plt.savefig(outpath_preproc_inc  + 'Income_2016.png')
-
-
-### Write results of weights to file
-np.savetxt(outpath_preproc_inc +'weights06.csv', weights06, delimiter = ',')
-np.savetxt(outpath_preproc_inc +'weights11.csv', weights11, delimiter = ',')
-np.savetxt(outpath_preproc_inc +'weights16.csv', weights16, delimiter = ',')
-#for loading data use np.loadtxt('weights...csv')
-
-
-###
-# Apply weights to calculate new income bins
-# Note that "TOTAL" in input income data is more than sum of individual income bins of the input data (TOTAL = Total population including non-income?)
-# Thus, the new 5 income bins are therefore given in percentage (each bin divided by sum of income bins) rather than "TOTAL"
-print('Calculating and saving new income bins...')
-dfnew06 = lin_transform(inc06, weights06, newcol_names = ['VERY_LOW', 'LOW', 'MID', 'HIGH', 'VERY_HIGH'], decround =4) 
-dfnew06['TOTAL'] = inc06['Total']
-dfnew06.rename(columns={"ASGC_CODE7": "SA1_CODE7"}, inplace = True)
-dfnew06.to_csv(outpath_preproc_inc  + 'NEWPERC_INC06.csv', index = False)  
-
-dfnew11 = lin_transform(inc11, weights11, newcol_names = ['VERY_LOW', 'LOW', 'MID', 'HIGH', 'VERY_HIGH'], decround =4) 
-dfnew11['TOTAL'] = inc11['Total']
-dfnew11.to_csv(outpath_preproc_inc  + 'NEWPERC_INC11.csv', index = False)  
-
-dfnew16 = lin_transform(inc16, weights16, newcol_names = ['VERY_LOW', 'LOW', 'MID', 'HIGH', 'VERY_HIGH'], decround =4) 
-dfnew16['TOTAL'] = inc16['Total']
-dfnew16.to_csv(outpath_preproc_inc  + 'NEWPERC_INC16.csv', index = False)  
-
-print('Preprocessing Income data finished')
\ No newline at end of file
+	plt.savefig(outpath  + 'Income_' + str(res['year']) + '.png')
+	plt.close(fig)
+
+
+def main(cfg = None):
+	""" Runs income preprocessing for all census years in settings (in parallel) and optional plots
+
+	:param cfg: settings dictionary (Default: read from settings.yaml)
+	"""
+	if cfg is None:
+		cfg = load_settings()
+	inpath, outpath = cfg['inpath'], cfg['outpath_preproc_inc']
+	if not os.path.exists(outpath):
+		os.makedirs(outpath)
+	census_years = cfg['census_years']
+	workers = min(cfg.get('workers', 1), len(census_years))
+	indexname = cfg.get('indexname', 'SA1_CODE7')
+	args = [(entry['year'], entry['fname_income'], entry['index'], inpath, outpath, indexname) for entry in census_years]
+	if workers <= 1:
+		results = []
+		for arg in args:
+			with profiling.stage('income' + str(arg[0])):
+				results.append(process_census_year(*arg))
+	else:
+		with ProcessPoolExecutor(max_workers = workers) as pool:
+			# stages recorded in workers are added to profiling report
+			ctx = [profiling.context('income' + str(arg[0])) for arg in args]
+			results = []
+			for res, records in pool.map(profiling.collect, ctx, [process_census_year] * len(args), *zip(*args)):
+				results.append(res)
+				profiling.merge(records)
+
+	if cfg.get('plot_exp', False):
+		print('Plotting income data ...')
+		with profiling.stage('plots_income'):
+			if cfg.get('fname_area_plot') is not None:
+				plot_area(inpath + cfg['fname_area_plot'], outpath)
+			plot_percentiles(results, outpath)
+			for res in results:
+				plot_income(res, outpath)
+	print('Preprocessing Income data finished')
+	return results
+
+
+if __name__ == '__main__':
+	main()